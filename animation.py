@@ -0,0 +1,425 @@
+# Time-lapse maps of several days or hours, rendered on a single figure
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import instrument
+
+# What is drawn for every product, by source of the frames. Products without
+# minval/maxval keep the color scale of the first frame with values for the whole animation.
+PRODUCTS = {
+    'daily': {
+        'temperature_max': {'column': 't_max', 'filter': 'filter_max_values',
+                            'title': 'Temperature massime %s'},
+        'temperature_min': {'column': 't_min', 'filter': 'filter_min_values',
+                            'title': 'Temperature minime %s'},
+        'rain': {'column': 'rain', 'filter': 'filter_max_values', 'minval': 0, 'maxval': 150,
+                 'cmap': 'gist_stern_r', 'title': 'Pioggia giornaliera %s'},
+        'gust': {'column': 'w_max', 'filter': 'filter_max_values', 'minval': 0, 'maxval': 150,
+                 'cmap': 'gist_stern_r', 'title': 'Raffica massima giornaliera %s'},
+    },
+    'archive': {
+        'temperature': {'column': 'temperature', 'filter': 'filter_values',
+                        'title': 'Temperatura %s'},
+        'humidity': {'column': 'rh', 'filter': 'filter_values', 'minval': 0, 'maxval': 100,
+                     'cmap': 'jet_r', 'title': 'Umidita %s'},
+        'rain': {'column': 'daily_rain', 'filter': 'filter_values', 'minval': 0, 'maxval': 150,
+                 'cmap': 'gist_stern_r', 'title': 'Precipitazioni %s'},
+        'gust': {'column': 'wind_gust', 'filter': 'filter_values', 'minval': 0, 'maxval': 150,
+                 'cmap': 'gist_stern_r', 'fontsize': 10, 'barbs': True, 'title': 'Raffiche %s'},
+    },
+}
+
+
+def prefetch(load, keys, ahead=2):
+    '''Yield (key, load(key)) for every key in order, loading the next ahead keys
+    in background threads while the current one is used (e.g. rendered).
+    A key that cannot be loaded yields its exception instead of the data.'''
+    keys = list(keys)
+    with ThreadPoolExecutor(max_workers=ahead) as executor:
+        futures = [executor.submit(load, key) for key in keys[:ahead]]
+        for i, key in enumerate(keys):
+            if i + ahead < len(keys):
+                futures.append(executor.submit(load, keys[i + ahead]))
+            try:
+                yield key, futures[i].result()
+            except Exception as e:
+                yield key, e
+            # Do not keep the data of the frames already rendered
+            futures[i] = None
+
+
+def daily_frames(start, end, mnw=None, ahead=2, failed=None, **kwargs):
+    '''Yield (date, data) for every day between start and end (YYYY-MM-DD),
+    from get_daily_stations(**kwargs) (e.g. country='IT'), downloading the
+    next ahead days while the current one is rendered. The days that cannot be
+    downloaded are skipped and, if failed is a list, appended to it as (date, error).'''
+    import pandas as pd
+
+    if mnw is None:
+        from api import get_api
+        mnw = get_api()
+    dates = pd.date_range(start, end, freq='D').strftime('%Y-%m-%d')
+
+    def load(observation_date):
+        return mnw.get_daily_stations(observation_date=observation_date, **kwargs)
+
+    for observation_date, data in prefetch(load, dates, ahead):
+        if isinstance(data, Exception):
+            print('Could not download the data of %s: %s' % (observation_date, data))
+            if failed is not None:
+                failed.append((observation_date, data))
+            continue
+        yield observation_date, data
+
+
+def archive_frames(start, end, stations=None, freq='1h', mnw=None, ahead=1, max_workers=8,
+                   failed=None, **kwargs):
+    '''Yield (time, data) every freq between the days start and end (YYYY-MM-DD)
+    with the last observation of every station in that interval, from the
+    archive of stations (by default all the stations of get_stations_meta(**kwargs),
+    e.g. country='IT'). Every day is downloaded by get_archive_range with
+    max_workers concurrent requests while the previous one is rendered.
+    If failed is a list, the days that could not be downloaded, even only for
+    some stations, are appended to it as (date, error).'''
+    import pandas as pd
+    from stations import StationIndex
+
+    if mnw is None:
+        from api import get_api
+        mnw = get_api()
+    index = StationIndex.from_api(mnw, **kwargs)
+    if stations is None:
+        stations = index.meta['station_code'].astype(str).tolist()
+    dates = pd.date_range(start, end, freq='D').strftime('%Y-%m-%d')
+
+    def load(observation_date):
+        data, failed_stations = mnw.get_archive_range(stations, observation_date, observation_date,
+                                                      max_workers=max_workers)
+        if failed_stations and failed is not None:
+            failed.append((observation_date, RuntimeError(
+                '%d stations could not be downloaded' % len(failed_stations))))
+        if data.empty:
+            return data
+        if 'latitude' not in data:
+            data = index.join(data, ['latitude', 'longitude'])
+        data = data.assign(observation_time_local=pd.to_datetime(data['observation_time_local']))
+        return data.sort_values('observation_time_local')
+
+    for observation_date, data in prefetch(load, dates, ahead):
+        if isinstance(data, Exception):
+            print('Could not download the archive of %s: %s' % (observation_date, data))
+            if failed is not None:
+                failed.append((observation_date, data))
+            continue
+        if data.empty:
+            continue
+        slots = data['observation_time_local'].dt.floor(freq)
+        for slot, frame in data.groupby(slots, sort=True):
+            frame = frame.drop_duplicates('station_code', keep='last').reset_index(drop=True)
+            yield slot.strftime('%Y-%m-%d %H:%M'), frame
+
+
+class FFmpegEncoder():
+    def __init__(self, filename, width, height, fps=4, quality=23):
+        '''Pipe raw RGBA frames of width x height pixels to ffmpeg, which encodes
+        them in the format of filename (mp4, gif, webp...) as they arrive.
+        quality is the crf of the mp4 (lower is better).'''
+        extension = os.path.splitext(filename)[1].lower()
+        if extension == '.gif':
+            options = ['-filter_complex', 'split[a][b];[a]palettegen[p];[b][p]paletteuse', '-loop', '0']
+        elif extension == '.webp':
+            options = ['-c:v', 'libwebp', '-lossless', '0', '-q:v', '80', '-loop', '0']
+        else:
+            options = ['-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-crf', str(quality),
+                       '-movflags', '+faststart']
+        command = [os.environ.get('MNW_FFMPEG', 'ffmpeg'), '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'rgba', '-s', '%dx%d' % (width, height),
+                   '-r', str(fps), '-i', '-'] + options + [filename]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, pixels):
+        self.process.stdin.write(pixels.tobytes())
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError('ffmpeg exited with code %d' % self.process.returncode)
+
+
+class PillowEncoder():
+    def __init__(self, filename, fps=4):
+        '''Save an animated gif or webp with Pillow, when ffmpeg is not available.
+        Frames are kept in memory until close (gif frames as 256 colors images).'''
+        self.filename = filename
+        self.format = 'GIF' if filename.lower().endswith('.gif') else 'WEBP'
+        self.duration = int(1000 / fps)
+        self.frames = []
+
+    def write(self, pixels):
+        from PIL import Image
+
+        image = Image.fromarray(pixels, 'RGBA').convert('RGB')
+        if self.format == 'GIF':
+            image = image.quantize(256, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+        self.frames.append(image)
+
+    def close(self):
+        if not self.frames:
+            return
+        tmp_filename = '%s.tmp%d' % (self.filename, os.getpid())
+        self.frames[0].save(tmp_filename, format=self.format, save_all=True,
+                            append_images=self.frames[1:], duration=self.duration, loop=0)
+        os.replace(tmp_filename, self.filename)
+        self.frames = []
+
+
+def get_encoder(filename, width, height, fps=4):
+    '''Return an encoder for filename: ffmpeg if installed (or given in MNW_FFMPEG),
+    otherwise Pillow for gif and webp'''
+    if shutil.which(os.environ.get('MNW_FFMPEG', 'ffmpeg')):
+        return FFmpegEncoder(filename, width, height, fps)
+    if os.path.splitext(filename)[1].lower() in ('.gif', '.webp'):
+        return PillowEncoder(filename, fps)
+    raise RuntimeError('ffmpeg is needed to save %s, only gif and webp can be saved without it' % filename)
+
+
+class FrameRenderer():
+    def __init__(self, product, projection='italy', figsize=(10, 10), dpi=100,
+                 minval=None, maxval=None):
+        '''Draw the frames of an animation of product (an entry of PRODUCTS) on a
+        single figure. The map, its layers and the logos are rendered once and
+        kept as a bitmap: every frame only restores it and draws the new values,
+        barbs and title over it.'''
+        import matplotlib.pyplot as plt
+        import utils
+
+        self.product = product
+        self.projection = projection
+        self.minval = minval if minval is not None else product.get('minval')
+        self.maxval = maxval if maxval is not None else product.get('maxval')
+        self.fig = plt.figure(figsize=figsize, dpi=dpi)
+        self.ax = utils.get_projection(plt, projection, regions=False)
+        if utils.has_cartopy():
+            self.extents = self.ax.get_extent()
+        else:
+            self.extents = utils.map_extent(projection)
+        self.logos = [
+            utils.add_logo_on_map(
+                ax=self.ax, logo='meteoindiretta_logo.png', zoom=0.15, pos=(0.92, 0.1)),
+            utils.add_logo_on_map(
+                ax=self.ax, logo='meteonetwork_logo.png', zoom=0.3, pos=(0.15, 0.05))]
+        self.title = self.ax.set_title('')
+        self.labels = None
+        self.barbs = None
+        self.mappable = None
+        self.background = None
+        self.dynamic = []
+        self.crop = None
+        # Data of the last frame rendered
+        self.previous = None
+
+    def fields(self, data):
+        '''Return the filtered values, their positions and the wind components.
+        Values failing the quality control are left out, comparing the frame
+        with the previous one (see qc.check).'''
+        import qc
+        import utils
+
+        column = self.product['column']
+        columns = [column, 'wind_speed'] if self.product.get('barbs') else [column]
+        flags = qc.check(data, previous=self.previous, columns=[c for c in columns if c in qc.LIMITS])
+        lats = data['latitude'].to_numpy(dtype=float)
+        lons = data['longitude'].to_numpy(dtype=float)
+        values = qc.masked(data, flags, column)
+        sparse = getattr(utils, self.product['filter'])(values, lats, lons, valid=qc.valid(flags, column))
+        u = v = None
+        if self.product.get('barbs'):
+            u, v = utils.wind_components(qc.masked(data, flags, 'wind_speed'), data['wind_direction'].values)
+            removed = utils.station_selection(lats, lons, max_density=1, valid=qc.valid(flags, 'wind_speed'))
+            u, v = utils.apply_selection(removed, u, v)
+
+        return sparse, lons, lats, u, v
+
+    def inside(self, lons, lats, *variables):
+        '''Mask of the stations inside the map where all variables are defined'''
+        import numpy as np
+
+        lon_min, lon_max, lat_min, lat_max = self.extents
+        mask = (lon_min <= lons) & (lons <= lon_max) & (lat_min <= lats) & (lats <= lat_max)
+        for variable in variables:
+            mask &= ~np.isnan(variable)
+        return mask
+
+    def set_scale(self, sparse):
+        '''Take the ends of the color scale not given from the values of a frame,
+        if it has any. Returns whether the color scale is known.'''
+        import numpy as np
+
+        values = sparse[np.isfinite(sparse)]
+        if len(values):
+            if self.minval is None:
+                self.minval = values.min()
+            if self.maxval is None:
+                self.maxval = values.max()
+        return self.minval is not None and self.maxval is not None
+
+    def setup(self, sparse, lons, lats, u, v):
+        '''Create the artists with the first frame and render the static bitmap'''
+        import matplotlib.cm as mplcm
+        import matplotlib.colors as mplcolors
+        import output
+        import utils
+
+        self.labels = utils.add_vals_on_map(ax=self.ax, var=sparse, projection=self.projection,
+                                            lons=lons, lats=lats, minval=self.minval,
+                                            maxval=self.maxval, cmap=self.product.get('cmap', 'rainbow'),
+                                            fontsize=self.product.get('fontsize', 12))
+        if u is not None:
+            self.barbs = utils.add_barbs_on_map(ax=self.ax, projection=self.projection, u=u, v=v,
+                                                lons=lons, lats=lats)
+        self.mappable = mplcm.ScalarMappable(norm=mplcolors.Normalize(vmin=self.minval, vmax=self.maxval),
+                                             cmap=self.product.get('cmap', 'rainbow'))
+
+        # One full draw with the first frame gives the area of the video (the
+        # tight area of that frame, with even sides as video encoders need)
+        # and, without the changing artists, the bitmap restored for every frame
+        canvas = self.fig.canvas
+        canvas.draw()
+        top, bottom, left, right = output.tight_crop(self.fig, canvas.get_renderer())
+        self.crop = (top, bottom - (bottom - top) % 2, left, right - (right - left) % 2)
+        # Logos are drawn again above the values, as in the maps of the products
+        artists = [a for a in [self.labels, self.barbs] + self.logos + [self.title] if a is not None]
+        self.dynamic = sorted(artists, key=lambda artist: artist.get_zorder())
+        for artist in self.dynamic:
+            # Animated artists are left out by draw and drawn by draw_artist
+            artist.set_animated(True)
+        canvas.draw()
+        self.background = canvas.copy_from_bbox(self.fig.bbox)
+
+    @instrument.stage('frame')
+    def render(self, data, label):
+        '''Draw a frame with data and title label and return its RGBA pixels'''
+        import numpy as np
+        import output
+
+        sparse, lons, lats, u, v = self.fields(data)
+        instrument.add(stations=len(data))
+        self.title.set_text(self.product['title'] % label)
+        if self.background is None:
+            if not self.set_scale(sparse):
+                raise ValueError('No value of %s to set the color scale from, give minval and maxval'
+                                 % self.product['column'])
+            self.setup(sparse, lons, lats, u, v)
+
+        inside = self.inside(lons, lats, sparse)
+        values = sparse[inside]
+        self.labels.set_data(np.column_stack([lons[inside], lats[inside]]), np.char.mod('%d', values),
+                             self.mappable.to_rgba(values))
+        if self.barbs is not None:
+            inside = self.inside(lons, lats, u, v)
+            # Stations change between frames, so positions are replaced
+            # together with the components
+            self.barbs.x, self.barbs.y = lons[inside], lats[inside]
+            self.barbs.set_UVC(u[inside], v[inside])
+
+        canvas = self.fig.canvas
+        canvas.restore_region(self.background)
+        for artist in self.dynamic:
+            self.fig.draw_artist(artist)
+        self.previous = data
+
+        return output.crop_pixels(self.fig, np.asarray(canvas.buffer_rgba()), self.crop)
+
+    def close(self):
+        import matplotlib.pyplot as plt
+
+        plt.close(self.fig)
+
+
+def render_animation(frames, product, filename, projection='italy', fps=4,
+                     minval=None, maxval=None, figsize=(10, 10), dpi=100):
+    '''Render frames, an iterable of (label, data) like daily_frames or archive_frames,
+    as an animation of product (an entry of PRODUCTS) in filename (mp4, gif or webp).
+    Frames are piped to the encoder as soon as they are drawn, without intermediate
+    files. Without minval or maxval the color scale is the one of the first frame
+    with values, and the frames before it wait for it. Returns the number of frames.'''
+    import matplotlib
+    matplotlib.use("agg")
+
+    renderer = FrameRenderer(product, projection, figsize, dpi, minval, maxval)
+    encoder = None
+    count = 0
+    pending = []
+    try:
+        for label, data in frames:
+            if data.empty:
+                print('No data for %s, frame skipped' % label)
+                continue
+            pending.append((label, data))
+            if renderer.background is None and not renderer.set_scale(renderer.fields(data)[0]):
+                continue
+            for label, data in pending:
+                pixels = renderer.render(data, label)
+                if encoder is None:
+                    encoder = get_encoder(filename, pixels.shape[1], pixels.shape[0], fps)
+                with instrument.Stage('encode_frame'):
+                    encoder.write(pixels)
+                count += 1
+            pending = []
+        if pending:
+            raise ValueError('No frame has values of %s to set the color scale from, give minval and maxval'
+                             % product['column'])
+    finally:
+        renderer.close()
+        if encoder is not None:
+            encoder.close()
+
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('source', help='daily for one frame per day of the daily data, archive for one '
+                        'frame every --freq of the archive data of the stations', choices=['daily', 'archive'])
+    parser.add_argument('-t', '--plot_type', help='Product, for daily: temperature_max, temperature_min, rain, '
+                        'gust; for archive: temperature, humidity, rain, gust', required=True)
+    parser.add_argument('-s', '--start', help='First day, with format YYYY-MM-DD',
+                        required=False, default=(datetime.now() - timedelta(1)).strftime(format='%Y-%m-%d'))
+    parser.add_argument('-e', '--end', help='Last day, with format YYYY-MM-DD (same as start by default)',
+                        required=False, default=None)
+    parser.add_argument('-f', '--filename', help='Name of the output file (mp4, gif or webp)',
+                        required=False, default='animation.mp4')
+    parser.add_argument('-p', '--projection', help='Projection, at the moment only italy is supported',
+                        required=False, default='italy')
+    parser.add_argument('-c', '--country', help='Country of the stations', required=False, default='IT')
+    parser.add_argument('--stations', help='Station codes (archive only, all the stations of the country by default)',
+                        required=False, nargs='+', default=None)
+    parser.add_argument('--freq', help='Interval between two frames of the archive (e.g. 1h, 30min)',
+                        required=False, default='1h')
+    parser.add_argument('--fps', help='Frames per second', required=False, type=float, default=4)
+    parser.add_argument('--minval', help='Minimum of the color scale', required=False, type=float, default=None)
+    parser.add_argument('--maxval', help='Maximum of the color scale', required=False, type=float, default=None)
+
+    args = parser.parse_args()
+
+    if args.plot_type not in PRODUCTS[args.source]:
+        parser.error('plot_type of %s can be %s' % (args.source, ', '.join(PRODUCTS[args.source])))
+    end = args.end or args.start
+    failed = []
+    if args.source == 'daily':
+        frames = daily_frames(args.start, end, failed=failed, country=args.country)
+    else:
+        frames = archive_frames(args.start, end, stations=args.stations, freq=args.freq,
+                                failed=failed, country=args.country)
+    count = render_animation(frames, PRODUCTS[args.source][args.plot_type], args.filename,
+                             projection=args.projection, fps=args.fps,
+                             minval=args.minval, maxval=args.maxval)
+    print('%s: %d frames' % (args.filename, count))
+    if failed:
+        print('%d days could not be downloaded, the animation is missing their frames' % len(failed))
+    if count == 0 or failed:
+        sys.exit(1)
@@ -1,35 +1,149 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import hashlib
+import itertools
 import json
 import os
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import time
 import pandas as pd
+import instrument
+from parsing import parse_records
+from response_cache import ResponseCache
+from token_store import TokenStore, token_expiry
+
+API_URL = "https://api.meteonetwork.it/v3"
+# MNWApi shared by the scripts, see get_api
+mnw = None
+
+
+def get_api():
+    '''Return the MNWApi shared by all the downloads of the process, created on
+    the first call, so that its session and tokens are reused by every script'''
+    global mnw
+    if mnw is None:
+        mnw = MNWApi()
+    return mnw
 
 
 class MNWApi():
-    def __init__(self):
-        self.api_url = "https://api.meteonetwork.it/v3"
+    def __init__(self, timeout=(5, 60), retries=3, backoff_factor=0.5,
+                 pool_connections=4, pool_maxsize=16, token_store=None,
+                 cache=None, api_url=None):
+        '''All requests go through a single pooled session which keeps the
+        connections alive between calls.
+        - timeout is the (connect, read) timeout in seconds used for every request
+        - retries is the maximum number of retries on connection errors and on
+          429/5xx answers, spaced by an exponential backoff of backoff_factor seconds
+        - pool_connections is the number of hosts to keep pools for and pool_maxsize
+          the number of connections kept alive per host, which should be at least
+          the number of threads using this object concurrently
+        - token_store is the TokenStore where tokens are cached between runs
+        - cache is the ResponseCache used to avoid repeating requests whose answer
+          cannot have changed, by default one in ~/.cache/meteonetwork; pass
+          cache=False to always download
+        - api_url is the base url of the server, by default the meteonetwork one or
+          the one defined in MNW_API_URL (e.g. a local stand-in server)'''
+        self.api_url = (api_url or os.environ.get('MNW_API_URL', API_URL)).rstrip('/')
+        self.timeout = timeout
+        self.session = self.create_session(retries=retries, backoff_factor=backoff_factor,
+                                           pool_connections=pool_connections,
+                                           pool_maxsize=pool_maxsize)
+        if cache is None:
+            cache = ResponseCache()
+            if self.api_url != API_URL:
+                # Answers of other servers are kept apart
+                cache = ResponseCache(os.path.join(cache.path, self.server_key))
+        self.cache = cache
 
-        if 'MNW_TOKEN' in os.environ:
-            self.token = os.environ['MNW_TOKEN']
-        else:
-            print('Requiring new token')
-            self.token = self.get_token()
-            os.environ['MNW_TOKEN'] = self.token
-        if 'MNW_BULK_TOKEN' in os.environ:
-            self.bulk_token = os.environ['MNW_BULK_TOKEN']
-        else:
-            print('Requiring new bulk token')
-            self.bulk_token = self.get_token(bulk=True)
-            os.environ['MNW_BULK_TOKEN'] = self.token
+        # Tokens are obtained lazily on the first request and shared with other
+        # processes through the token store. MNW_TOKEN and MNW_BULK_TOKEN, if defined,
+        # are used until the server rejects them. They are tokens of the meteonetwork
+        # api, never sent to other servers.
+        self.token_store = token_store or TokenStore()
+        self._tokens = {}
+        self._tokens_lock = threading.Lock()
+        if self.api_url == API_URL:
+            if 'MNW_TOKEN' in os.environ:
+                self._tokens[self.token_kind()] = (os.environ['MNW_TOKEN'], float('inf'))
+            if 'MNW_BULK_TOKEN' in os.environ:
+                self._tokens[self.token_kind(bulk=True)] = (os.environ['MNW_BULK_TOKEN'], float('inf'))
 
-        self.headers = {'Authorization': "Bearer %s" % self.token}
-        self.bulk_headers = {'Authorization': "Bearer %s" % self.bulk_token}
+    @property
+    def server_key(self):
+        '''Short name of the server, used to keep its tokens and answers apart'''
+        if self.api_url == API_URL:
+            return None
+        return hashlib.sha1(self.api_url.encode()).hexdigest()[:10]
 
-    def get_token(self, bulk=False):
+    def token_kind(self, bulk=False):
+        '''Name of the tokens of a kind in the token store'''
+        kind = 'bulk' if bulk else 'standard'
+        if self.server_key:
+            kind = '%s@%s' % (kind, self.server_key)
+        return kind
+
+    @property
+    def token(self):
+        return self.get_valid_token()
+
+    @property
+    def bulk_token(self):
+        return self.get_valid_token(bulk=True)
+
+    @property
+    def headers(self):
+        return {'Authorization': "Bearer %s" % self.token}
+
+    @property
+    def bulk_headers(self):
+        return {'Authorization': "Bearer %s" % self.bulk_token}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        '''Close the pooled connections'''
+        self.session.close()
+
+    def create_session(self, retries=3, backoff_factor=0.5,
+                       pool_connections=4, pool_maxsize=16):
+        '''Create a session with keep-alive connection pooling, bounded
+        retries with exponential backoff and compressed transfers'''
+        retry = Retry(total=retries, backoff_factor=backoff_factor,
+                      status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(['GET', 'POST']),
+                      respect_retry_after_header=True,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({'Accept': 'application/json',
+                                'Accept-Encoding': 'gzip, deflate'})
+
+        return session
+
+    def request(self, method, url, **kwargs):
+        '''Perform a request through the pooled session, applying
+        the default timeout if none is given'''
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    @instrument.stage('login')
+    def login(self, bulk=False):
+        '''Log in with MNW_MAIL and MNW_PASSWORD and return the server answer'''
         url = "%s/login" % self.api_url
         data = {
-            'email': os.environ['MNW_MAIL'],
-            'password': os.environ['MNW_PASSWORD']
+            'email': os.environ.get('MNW_MAIL', ''),
+            'password': os.environ.get('MNW_PASSWORD', '')
         }
         if bulk:
             data['bulk'] = True
@@ -37,32 +151,107 @@ class MNWApi():
             data['description'] = 'Hobby, making visualisation and analysis of data'
             data['contribution'] = 'service'
 
-        response = requests.request("POST", url, data=data)
+        response = self.request("POST", url, data=data)
         js = json.loads(response.text)
 
         if "access_token" in js:
-            return js["access_token"]
+            return js
         else:
             sys.exit('Error in getting token: %s' % response.text)
 
-    def get_realtime_station(self, station_code, data_quality=True):
+    def get_token(self, bulk=False):
+        '''Require a new token to the server'''
+        return self.login(bulk)["access_token"]
+
+    def get_valid_token(self, bulk=False):
+        '''Return a token which is not expired, looking first in memory, then
+        in the token store and only as last resort logging in again.'''
+        kind = self.token_kind(bulk)
+        with self._tokens_lock:
+            token, expires_at = self._tokens.get(kind, (None, None))
+            if token and expires_at - self.token_store.margin > time.time():
+                return token
+            token, expires_at = self.token_store.get(kind)
+            if not token:
+                with self.token_store.lock():
+                    # Another process may have refreshed it while we were waiting
+                    token, expires_at = self.token_store.get(kind)
+                    if not token:
+                        print('Requiring new %s token' % kind)
+                        js = self.login(bulk)
+                        token, expires_at = js['access_token'], token_expiry(js)
+                        self.token_store.set(kind, token, expires_at)
+            self._tokens[kind] = (token, expires_at)
+
+            return token
+
+    def invalidate_token(self, token, bulk=False):
+        '''Forget a token that has been rejected by the server'''
+        kind = self.token_kind(bulk)
+        with self._tokens_lock:
+            if self._tokens.get(kind, (None,))[0] == token:
+                del self._tokens[kind]
+        self.token_store.invalidate(kind, token)
+
+    def authorized_request(self, method, url, bulk=False, **kwargs):
+        '''Perform a request with the standard or bulk token. If the token
+        is rejected it is refreshed and the request is repeated once.'''
+        token = self.get_valid_token(bulk)
+        response = self.request(method, url, headers={'Authorization': "Bearer %s" % token},
+                                **kwargs)
+        if response.status_code == 401:
+            self.invalidate_token(token, bulk)
+            token = self.get_valid_token(bulk)
+            response = self.request(method, url, headers={'Authorization': "Bearer %s" % token},
+                                    **kwargs)
+
+        return response
+
+    def get_dataframe(self, endpoint, params, bulk=False, columns=None):
+        '''Get the answer of an endpoint as a typed DataFrame, from the cache
+        if it is still valid there. If columns is given only those columns are
+        returned: when caching the whole answer is parsed and saved anyway,
+        so that other column selections can be served from the cache later.'''
+        if self.cache:
+            with instrument.Stage('cache_lookup', endpoint=endpoint) as stage:
+                data = self.cache.get(endpoint, params, columns=columns)
+                stage.add(hit=data is not None)
+            if data is not None:
+                return data
+
+        url = "%s/%s" % (self.api_url, endpoint)
+        with instrument.Stage('download', endpoint=endpoint) as stage:
+            response = self.authorized_request("GET", url, bulk=bulk, params=params)
+            response.raise_for_status()
+            stage.add(bytes=len(response.content))
+
+        with instrument.Stage('parse', endpoint=endpoint) as stage:
+            if self.cache:
+                data = parse_records(response.content, endpoint)
+                self.cache.set(endpoint, params, data)
+                if columns is not None:
+                    data = data.reindex(columns=columns)
+            else:
+                data = parse_records(response.content, endpoint, columns=columns)
+            stage.add(stations=len(data))
+
+        return data
+
+    def get_realtime_station(self, station_code, data_quality=True, columns=None):
         '''Get realtime data from a single station. 
         Need station_code as input'''
-        url = "%s/data-realtime/%s" % (self.api_url, station_code)
+        endpoint = "data-realtime/%s" % station_code
         data = {
             'data_quality': data_quality
         }
-        response = requests.request(
-            "GET", url, headers=self.headers, params=data)
-
-        return pd.read_json(response.text)
+        return self.get_dataframe(endpoint, data, columns=columns)
 
     def get_realtime_stations(self, country=None, region=None,
-                              lat=None, lon=None, range_km=None, data_quality=True):
+                              lat=None, lon=None, range_km=None, data_quality=True, columns=None):
         '''Get realtime data for all stations.
         One can specify country, region (IT) or a center lat, lon and a range (in km)
-        to search stations in this area.'''
-        url = "%s/data-realtime" % self.api_url
+        to search stations in this area, and columns to only get some of the fields.'''
+        endpoint = "data-realtime"
         data = {
             'data_quality': data_quality
         }
@@ -77,30 +266,24 @@ class MNWApi():
         if range_km:
             data['range'] = range_km
 
-        response = requests.request(
-            "GET", url, headers=self.bulk_headers, params=data)
-
-        return pd.read_json(response.text)
+        return self.get_dataframe(endpoint, data, bulk=True, columns=columns)
 
-    def get_daily_station(self, station_code, observation_date="today", data_quality=True):
+    def get_daily_station(self, station_code, observation_date="today", data_quality=True, columns=None):
         '''Get daily data from a single station. 
         Need station_code and observation_date (YYYY-MM-DD) as input'''
-        url = "%s/data-daily/%s" % (self.api_url, station_code)
+        endpoint = "data-daily/%s" % station_code
         data = {
             'data_quality': data_quality,
             'observation_date': observation_date
         }
-        response = requests.request(
-            "GET", url, headers=self.headers, params=data)
-
-        return pd.read_json(response.text)
+        return self.get_dataframe(endpoint, data, columns=columns)
 
     def get_daily_stations(self, observation_date="today", country=None, region=None,
-                           lat=None, lon=None, range_km=None, data_quality=True):
+                           lat=None, lon=None, range_km=None, data_quality=True, columns=None):
         '''Get daily data for all stations.
         One can specify country, region (IT) or a center lat, lon and a range (in km)
-        to search stations in this area.'''
-        url = "%s/data-daily" % self.api_url
+        to search stations in this area, and columns to only get some of the fields.'''
+        endpoint = "data-daily"
         data = {
             'data_quality': data_quality,
             'observation_date': observation_date
@@ -116,15 +299,12 @@ class MNWApi():
         if range_km:
             data['range'] = range_km
 
-        response = requests.request(
-            "GET", url, headers=self.bulk_headers, params=data)
-
-        return pd.read_json(response.text)
+        return self.get_dataframe(endpoint, data, bulk=True, columns=columns)
 
     def get_stations_meta(self, country=None, region=None,
-                          lat=None, lon=None, range_km=None, data_quality=True):
+                          lat=None, lon=None, range_km=None, data_quality=True, columns=None):
         '''Get station attributes.'''
-        url = "%s/stations" % self.api_url
+        endpoint = "stations"
         data = {
             'data_quality': data_quality
         }
@@ -139,20 +319,107 @@ class MNWApi():
         if range_km:
             data['range'] = range_km
 
-        response = requests.request(
-            "GET", url, headers=self.bulk_headers, params=data)
-
-        return pd.read_json(response.text)
+        return self.get_dataframe(endpoint, data, bulk=True, columns=columns)
 
-    def get_archive_station(self, station_code, observation_date="today", data_quality=True):
+    def get_archive_station(self, station_code, observation_date="today", data_quality=True, columns=None):
         '''Get archived data from a single station. 
         Need station_code and observation_date (YYYY-MM-DD) as input'''
-        url = "%s/data-archive/%s" % (self.api_url, station_code)
+        endpoint = "data-archive/%s" % station_code
         data = {
             'data_quality': data_quality,
             'observation_date': observation_date
         }
-        response = requests.request(
-            "GET", url, headers=self.bulk_headers, params=data)
+        return self.get_dataframe(endpoint, data, bulk=True, columns=columns)
+
+    def get_archive_range(self, stations, start, end, max_workers=8, rate=None,
+                          callback=None, checkpoint_dir=None, data_quality=True, columns=None,
+                          skip=None):
+        '''Get archived data for a list of stations between the days start and end
+        (YYYY-MM-DD, both included), downloading up to max_workers station/day pairs
+        concurrently and at most rate requests per second (no limit if None).
+        Remember to create the MNWApi with a pool_maxsize of at least max_workers.
+        - callback, if given, is called as callback(station_code, observation_date, data)
+          for every station/day as soon as it is available, and the data is not kept
+          in memory; otherwise everything is concatenated in a single DataFrame
+        - checkpoint_dir, if given, is a directory where every downloaded station/day is
+          saved, so that a new call after a partial failure only downloads what is missing
+        - skip, if given, is a set of (station_code, observation_date) not to download
+        Returns the data (None when using callback) and the list of
+        (station_code, observation_date, error) that could not be downloaded or
+        for which callback failed.'''
+        dates = pd.date_range(start, end, freq='D').strftime('%Y-%m-%d')
+        limiter = RateLimiter(rate) if rate else None
+        if checkpoint_dir:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+
+        def download(station_code, observation_date):
+            if checkpoint_dir:
+                chunk_file = os.path.join(checkpoint_dir, '%s_%s.pkl' % (station_code, observation_date))
+                if os.path.exists(chunk_file):
+                    return pd.read_pickle(chunk_file)
+            if limiter:
+                limiter.wait()
+            data = self.get_archive_station(station_code, observation_date, data_quality, columns)
+            if not data.empty and 'station_code' not in data:
+                data['station_code'] = station_code
+            if checkpoint_dir:
+                # Write to a temporary file first so that an interrupted run
+                # never leaves a truncated chunk behind
+                data.to_pickle(chunk_file + '.tmp')
+                os.replace(chunk_file + '.tmp', chunk_file)
+            return data
+
+        pairs = ((station_code, observation_date) for station_code in stations for observation_date in dates
+                 if not skip or (station_code, observation_date) not in skip)
+        # Station/days are submitted in windows, so that long ranges never hold
+        # more than a few pending futures (and their results) in memory
+        window = max_workers * 4
+        chunks, failed = [], []
+        total = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            while True:
+                for station_code, observation_date in itertools.islice(pairs, window - len(futures)):
+                    future = executor.submit(download, station_code, observation_date)
+                    futures[future] = (station_code, observation_date)
+                if not futures:
+                    break
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    station_code, observation_date = futures.pop(future)
+                    total += 1
+                    try:
+                        data = future.result()
+                        if callback:
+                            # A failing callback (e.g. a partition that cannot be
+                            # written) only fails its station/day
+                            callback(station_code, observation_date, data)
+                        elif not data.empty:
+                            chunks.append(data)
+                    except Exception as e:
+                        failed.append((station_code, observation_date, e))
+
+        if failed:
+            print('Could not get %d out of %d station/days' % (len(failed), total))
+        if callback:
+            return None, failed
+        if chunks:
+            return pd.concat(chunks, ignore_index=True), failed
+        return pd.DataFrame(), failed
+
+
+class RateLimiter():
+    def __init__(self, rate):
+        '''Allow at most rate calls per second to wait(), shared between threads'''
+        self.interval = 1. / rate
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
 
-        return pd.read_json(response.text)
+    def wait(self):
+        '''Block until the next call is allowed'''
+        with self.lock:
+            now = time.monotonic()
+            call_time = max(now, self.next_time)
+            self.next_time = call_time + self.interval
+        if call_time > now:
+            time.sleep(call_time - now)
@@ -0,0 +1,232 @@
+# Local partitioned store of the historical meteonetwork data
+import argparse
+import os
+import shutil
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pandas as pd
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.local', 'share', 'meteonetwork', 'archive')
+# Files starting with _ are ignored when reading the partitions
+EMPTY_MARKER = '_EMPTY'
+# Partitions of days which may still receive data, downloaded again by the next backfill
+PROVISIONAL_MARKER = '_PROVISIONAL'
+
+
+class ArchiveStore():
+    def __init__(self, path=None, mnw=None, settle_time=6 * 3600):
+        '''Store of parquet files in path, by default ~/.local/share/meteonetwork/archive
+        or the directory defined in MNW_ARCHIVE_DIR, with two datasets:
+        - daily: data from get_daily_stations, one partition per day
+          (daily/date=YYYY-MM-DD/part-0.parquet)
+        - archive: data from get_archive_station, one partition per day and station
+          (archive/date=YYYY-MM-DD/station=CODE/part-0.parquet)
+        mnw is the MNWApi used to backfill the store. Days which ended less than
+        settle_time seconds ago (as in ResponseCache) can still be incomplete: their
+        partitions are marked as provisional and replaced by the next backfill.'''
+        self.path = path or os.environ.get('MNW_ARCHIVE_DIR', DEFAULT_PATH)
+        self.mnw = mnw
+        self.settle_time = settle_time
+
+    def is_settled(self, observation_date):
+        '''Whether the data of a day (YYYY-MM-DD) is not going to change anymore'''
+        day = datetime.strptime(observation_date, '%Y-%m-%d')
+        return datetime.now() > day + timedelta(days=1, seconds=self.settle_time)
+
+    def partition_path(self, dataset, observation_date, station_code=None):
+        '''Directory of a partition'''
+        path = os.path.join(self.path, dataset, 'date=%s' % observation_date)
+        if station_code is not None:
+            path = os.path.join(path, 'station=%s' % station_code)
+        return path
+
+    def partitions(self, dataset):
+        '''Return the set of complete partitions already in the store: dates for the
+        daily dataset, (station_code, date) pairs for the archive dataset.
+        Provisional partitions are left out, so that they are downloaded again.'''
+        existing = set()
+        root = os.path.join(self.path, dataset)
+        if not os.path.isdir(root):
+            return existing
+        for date_dir in os.scandir(root):
+            if not date_dir.name.startswith('date='):
+                continue
+            observation_date = date_dir.name[5:]
+            if dataset == 'daily':
+                if not os.path.exists(os.path.join(date_dir.path, PROVISIONAL_MARKER)):
+                    existing.add(observation_date)
+                continue
+            for station_dir in os.scandir(date_dir.path):
+                if (station_dir.name.startswith('station=') and
+                        not os.path.exists(os.path.join(station_dir.path, PROVISIONAL_MARKER))):
+                    existing.add((station_dir.name[8:], observation_date))
+
+        return existing
+
+    def write_partition(self, data, dataset, observation_date, station_code=None):
+        '''Save the data of a partition. Days without data are saved as
+        empty partitions so that they are not downloaded again. Partitions of
+        days which are not settled yet are marked as provisional.'''
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        path = self.partition_path(dataset, observation_date, station_code)
+        # Hidden until complete, so that it is ignored when reading
+        tmp_path = os.path.join(os.path.dirname(path), '.%s.tmp%d' % (os.path.basename(path), os.getpid()))
+        os.makedirs(tmp_path, exist_ok=True)
+        if data.empty:
+            open(os.path.join(tmp_path, EMPTY_MARKER), 'w').close()
+        else:
+            # Categories are saved as strings, which parquet compresses anyway,
+            # so that all the partitions have the same schema (missing values stay null)
+            data = data.astype({c: 'string' for c in data.select_dtypes('category')})
+            table = pa.Table.from_pandas(data, preserve_index=False)
+            # Strings have the same type with every version of pandas
+            table = table.cast(pa.schema([pa.field(f.name, pa.string()) if pa.types.is_large_string(f.type) else f
+                                          for f in table.schema], metadata=table.schema.metadata))
+            pq.write_table(table, os.path.join(tmp_path, 'part-0.parquet'), compression='zstd')
+        if not self.is_settled(observation_date):
+            open(os.path.join(tmp_path, PROVISIONAL_MARKER), 'w').close()
+        # The partition appears only when complete
+        if os.path.exists(path) and not os.path.exists(os.path.join(path, PROVISIONAL_MARKER)):
+            # Written in the meantime by another process
+            shutil.rmtree(tmp_path)
+            return
+        old_path = None
+        if os.path.exists(path):
+            # Replace the provisional partition
+            old_path = tmp_path + '.old'
+            os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        if old_path:
+            shutil.rmtree(old_path)
+
+    def backfill(self, dataset, start, end, stations=None, max_workers=4, **kwargs):
+        '''Download the partitions between the days start and end (YYYY-MM-DD) which
+        are not in the store yet. For the archive dataset stations is the list of
+        station codes, for the daily dataset kwargs are passed to get_daily_stations
+        (e.g. country='IT'). Returns the list of partitions that could not be downloaded.'''
+        if self.mnw is None:
+            from api import MNWApi
+            # The store keeps the answers itself, and the cache could give back
+            # the answer of a provisional day after it settled
+            self.mnw = MNWApi(pool_maxsize=max_workers, cache=False)
+        existing = self.partitions(dataset)
+        dates = pd.date_range(start, end, freq='D').strftime('%Y-%m-%d')
+
+        if dataset == 'archive':
+            def save(station_code, observation_date, data):
+                self.write_partition(data, 'archive', observation_date, station_code)
+
+            _, failed = self.mnw.get_archive_range(stations, start, end, max_workers=max_workers,
+                                                   callback=save, skip=existing, **kwargs)
+            return failed
+
+        failed = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(self.mnw.get_daily_stations, observation_date=d, **kwargs): d
+                       for d in dates if d not in existing}
+            for future in as_completed(futures):
+                observation_date = futures[future]
+                try:
+                    self.write_partition(future.result(), 'daily', observation_date)
+                except Exception as e:
+                    failed.append((observation_date, e))
+
+        return failed
+
+    def dataset(self, dataset):
+        '''Return the pyarrow dataset, with date (and station) as partition fields'''
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+
+        fields = [('date', pa.string())]
+        if dataset == 'archive':
+            fields.append(('station', pa.string()))
+
+        return ds.dataset(os.path.join(self.path, dataset), format='parquet',
+                          partitioning=ds.partitioning(pa.schema(fields), flavor='hive'))
+
+    def query(self, dataset, start=None, end=None, stations=None, columns=None,
+              bbox=None, filters=None):
+        '''Read data from the store as a DataFrame, only reading the partitions,
+        row groups and columns that are needed.
+        - start, end: first and last day (YYYY-MM-DD) to read
+        - stations: list of station codes
+        - columns: list of columns to read, all if None
+        - bbox: [lon_min, lon_max, lat_min, lat_max] of the stations to read
+        - filters: list of further conditions as (column, operator, value) with
+          operator one of ==, !=, <, <=, >, >=, in
+        e.g. query('daily', '2020-01-01', '2022-12-31', columns=['station_code', 't_max'],
+                   filters=[('region_name', '==', 'Lombardia')])'''
+        import pyarrow.dataset as ds
+
+        conditions = []
+        if start:
+            conditions.append(ds.field('date') >= start)
+        if end:
+            conditions.append(ds.field('date') <= end)
+        if stations is not None:
+            stations = [str(s) for s in stations]
+            if dataset == 'archive':
+                # Prune the partitions as well
+                conditions.append(ds.field('station').isin(stations))
+            conditions.append(ds.field('station_code').isin(stations))
+        if bbox is not None:
+            lon_min, lon_max, lat_min, lat_max = bbox
+            conditions += [ds.field('longitude') >= lon_min, ds.field('longitude') <= lon_max,
+                           ds.field('latitude') >= lat_min, ds.field('latitude') <= lat_max]
+        operators = {'==': '__eq__', '!=': '__ne__', '<': '__lt__', '<=': '__le__',
+                     '>': '__gt__', '>=': '__ge__'}
+        for column, operator, value in filters or []:
+            if operator == 'in':
+                conditions.append(ds.field(column).isin(value))
+            else:
+                conditions.append(getattr(ds.field(column), operators[operator])(value))
+
+        condition = None
+        for c in conditions:
+            condition = c if condition is None else condition & c
+
+        try:
+            data = self.dataset(dataset)
+        except FileNotFoundError:
+            return pd.DataFrame(columns=columns)
+
+        return data.to_table(columns=columns, filter=condition).to_pandas()
+
+    def station_statistics(self, dataset, column, start=None, end=None, stations=None,
+                           bbox=None, filters=None):
+        '''Return count, mean, min and max of column for every station'''
+        data = self.query(dataset, start, end, stations=stations, columns=['station_code', column],
+                          bbox=bbox, filters=filters)
+
+        return data.groupby('station_code')[column].agg(['count', 'mean', 'min', 'max'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dataset', help='Dataset to backfill, daily or archive', choices=['daily', 'archive'])
+    parser.add_argument('-s', '--start', help='First day to download, with format YYYY-MM-DD', required=True)
+    parser.add_argument('-e', '--end', help='Last day to download, with format YYYY-MM-DD', required=True)
+    parser.add_argument('--stations', help='Station codes to download (archive dataset only)',
+                        required=False, nargs='+', default=None)
+    parser.add_argument('-c', '--country', help='Country of the stations to download (daily dataset only)',
+                        required=False, default=None)
+    parser.add_argument('-w', '--workers', help='Number of concurrent downloads',
+                        required=False, type=int, default=4)
+    parser.add_argument('-d', '--directory', help='Directory of the store',
+                        required=False, default=None)
+
+    args = parser.parse_args()
+
+    store = ArchiveStore(args.directory)
+    if args.dataset == 'archive':
+        if not args.stations:
+            parser.error('--stations is required for the archive dataset')
+        failed = store.backfill('archive', args.start, args.end, stations=args.stations,
+                                max_workers=args.workers)
+    else:
+        failed = store.backfill('daily', args.start, args.end, max_workers=args.workers,
+                                country=args.country)
+    print('Backfill done, %d partitions failed' % len(failed))
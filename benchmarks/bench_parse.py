@@ -0,0 +1,32 @@
+# Compare the parsing of a realtime answer with pd.read_json and with parsing.parse_records
+import argparse
+import io
+import os
+import sys
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import parsing
+import synthetic
+from run_benchmarks import measure
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num_stations', help='Number of stations in the synthetic answers',
+                        type=int, nargs='+', default=[1000, 10000, 100000])
+    args = parser.parse_args()
+
+    projection = ['latitude', 'longitude', 'temperature']
+    print('%10s %-28s %10s %12s' % ('stations', 'method', 'time [ms]', 'peak [MB]'))
+    for num_stations in args.num_stations:
+        content = synthetic.payload(synthetic.realtime_frame(num_stations))
+        methods = {
+            'pd.read_json(text)': lambda: pd.read_json(io.StringIO(content.decode())),
+            'parse_records': lambda: parsing.parse_records(content, 'data-realtime'),
+            'parse_records (3 columns)': lambda: parsing.parse_records(content, 'data-realtime',
+                                                                       columns=projection),
+        }
+        for name, function in methods.items():
+            wall_time, peak = measure(function)
+            print('%10d %-28s %10.1f %12.1f' % (num_stations, name, wall_time * 1000, peak))
@@ -0,0 +1,303 @@
+# Local stand-in of the meteonetwork api, serving synthetic or recorded answers
+# with configurable latency, errors and rate limits
+import argparse
+import glob
+import hashlib
+import json
+import os
+import random
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import numpy as np
+import pandas as pd
+import synthetic
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from stations import to_xyz, chord_to_km
+
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+STATION_COLUMNS = ['station_code', 'place', 'latitude', 'longitude', 'country', 'region_name']
+
+
+def load_fixture(kind, fixtures_dir):
+    '''Return the recorded answer of a kind (realtime or daily) as a DataFrame,
+    preferring the europe one which contains all the stations, or None'''
+    for name in ['europe', 'italy']:
+        filename = os.path.join(fixtures_dir, '%s_%s.json' % (kind, name))
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                return pd.DataFrame(json.loads(f.read()))
+    for filename in sorted(glob.glob(os.path.join(fixtures_dir, '%s_*.json' % kind))):
+        with open(filename, 'rb') as f:
+            return pd.DataFrame(json.loads(f.read()))
+    return None
+
+
+def synthetic_frame(frame_function, num_stations, seed=0):
+    '''Synthetic answer for a network with 60% of the stations in Italy'''
+    num_italy = int(num_stations * 0.6)
+    italy = frame_function(num_italy, 'italy', seed=seed)
+    europe = frame_function(num_stations - num_italy, 'europe', seed=seed + 100)
+    europe['station_code'] = europe['station_code'].str.replace('st', 'eu', n=1)
+
+    return pd.concat([italy, europe], ignore_index=True)
+
+
+class LocalServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 8000), num_stations=2000, fixtures_dir=None,
+                 latency=0., jitter=0., error_rate=0., rate_limit=None, token_ttl=86400,
+                 check_tokens=False, seed=0):
+        '''Serve /login, /data-realtime, /data-daily, /stations and /data-archive
+        (optionally under /v3) like the meteonetwork api.
+        - num_stations is the size of the synthetic network, used unless recorded answers
+          (see record_fixtures.py) are found in fixtures_dir
+        - every answer is delayed by latency seconds plus up to jitter random seconds
+        - a fraction error_rate of the requests fails with 503
+        - more than rate_limit requests per second (per token) are refused with 429
+        - tokens issued by /login expire after token_ttl seconds; only with
+          check_tokens=True other tokens are refused with 401
+        GET /stats returns the number of requests and answers by status.'''
+        super().__init__(address, RequestHandler)
+        self.num_stations = num_stations
+        self.fixtures_dir = fixtures_dir
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.token_ttl = token_ttl
+        self.check_tokens = check_tokens
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.windows = {}
+        self.stats = Counter()
+        self.realtime = None
+        if fixtures_dir:
+            self.realtime = load_fixture('realtime', fixtures_dir)
+        if self.realtime is None:
+            self.realtime = synthetic_frame(synthetic.realtime_frame, num_stations, seed)
+        self.daily_cache = {}
+
+    @property
+    def url(self):
+        '''Base url to give to MNWApi'''
+        return 'http://%s:%d/v3' % self.server_address[:2]
+
+    def daily(self, observation_date):
+        '''Daily answer of a day, the recorded one or a synthetic one
+        which is different but reproducible for every day'''
+        with self.lock:
+            if observation_date not in self.daily_cache:
+                data = load_fixture('daily', self.fixtures_dir) if self.fixtures_dir else None
+                if data is None:
+                    # Same stations of the realtime answer
+                    day_seed = int(hashlib.sha1(observation_date.encode()).hexdigest()[:6], 16)
+                    generated = synthetic.daily_frame(len(self.realtime), seed=day_seed)
+                    stations = self.realtime[[c for c in STATION_COLUMNS if c in self.realtime]]
+                    data = pd.concat([stations.reset_index(drop=True),
+                                      generated.loc[:, 'observation_date':]], axis=1)
+                data = data.assign(observation_date=observation_date)
+                self.daily_cache[observation_date] = data
+            return self.daily_cache[observation_date]
+
+    def archive(self, station_code, observation_date):
+        '''Synthetic observations of a station every 10 minutes of a day'''
+        station = self.realtime[self.realtime['station_code'] == station_code]
+        if station.empty:
+            return station
+        day_seed = int(hashlib.sha1(('%s %s' % (station_code, observation_date)).encode())
+                       .hexdigest()[:8], 16)
+        rng = np.random.default_rng(day_seed)
+        times = pd.date_range(observation_date, periods=144, freq='10min')
+        temperature = (station['temperature'].iloc[0] - 5 * np.cos(np.arange(144) / 144 * 2 * np.pi)
+                       + rng.normal(0, 0.3, 144).cumsum() / 10)
+        data = pd.DataFrame({column: station[column].iloc[0] for column in STATION_COLUMNS},
+                            index=range(144))
+        data['observation_time_local'] = times.strftime('%Y-%m-%d %H:%M:%S')
+        data['temperature'] = temperature.round(1)
+        data['rh'] = np.clip(70 + 20 * np.cos(np.arange(144) / 144 * 2 * np.pi), 0, 100).round()
+        data['wind_speed'] = rng.gamma(2, 4, 144).round(1)
+        data['daily_rain'] = np.cumsum(rng.exponential(0.1, 144) * (rng.random(144) < 0.1)).round(1)
+
+        return data
+
+    def rate_limited(self, token):
+        '''Whether a request with token exceeds the rate limit'''
+        if not self.rate_limit:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            window = [t for t in self.windows.get(token, []) if now - t < 1.]
+            limited = len(window) >= self.rate_limit
+            if not limited:
+                window.append(now)
+            self.windows[token] = window
+        return limited
+
+
+def select(data, params):
+    '''Apply the country, region and lat/lon/range filters of the api'''
+    if 'country' in params and 'country' in data:
+        data = data[data['country'] == params['country']]
+    if 'region' in params:
+        region = 'region' if 'region' in data else 'region_name'
+        data = data[data[region].astype(str).str.lower() == params['region'].lower()]
+    if 'lat' in params and 'lon' in params and 'range' in params:
+        point = to_xyz(float(params['lat']), float(params['lon']))
+        distances = chord_to_km(np.linalg.norm(
+            to_xyz(data['latitude'].values, data['longitude'].values) - point, axis=-1))
+        data = data[distances <= float(params['range'])]
+    return data
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def answer(self, status, content, headers=None):
+        with self.server.lock:
+            self.server.stats[str(status)] += 1
+        if isinstance(content, pd.DataFrame):
+            content = content.to_json(orient='records', double_precision=5)
+        elif not isinstance(content, (str, bytes)):
+            content = json.dumps(content)
+        if isinstance(content, str):
+            content = content.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def prepare(self):
+        '''Simulate latency and errors, returning False if the request was refused'''
+        server = self.server
+        with server.lock:
+            server.stats['requests'] += 1
+        if server.latency or server.jitter:
+            time.sleep(server.latency + server.jitter * server.random.random())
+        if server.error_rate and server.random.random() < server.error_rate:
+            self.answer(503, {'message': 'Service temporarily unavailable'})
+            return False
+        return True
+
+    def route(self):
+        '''Split the path in endpoint and station code, without the /v3 prefix'''
+        url = urlsplit(self.path)
+        parts = [p for p in url.path.split('/') if p]
+        if parts and parts[0] == 'v3':
+            parts = parts[1:]
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        return parts, params
+
+    def do_POST(self):
+        parts, params = self.route()
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        if parts != ['login']:
+            self.answer(404, {'message': 'Not found'})
+            return
+        if not self.prepare():
+            return
+        token = secrets.token_hex(20)
+        with self.server.lock:
+            self.server.tokens[token] = time.time() + self.server.token_ttl
+        self.answer(200, {'access_token': token, 'token_type': 'Bearer',
+                          'expires_in': self.server.token_ttl})
+
+    def do_GET(self):
+        server = self.server
+        parts, params = self.route()
+        if parts == ['stats']:
+            self.answer(200, dict(server.stats))
+            return
+        if not self.prepare():
+            return
+
+        token = self.headers.get('Authorization', '').replace('Bearer ', '', 1)
+        expires_at = server.tokens.get(token)
+        if not token or (expires_at is None and server.check_tokens) or \
+                (expires_at is not None and expires_at < time.time()):
+            self.answer(401, {'message': 'Unauthenticated.'})
+            return
+        if server.rate_limited(token):
+            self.answer(429, {'message': 'Too Many Attempts.'}, {'Retry-After': '1'})
+            return
+
+        endpoint, station_code = parts[0] if parts else None, parts[1] if len(parts) > 1 else None
+        if endpoint == 'data-realtime':
+            data = server.realtime
+        elif endpoint == 'stations':
+            data = server.realtime[[c for c in STATION_COLUMNS if c in server.realtime]]
+        elif endpoint == 'data-daily':
+            observation_date = params.get('observation_date', 'today')
+            if observation_date == 'today':
+                observation_date = time.strftime('%Y-%m-%d')
+            data = server.daily(observation_date)
+        elif endpoint == 'data-archive' and station_code:
+            observation_date = params.get('observation_date', 'today')
+            if observation_date == 'today':
+                observation_date = time.strftime('%Y-%m-%d')
+            self.answer(200, server.archive(station_code, observation_date))
+            return
+        else:
+            self.answer(404, {'message': 'Not found'})
+            return
+
+        if station_code:
+            data = data[data['station_code'] == station_code]
+            if data.empty:
+                self.answer(404, {'message': 'Station not found'})
+                return
+        self.answer(200, select(data, params))
+
+
+def serve_in_background(**kwargs):
+    '''Start a LocalServer in a daemon thread (on a free port unless address is given)
+    and return it; use server.url as api_url and server.shutdown() to stop it'''
+    kwargs.setdefault('address', ('127.0.0.1', 0))
+    server = LocalServer(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', help='Address to listen on', default='127.0.0.1')
+    parser.add_argument('-p', '--port', help='Port to listen on', type=int, default=8000)
+    parser.add_argument('-n', '--num_stations', help='Number of stations of the synthetic network',
+                        type=int, default=2000)
+    parser.add_argument('--fixtures', help='Directory of the recorded answers to replay',
+                        default=None)
+    parser.add_argument('--latency', help='Seconds of delay of every answer', type=float, default=0.)
+    parser.add_argument('--jitter', help='Maximum random seconds added to the delay', type=float, default=0.)
+    parser.add_argument('--error_rate', help='Fraction of requests failing with 503', type=float, default=0.)
+    parser.add_argument('--rate_limit', help='Requests per second allowed for every token',
+                        type=int, default=None)
+    parser.add_argument('--token_ttl', help='Seconds of validity of the tokens', type=int, default=86400)
+    parser.add_argument('--check_tokens', help='Refuse the tokens not issued by this server',
+                        action='store_true')
+    parser.add_argument('--seed', help='Seed of the synthetic data and of the random errors',
+                        type=int, default=0)
+    args = parser.parse_args()
+
+    server = LocalServer((args.host, args.port), args.num_stations, args.fixtures, args.latency,
+                         args.jitter, args.error_rate, args.rate_limit, args.token_ttl,
+                         args.check_tokens, args.seed)
+    print('Serving on %s (export MNW_API_URL=%s)' % (server.url, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,34 @@
+# Save real api answers in fixtures/ to be used by run_benchmarks.py
+import argparse
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from api import MNWApi
+
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def record(mnw, endpoint, params, filename):
+    '''Save the raw answer of endpoint, requested with the bulk token as
+    MNWApi does for all the endpoints of many stations'''
+    response = mnw.authorized_request("GET", "%s/%s" % (mnw.api_url, endpoint), bulk=True, params=params)
+    response.raise_for_status()
+    with open(os.path.join(FIXTURES_PATH, filename), 'wb') as f:
+        f.write(response.content)
+    print('Saved %s (%d bytes)' % (filename, len(response.content)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--date', help='Day of the daily answers, with format YYYY-MM-DD',
+                        default=(datetime.now() - timedelta(1)).strftime('%Y-%m-%d'))
+    args = parser.parse_args()
+
+    os.makedirs(FIXTURES_PATH, exist_ok=True)
+    with MNWApi(cache=False) as mnw:
+        record(mnw, 'data-realtime', {'country': 'IT', 'data_quality': True}, 'realtime_italy.json')
+        record(mnw, 'data-realtime', {'data_quality': True}, 'realtime_europe.json')
+        record(mnw, 'data-daily', {'observation_date': args.date, 'country': 'IT', 'data_quality': True},
+               'daily_italy.json')
@@ -0,0 +1,310 @@
+# Time every stage of the processing, from parsing to the full products,
+# on synthetic station networks and recorded api answers
+import argparse
+import glob
+import importlib
+import io
+import json
+import os
+import platform
+import subprocess
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+sys.path.insert(0, ROOT)
+
+import matplotlib
+matplotlib.use('agg')
+import matplotlib.pyplot as plt
+import parsing
+import utils
+import synthetic
+
+# Scripts that must start without importing the api, numpy or matplotlib
+SCRIPTS = ['plot_live', 'plot_daily', 'live_daemon']
+LIVE_PRODUCTS = ['temperature', 'rain', 'humidity', 'gust', 'synoptic']
+DAILY_PRODUCTS = ['temperature_max', 'temperature_min', 'rain', 'gust']
+
+
+def measure(function, repeat=5):
+    '''Return the best wall time (s) and the peak memory (MB) of function()'''
+    best = float('inf')
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+    tracemalloc.stop()
+
+    return best, peak
+
+
+def measure_startup(args, repeat=5):
+    '''Return the best wall time (s) of running a new interpreter with args'''
+    best = float('inf')
+    for i in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+        best = min(best, time.perf_counter() - start)
+
+    return best, None
+
+
+def startup_commands():
+    '''Return the commands whose startup time is measured, by name'''
+    commands = {'python': ['-c', 'pass'], 'import utils': ['-c', 'import utils']}
+    for script in SCRIPTS:
+        commands['import %s' % script] = ['-c', 'import %s' % script]
+        commands['%s.py --help' % script] = ['%s.py' % script, '--help']
+
+    return commands
+
+
+def check_startup(results, max_startup=0.1):
+    '''Return the startup stages of the scripts taking more than max_startup
+    seconds besides the start of the interpreter itself'''
+    python = results.get('startup|python|0', {}).get('time')
+    if python is None:
+        return []
+    slow = []
+    for script in SCRIPTS:
+        for stage in ['import %s' % script, '%s.py --help' % script]:
+            result = results.get('startup|%s|0' % stage, {})
+            if 'time' in result and result['time'] - python > max_startup:
+                print('%s takes %.0f ms more than starting python, more than %.0f ms' % (
+                    stage, (result['time'] - python) * 1000, max_startup * 1000))
+                slow.append(stage)
+
+    return slow
+
+
+def empty_map(projection='italy'):
+    '''Figure with the map axes only, without any layer'''
+    import cartopy.crs as ccrs
+
+    fig = plt.figure(figsize=(12, 12))
+    ax = plt.axes(projection=ccrs.PlateCarree())
+    ax.set_extent(utils.map_extent(projection), ccrs.PlateCarree())
+    return fig, ax
+
+
+def draw_vals(data, projection='italy'):
+    fig, ax = empty_map(projection)
+    utils.add_vals_on_map(ax, projection, data['temperature'].values,
+                          data['longitude'].values, data['latitude'].values)
+    fig.canvas.draw()
+    plt.close(fig)
+
+
+def draw_barbs(u, v, data, projection='italy'):
+    fig, ax = empty_map(projection)
+    utils.add_barbs_on_map(ax, projection, u, v, data['longitude'].values, data['latitude'].values)
+    fig.canvas.draw()
+    plt.close(fig)
+
+
+def draw_map(projection='italy'):
+    fig, ax = empty_map(projection)
+    fig.canvas.draw()
+    plt.close(fig)
+
+
+def uncached_filter_values(var, lats, lons):
+    '''filter_values without reusing the station selection of the previous run'''
+    utils.selection_cache.clear()
+    shutil.rmtree(os.environ['MNW_SELECTION_DIR'], ignore_errors=True)
+    return utils.filter_values(var, lats, lons)
+
+
+def disk_cached_filter_values(var, lats, lons):
+    '''filter_values reading the station selection saved by a previous run'''
+    utils.selection_cache.clear()
+    return utils.filter_values(var, lats, lons)
+
+
+def stages(realtime_content, daily_content, products, output_dir, projection='italy'):
+    '''Return the stages to benchmark on an answer as {stage: function}'''
+    realtime = parsing.parse_records(realtime_content, 'data-realtime')
+    daily = parsing.parse_records(daily_content, 'data-daily') if daily_content else None
+    lats = realtime['latitude'].values
+    lons = realtime['longitude'].values
+    temperature = realtime['temperature'].values
+    u, v = utils.wind_components(realtime['wind_speed'].values, realtime['wind_direction'].values)
+
+    functions = {
+        'parse pd.read_json': lambda: pd.read_json(io.StringIO(realtime_content.decode())),
+        'parse parse_records': lambda: parsing.parse_records(realtime_content, 'data-realtime'),
+        'filter_values': lambda: uncached_filter_values(temperature, lats, lons),
+        'filter_values (disk)': lambda: disk_cached_filter_values(temperature, lats, lons),
+        'filter_values (cached)': lambda: utils.filter_values(temperature, lats, lons),
+        'filter_max_values': lambda: utils.filter_max_values(temperature, lats, lons),
+        'filter_min_values': lambda: utils.filter_min_values(temperature, lats, lons),
+        'wind_components': lambda: utils.wind_components(realtime['wind_speed'].values,
+                                                         realtime['wind_direction'].values),
+    }
+    if importlib.util.find_spec('cartopy') is not None:
+        functions.update({
+            'empty map': lambda: draw_map(projection),
+            'add_vals_on_map': lambda: draw_vals(realtime, projection),
+            'add_barbs_on_map': lambda: draw_barbs(u, v, realtime, projection),
+        })
+    if products:
+        import plot_live
+        import plot_daily
+
+        for plot_type in LIVE_PRODUCTS:
+            functions['plot_live %s' % plot_type] = (
+                lambda plot_type=plot_type: plot_live.plot_product(
+                    realtime, plot_type, os.path.join(output_dir, 'live_%s.png' % plot_type), projection))
+        if daily is not None:
+            for plot_type in DAILY_PRODUCTS:
+                functions['plot_daily %s' % plot_type] = (
+                    lambda plot_type=plot_type: plot_daily.plot_product(
+                        daily, plot_type, '2024-06-01',
+                        os.path.join(output_dir, 'daily_%s.png' % plot_type), projection))
+
+    return functions
+
+
+def answers(num_stations, fixtures=True):
+    '''Return the answers to benchmark as (name, realtime content, daily content, stations):
+    synthetic networks of num_stations stations and the recorded fixtures'''
+    for n in num_stations:
+        yield ('synthetic', synthetic.payload(synthetic.realtime_frame(n)),
+               synthetic.payload(synthetic.daily_frame(n)), n)
+    if not fixtures:
+        return
+    for filename in sorted(glob.glob(os.path.join(FIXTURES_PATH, 'realtime_*.json'))):
+        name = os.path.basename(filename)[9:-5]
+        with open(filename, 'rb') as f:
+            realtime_content = f.read()
+        daily_content = None
+        daily_filename = os.path.join(FIXTURES_PATH, 'daily_%s.json' % name)
+        if os.path.exists(daily_filename):
+            with open(daily_filename, 'rb') as f:
+                daily_content = f.read()
+        yield ('fixture %s' % name, realtime_content, daily_content,
+               len(parsing.loads(realtime_content)))
+
+
+def run(num_stations, products_max=10000, repeat=5, fixtures=True, startup=True):
+    '''Run all the benchmarks, returning {key: result}'''
+    results = {}
+    output_dir = tempfile.mkdtemp(prefix='mnw-bench-')
+    # Station selections saved by the benchmark do not mix with the real ones
+    os.environ['MNW_SELECTION_DIR'] = os.path.join(output_dir, 'selections')
+    print('%-18s %-28s %10s %10s %14s %10s' % ('answer', 'stage', 'stations', 'time [ms]',
+                                                'stations/s', 'peak [MB]'))
+
+    def report(answer, stage, stations, wall_time, peak, error=None):
+        key = '%s|%s|%d' % (answer, stage, stations)
+        if error is not None:
+            results[key] = {'error': error}
+            print('%-18s %-28s %10d %s' % (answer, stage, stations, error))
+            return
+        results[key] = {'time': wall_time, 'peak': peak,
+                        'throughput': stations / wall_time if stations else None}
+        print('%-18s %-28s %10d %10.1f %14s %10s' % (
+            answer, stage, stations, wall_time * 1000,
+            '%.0f' % (stations / wall_time) if stations else '-',
+            '%.1f' % peak if peak is not None else '-'))
+
+    if startup:
+        for stage, args in startup_commands().items():
+            report('startup', stage, 0, *measure_startup(args, repeat))
+
+    for name, realtime_content, daily_content, stations in answers(num_stations, fixtures):
+        projection = 'europe' if name.endswith('europe') else 'italy'
+        functions = stages(realtime_content, daily_content, stations <= products_max,
+                           output_dir, projection)
+        for stage, function in functions.items():
+            try:
+                report(name, stage, stations, *measure(function, repeat))
+            except Exception as e:
+                report(name, stage, stations, None, None, error='error: %s' % e)
+            plt.close('all')
+
+    return results
+
+
+def compare(results, baseline, tolerance=0.25):
+    '''Print the ratio between results and baseline for every stage in both
+    and return the stages slower (or using more memory) than baseline by
+    more than tolerance'''
+    regressions = []
+    print('\n%-70s %12s %12s %s' % ('stage', 'time ratio', 'peak ratio', ''))
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None or 'time' not in result or 'time' not in base:
+            continue
+        time_ratio = result['time'] / base['time']
+        peak_ratio = None
+        if result['peak'] is not None and base['peak']:
+            peak_ratio = result['peak'] / base['peak']
+        # Very short stages and small allocations are too noisy to be compared
+        slower = time_ratio > 1 + tolerance and result['time'] - base['time'] > 1e-3
+        bigger = (peak_ratio is not None and peak_ratio > 1 + tolerance and
+                  result['peak'] - base['peak'] > 1.)
+        status = 'REGRESSION' if slower or bigger else ''
+        if status:
+            regressions.append(key)
+        print('%-70s %12.2f %12s %s' % (key, time_ratio,
+                                        '%.2f' % peak_ratio if peak_ratio is not None else '-', status))
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num_stations', help='Number of stations of the synthetic networks',
+                        type=int, nargs='+', default=[1000, 10000, 50000, 200000])
+    parser.add_argument('-r', '--repeat', help='Number of runs of every stage, the best one is reported',
+                        type=int, default=5)
+    parser.add_argument('--products_max', help='Largest network on which the full products are rendered',
+                        type=int, default=10000)
+    parser.add_argument('--no_fixtures', help='Do not benchmark the recorded api answers in fixtures/',
+                        action='store_true')
+    parser.add_argument('--no_startup', help='Do not measure the import time of the scripts',
+                        action='store_true')
+    parser.add_argument('--max_startup', help='Seconds that importing the scripts or printing their --help '
+                        'may take besides starting python, exiting with an error if exceeded',
+                        type=float, default=0.1)
+    parser.add_argument('-o', '--output', help='Save the results to this json file', default=None)
+    parser.add_argument('-b', '--baseline', help='Compare the results with this json file, '
+                        'exiting with an error on regressions', default=None)
+    parser.add_argument('-t', '--tolerance', help='Relative slowdown tolerated before reporting a regression',
+                        type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = run(args.num_stations, args.products_max, args.repeat,
+                  not args.no_fixtures, not args.no_startup)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'date': datetime.now().isoformat(timespec='seconds'),
+                       'platform': platform.platform(), 'python': platform.python_version(),
+                       'numpy': np.__version__, 'pandas': pd.__version__,
+                       'matplotlib': matplotlib.__version__, 'results': results}, f, indent=1)
+
+    failed = False
+    if not args.no_startup and check_startup(results, args.max_startup):
+        failed = True
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('%d regressions with respect to %s' % (len(regressions), args.baseline))
+            failed = True
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,102 @@
+# Synthetic station networks and api answers for the benchmarks
+import numpy as np
+import pandas as pd
+
+DIRECTIONS = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE',
+              'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW', None]
+# Extents [lon_min, lon_max, lat_min, lat_max] and centres (lat, lon, weight) around
+# which the stations are clustered, roughly following where the network is denser
+DOMAINS = {
+    'italy': ([6, 19, 36, 48], [
+        (45.46, 9.19, 5), (45.07, 7.69, 3), (45.44, 12.32, 2), (45.41, 11.88, 2),
+        (44.49, 11.34, 3), (43.77, 11.26, 3), (44.41, 8.93, 2), (41.90, 12.50, 4),
+        (40.85, 14.27, 3), (41.12, 16.87, 2), (38.12, 13.36, 2), (37.50, 15.09, 2),
+        (39.22, 9.12, 1), (46.07, 11.12, 2), (46.50, 11.35, 1), (43.62, 13.52, 1)]),
+    'europe': ([-18, 40, 30, 70], [
+        (45.46, 9.19, 5), (41.90, 12.50, 3), (48.86, 2.35, 2), (50.85, 4.35, 1),
+        (52.52, 13.40, 1), (48.14, 11.58, 2), (47.37, 8.54, 2), (48.21, 16.37, 1),
+        (40.42, -3.70, 1), (41.39, 2.17, 1), (51.51, -0.13, 1), (46.05, 14.51, 1)]),
+}
+
+
+def clustered_stations(num_stations, domain='italy', clustered=0.7, spread=0.5, seed=0):
+    '''Return the positions (lats, lons) of num_stations stations inside domain:
+    a fraction clustered of them around the centres of the domain, with a
+    standard deviation of spread degrees, and the others uniformly spread'''
+    rng = np.random.default_rng(seed)
+    (lon_min, lon_max, lat_min, lat_max), centres = DOMAINS[domain]
+    centres = np.array(centres, dtype=float)
+
+    num_clustered = int(num_stations * clustered)
+    chosen = rng.choice(len(centres), num_clustered, p=centres[:, 2] / centres[:, 2].sum())
+    lats = np.concatenate([rng.normal(centres[chosen, 0], spread),
+                           rng.uniform(lat_min, lat_max, num_stations - num_clustered)])
+    lons = np.concatenate([rng.normal(centres[chosen, 1], spread),
+                           rng.uniform(lon_min, lon_max, num_stations - num_clustered)])
+
+    return np.clip(lats, lat_min, lat_max).round(5), np.clip(lons, lon_min, lon_max).round(5)
+
+
+def station_fields(num_stations, domain='italy', seed=0):
+    '''Metadata of the synthetic stations, as returned by the api'''
+    lats, lons = clustered_stations(num_stations, domain, seed=seed)
+    codes = np.array(['st%06d' % i for i in range(num_stations)], dtype=object)
+
+    return {
+        'station_code': codes,
+        'place': np.char.add('Place ', np.arange(num_stations).astype(str)).astype(object),
+        'latitude': lats,
+        'longitude': lons,
+        'country': np.full(num_stations, 'IT' if domain == 'italy' else 'EU', dtype=object),
+        'region_name': np.char.add('Region ', (np.arange(num_stations) % 20).astype(str)).astype(object),
+    }
+
+
+def realtime_frame(num_stations, domain='italy', seed=0):
+    '''Synthetic data-realtime answer as a DataFrame of records'''
+    rng = np.random.default_rng(seed + 1)
+    fields = station_fields(num_stations, domain, seed)
+    minutes = np.char.zfill((np.arange(num_stations) % 60).astype(str), 2)
+    rain = rng.exponential(2, num_stations).round(1).astype(object)
+    rain[rng.random(num_stations) < 0.1] = None
+    fields.update({
+        'observation_time_local': np.char.add(np.char.add('2024-06-01 12:', minutes), ':00').astype(object),
+        'observation_time_utc': np.char.add(np.char.add('2024-06-01 10:', minutes), ':00').astype(object),
+        'temperature': (30 - 0.8 * (fields['latitude'] - 36) + rng.normal(0, 2, num_stations)).round(1),
+        'smlp': rng.normal(1013, 8, num_stations).round(1),
+        'rh': rng.integers(10, 100, num_stations),
+        'dew_point': rng.normal(10, 4, num_stations).round(1),
+        'wind_speed': rng.gamma(2, 5, num_stations).round(1),
+        'wind_direction': np.array(DIRECTIONS, dtype=object)[rng.integers(len(DIRECTIONS), size=num_stations)],
+        'wind_gust': rng.gamma(2, 10, num_stations).round(1),
+        'daily_rain': rain,
+        'rain_rate': np.zeros(num_stations),
+    })
+
+    return pd.DataFrame(fields)
+
+
+def daily_frame(num_stations, domain='italy', seed=0):
+    '''Synthetic data-daily answer as a DataFrame of records'''
+    rng = np.random.default_rng(seed + 2)
+    fields = station_fields(num_stations, domain, seed)
+    t_mean = 25 - 0.8 * (fields['latitude'] - 36) + rng.normal(0, 2, num_stations)
+    rain = rng.exponential(5, num_stations).round(1).astype(object)
+    rain[rng.random(num_stations) < 0.1] = None
+    fields.update({
+        'observation_date': np.full(num_stations, '2024-06-01', dtype=object),
+        't_max': (t_mean + rng.uniform(3, 8, num_stations)).round(1),
+        't_min': (t_mean - rng.uniform(3, 8, num_stations)).round(1),
+        't_med': t_mean.round(1),
+        'rh_max': rng.integers(50, 100, num_stations),
+        'rh_min': rng.integers(10, 50, num_stations),
+        'rain': rain,
+        'w_max': rng.gamma(2, 12, num_stations).round(1),
+    })
+
+    return pd.DataFrame(fields)
+
+
+def payload(frame):
+    '''Encode the records of frame as the api does'''
+    return frame.to_json(orient='records', double_precision=5).encode()
@@ -10,18 +10,28 @@ echo "----------------------------------------------------------------"
 export QT_QPA_PLATFORM=offscreen
 export DISPLAY=localhost:0
 
-python plot_live.py -t temperature -f temperature_live.png 
-python plot_live.py -t humidity -f umidita_live.png
-python plot_live.py -t rain -f pioggia_live.png
-python plot_live.py -t sat -f sat_live.png
-python plot_live.py -t sat -p europe -f sat_live_europe.png
-
-
-ncftpput -R -v altervista meteoindiretta temperature_live.png
-ncftpput -R -v altervista meteoindiretta umidita_live.png
-ncftpput -R -v altervista meteoindiretta pioggia_live.png
-ncftpput -R -v altervista meteoindiretta sat_live.png
-ncftpput -R -v altervista meteoindiretta sat_live_europe.png
+# All products are rendered in a single process so that data is downloaded
+# only once per projection. Every image is uploaded as soon as it is ready,
+# reusing the FTP sessions, and only if it changed since the last upload.
+# The server is defined by MNW_FTP_USER and MNW_FTP_HOST, the password by MNW_FTP_PASSWORD,
+# which cron does not set: they are read from ~/.config/meteonetwork/ftp.env (or the
+# file in MNW_FTP_CONFIG) and the run stops if they are still missing.
+MNW_FTP_CONFIG="${MNW_FTP_CONFIG:-$HOME/.config/meteonetwork/ftp.env}"
+if [ -f "$MNW_FTP_CONFIG" ]; then
+    set -a
+    . "$MNW_FTP_CONFIG"
+    set +a
+fi
+: "${MNW_FTP_USER:?MNW_FTP_USER is not set, define it in $MNW_FTP_CONFIG}"
+: "${MNW_FTP_HOST:?MNW_FTP_HOST is not set, define it in $MNW_FTP_CONFIG}"
+: "${MNW_FTP_PASSWORD:?MNW_FTP_PASSWORD is not set, define it in $MNW_FTP_CONFIG}"
+
+python plot_live.py -b temperature:italy:temperature_live.png \
+                       humidity:italy:umidita_live.png \
+                       rain:italy:pioggia_live.png \
+                       sat:italy:sat_live.png \
+                       sat:europe:sat_live_europe.png \
+                    --publish "ftp://${MNW_FTP_USER}@${MNW_FTP_HOST}/meteoindiretta"
 
 echo "---------------------------------------------------------------"
 echo "meteonetwork: Finished script - `date`"
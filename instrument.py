@@ -0,0 +1,181 @@
+# Optional timing of the processing stages, enabled with MNW_INSTRUMENT=1
+import atexit
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is not reported there
+    resource = None
+
+# Last completed stages, in order of completion, and totals of all of them
+records = deque(maxlen=10000)
+totals = {}
+enabled = False
+_local = threading.local()
+_lock = threading.Lock()
+_settings = {'log': True, 'report': None, 'prometheus': None}
+
+
+def peak_rss():
+    '''Peak resident memory of the process in MB'''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return rss / 1024 ** 2 if sys.platform == 'darwin' else rss / 1024
+
+
+class Stage():
+    def __init__(self, name, **fields):
+        '''Time the code inside a with block as the stage name. Fields, like the
+        number of stations or of bytes transferred, can be given here or added
+        while running with add.'''
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        if not enabled:
+            return self
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not enabled or not hasattr(self, 'start'):
+            return
+        seconds = time.perf_counter() - self.start
+        _local.stack.pop()
+        record = {'stage': self.name, 'parent': self.parent, 'seconds': round(seconds, 6),
+                  'peak_rss_mb': peak_rss(), 'time': round(time.time(), 3)}
+        record.update(self.fields)
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        records.append(record)
+        with _lock:
+            entry = totals.setdefault(self.name, {'calls': 0, 'seconds': 0., 'max_seconds': 0.})
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+            for key in ('bytes', 'stations'):
+                if key in record:
+                    entry[key] = entry.get(key, 0) + record[key]
+        if _settings['log']:
+            print(json.dumps(record), file=sys.stderr)
+
+    def add(self, **fields):
+        '''Add to the fields of the stage, summing numbers'''
+        for key, value in fields.items():
+            if isinstance(value, (int, float)) and key in self.fields:
+                self.fields[key] += value
+            else:
+                self.fields[key] = value
+
+
+def stage(name=None):
+    '''Decorator timing every call of a function as the stage name
+    (the function name by default). When disabled it only costs a flag check.'''
+    def decorator(function):
+        stage_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with Stage(stage_name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add(**fields):
+    '''Add fields (e.g. stations=len(data), bytes=len(content)) to the stage running
+    in the current thread, if any'''
+    if not enabled:
+        return
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        stack[-1].add(**fields)
+
+
+def summary():
+    '''Return, for every stage, the number of calls, the total and maximum time
+    and the sum of bytes and stations'''
+    with _lock:
+        return {name: dict(entry) for name, entry in totals.items()}
+
+
+def write_atomic(path, content):
+    '''Replace the file at path with content at once, as the textfile
+    collector of the Prometheus node exporter requires'''
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def write_report(path):
+    '''Save all the stages and their summary as json'''
+    write_atomic(path, json.dumps({'argv': sys.argv, 'peak_rss_mb': peak_rss(),
+                                   'summary': summary(), 'stages': list(records)}, indent=1))
+
+
+def write_prometheus(path, job=None):
+    '''Save the summary in the Prometheus text format'''
+    job = job or os.path.basename(sys.argv[0]) or 'python'
+    lines = []
+    metrics = [('mnw_stage_seconds_total', 'counter', 'Time spent in the stage', 'seconds'),
+               ('mnw_stage_max_seconds', 'gauge', 'Longest call of the stage', 'max_seconds'),
+               ('mnw_stage_calls_total', 'counter', 'Calls of the stage', 'calls'),
+               ('mnw_stage_bytes_total', 'counter', 'Bytes transferred in the stage', 'bytes'),
+               ('mnw_stage_stations_total', 'counter', 'Stations processed in the stage', 'stations')]
+    stages = summary()
+    for metric, kind, description, key in metrics:
+        lines += ['# HELP %s %s' % (metric, description), '# TYPE %s %s' % (metric, kind)]
+        for name, entry in sorted(stages.items()):
+            if key in entry:
+                lines.append('%s{job="%s",stage="%s"} %s' % (metric, job, name, entry[key]))
+    lines += ['# HELP mnw_peak_rss_megabytes Peak resident memory of the run',
+              '# TYPE mnw_peak_rss_megabytes gauge',
+              'mnw_peak_rss_megabytes{job="%s"} %s' % (job, peak_rss()),
+              '# HELP mnw_last_run_timestamp_seconds End of the run',
+              '# TYPE mnw_last_run_timestamp_seconds gauge',
+              'mnw_last_run_timestamp_seconds{job="%s"} %.3f' % (job, time.time())]
+    write_atomic(path, '\n'.join(lines) + '\n')
+
+
+def write_outputs():
+    '''Write the report and the Prometheus file, if requested'''
+    if _settings['report']:
+        write_report(_settings['report'])
+    if _settings['prometheus']:
+        write_prometheus(_settings['prometheus'])
+
+
+def enable(log=True, report=None, prometheus=None):
+    '''Start recording the stages. Every stage is printed as a json line on stderr
+    if log is True; at exit the json report and the Prometheus textfile are
+    saved if their paths are given.'''
+    global enabled
+    if not enabled:
+        atexit.register(write_outputs)
+    enabled = True
+    _settings.update(log=log, report=report, prometheus=prometheus)
+
+
+if os.environ.get('MNW_INSTRUMENT', '0') not in ('', '0'):
+    enable(log=os.environ.get('MNW_INSTRUMENT_LOG', '1') != '0',
+           report=os.environ.get('MNW_INSTRUMENT_REPORT'),
+           prometheus=os.environ.get('MNW_INSTRUMENT_PROMETHEUS'))
@@ -0,0 +1,127 @@
+# Interpolation of the station values on regular grids
+import hashlib
+from collections import OrderedDict
+import numpy as np
+from stations import StationIndex
+
+# Recently computed weights, see get_weights
+weights_cache = OrderedDict()
+WEIGHTS_CACHE_SIZE = 8
+
+
+def regular_grid(extent, resolution=0.1):
+    '''Return the longitudes and latitudes of a regular grid covering
+    extent [lon_min, lon_max, lat_min, lat_max] with step resolution (degrees)'''
+    lon_min, lon_max, lat_min, lat_max = extent
+    grid_lons = np.arange(lon_min, lon_max + resolution / 2, resolution)
+    grid_lats = np.arange(lat_min, lat_max + resolution / 2, resolution)
+
+    return grid_lons, grid_lats
+
+
+class InterpolationWeights():
+    def __init__(self, index, extent, resolution=0.1, k=8, method='idw', power=2,
+                 smoothing=30., max_distance=100., chunk_size=65536):
+        '''Weights interpolating the values of the stations in index (a StationIndex)
+        on the regular grid covering extent with step resolution (degrees).
+        Every grid point uses its k nearest stations within max_distance km with
+        - method='idw': weights 1 / distance ** power
+        - method='barnes': weights exp(-(distance / smoothing) ** 2)
+        Points without stations within max_distance are NaN.
+        The weights are computed once, chunk_size grid points at a time, and stored as
+        indices and weights (grid points x k), i.e. the rows of a sparse matrix, so
+        that interpolating any variable of the same stations is a matrix-vector product.'''
+        if method not in ('idw', 'barnes'):
+            raise ValueError('Unknown interpolation method %s' % method)
+        self.index = index
+        self.grid_lons, self.grid_lats = regular_grid(extent, resolution)
+        self.shape = (len(self.grid_lats), len(self.grid_lons))
+        self.chunk_size = chunk_size
+
+        lons, lats = np.meshgrid(self.grid_lons, self.grid_lats)
+        lons, lats = lons.ravel(), lats.ravel()
+        k = min(k, len(index.xyz))
+        self.indices = np.zeros((lons.size, k), dtype=np.int32)
+        self.weights = np.zeros((lons.size, k), dtype=np.float32)
+        if k == 0:
+            return
+        if index.tree is None:
+            # The brute force search needs grid points x stations distances
+            chunk_size = max(1, chunk_size // len(index.xyz))
+        for start in range(0, lons.size, chunk_size):
+            chunk = slice(start, start + chunk_size)
+            indices, distances = index.nearest(lats[chunk], lons[chunk], k)
+            if method == 'idw':
+                # Stations on a grid point get a huge but finite weight
+                weights = np.maximum(distances, 1e-3) ** -power
+            else:
+                weights = np.exp(-(distances / smoothing) ** 2)
+            if max_distance is not None:
+                weights[distances > max_distance] = 0.
+            self.indices[chunk] = indices
+            self.weights[chunk] = weights
+
+    def apply(self, values):
+        '''Interpolate values, one for every station of the index (in the order of
+        index.meta). Missing values (NaN) are ignored by renormalising the weights
+        of the other stations. Returns an array with shape (latitudes, longitudes).'''
+        values = np.asarray(values, dtype=np.float32)
+        grid = np.empty(len(self.indices), dtype=np.float32)
+        for start in range(0, len(self.indices), self.chunk_size):
+            chunk = slice(start, start + self.chunk_size)
+            neighbours = values[self.indices[chunk]]
+            valid = np.isfinite(neighbours)
+            weights = np.where(valid, self.weights[chunk], 0.)
+            total = weights.sum(axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                grid[chunk] = (weights * np.where(valid, neighbours, 0.)).sum(axis=1) / total
+            grid[chunk][total == 0] = np.nan
+
+        return grid.reshape(self.shape)
+
+    def station_values(self, data, column):
+        '''Return the values of column in data (e.g. from get_realtime_stations)
+        in the order of the stations of the index, matched by station_code.
+        Stations missing from data are NaN.'''
+        values = data[column].set_axis(data['station_code'].astype(str))
+        values = values[~values.index.duplicated()]
+
+        return values.reindex(self.index.meta['station_code'].astype(str)).to_numpy(dtype=float)
+
+    def interpolate(self, data, column):
+        '''Interpolate column of data on the grid'''
+        return self.apply(self.station_values(data, column))
+
+
+def get_weights(data, extent, resolution=0.1, **kwargs):
+    '''Return the InterpolationWeights of the stations of data (a DataFrame with
+    station_code, latitude and longitude, or a StationIndex) on the grid.
+    Weights are cached by station positions and grid, so that every variable
+    and every snapshot with the same stations reuses them.'''
+    index = data if isinstance(data, StationIndex) else None
+    if index is None:
+        data = data.drop_duplicates('station_code')
+        positions = data[['latitude', 'longitude']].to_numpy(dtype=float)
+    else:
+        positions = np.column_stack([index.lats, index.lons])
+    key = hashlib.sha1(np.ascontiguousarray(positions).tobytes())
+    key.update(repr((list(extent), resolution, sorted(kwargs.items()))).encode())
+    key = key.hexdigest()
+
+    if key in weights_cache:
+        weights_cache.move_to_end(key)
+    else:
+        weights_cache[key] = InterpolationWeights(index or StationIndex(data), extent,
+                                                  resolution, **kwargs)
+        if len(weights_cache) > WEIGHTS_CACHE_SIZE:
+            weights_cache.popitem(last=False)
+
+    return weights_cache[key]
+
+
+def interpolate(data, column, extent, resolution=0.1, **kwargs):
+    '''Interpolate column of data (e.g. from get_realtime_stations) on a regular grid
+    covering extent. Returns the grid longitudes, latitudes and values.'''
+    weights = get_weights(data, extent, resolution, **kwargs)
+
+    return weights.grid_lons, weights.grid_lats, weights.interpolate(data, column)
@@ -0,0 +1,89 @@
+# Artist drawing all the station values of a map at once
+import numpy as np
+from matplotlib.artist import Artist
+from matplotlib.colors import to_rgba, to_rgba_array
+from matplotlib.font_manager import FontProperties
+from matplotlib.textpath import TextPath
+from matplotlib.transforms import Affine2D, Bbox, IdentityTransform
+import instrument
+
+
+class StationLabels(Artist):
+    zorder = 3
+
+    def __init__(self, xy, labels, colors='white', fontsize=12, weight='bold',
+                 stroke_width=1, stroke_color='black', transform=None):
+        '''Draw the strings labels at the positions xy (N x 2, in the coordinates
+        of transform) with colors given as one color or one color per label,
+        surrounded by a stroke like patheffects.withStroke.
+        The outline of every distinct string is computed only once and all the
+        labels are then drawn by the renderer in a single call, which is much
+        cheaper than creating an annotation for every station.'''
+        super().__init__()
+        self.prop = FontProperties(size=fontsize, weight=weight)
+        self.stroke_width = stroke_width
+        self.stroke_color = to_rgba(stroke_color)
+        self._paths = {}
+        if transform is not None:
+            self.set_transform(transform)
+        # Labels may go a bit outside of the map, as annotations did
+        self.set_clip_on(False)
+        self.set_data(xy, labels, colors)
+
+    def set_data(self, xy, labels, colors=None):
+        '''Replace the labels, e.g. to draw a new frame of an animation'''
+        self.xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+        self.labels = [str(label) for label in labels]
+        if colors is not None:
+            self.colors = to_rgba_array(colors)
+        self.stale = True
+
+    def text_path(self, label):
+        '''Outline of a string in points, with the origin on the left of the baseline'''
+        if label not in self._paths:
+            self._paths[label] = TextPath((0, 0), label, prop=self.prop)
+        return self._paths[label]
+
+    @instrument.stage('draw_labels')
+    def draw(self, renderer):
+        if not self.get_visible() or not self.labels:
+            return
+        instrument.add(stations=len(self.labels))
+        renderer.open_group('stationlabels', gid=self.get_gid())
+        offsets = self.get_transform().transform(self.xy)
+        # Every label is drawn twice in a row, first with the stroke (filled as
+        # well) and then with the fill only, so that overlapping labels hide
+        # each other as separate texts would do
+        paths = [self.text_path(label) for label in self.labels for i in range(2)]
+        offsets = np.repeat(offsets, 2, axis=0)
+        colors = self.colors
+        if len(colors) > 1:
+            colors = np.repeat(colors, 2, axis=0)
+        edgecolors = np.array([self.stroke_color, (0., 0., 0., 0.)])
+        linewidths = np.array([self.stroke_width, 0.])
+        # Paths are in points, scale them to pixels
+        master_transform = Affine2D().scale(renderer.points_to_pixels(1.))
+        gc = renderer.new_gc()
+        self._set_gc_clip(gc)
+        gc.set_alpha(self.get_alpha())
+        renderer.draw_path_collection(gc, master_transform, paths, np.zeros((0, 3, 3)), offsets,
+                                      IdentityTransform(), colors, edgecolors, linewidths,
+                                      [(0, None)], [True], [None], 'screen')
+        gc.restore()
+        renderer.close_group('stationlabels')
+        self.stale = False
+
+    def get_window_extent(self, renderer=None):
+        '''Extent of the labels in display coordinates'''
+        if not self.labels:
+            return Bbox.null()
+        if renderer is None:
+            renderer = self.figure._get_renderer()
+        scale = renderer.points_to_pixels(1.)
+        offsets = self.get_transform().transform(self.xy)
+        size = Bbox.union([self.text_path(label).get_extents()
+                           for label in set(self.labels)])
+        return Bbox.from_extents(offsets[:, 0].min() + size.x0 * scale,
+                                 offsets[:, 1].min() + size.y0 * scale,
+                                 offsets[:, 0].max() + size.x1 * scale,
+                                 offsets[:, 1].max() + size.y1 * scale)
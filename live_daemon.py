@@ -0,0 +1,143 @@
+# Resident service rendering the live maps only when their data changes
+import argparse
+import hashlib
+import signal
+import time
+import instrument
+import plot_live
+
+# Columns of the realtime data used by every product, besides the station positions
+# and the observation time which are used by all of them
+PRODUCT_COLUMNS = {
+    'temperature': ['temperature'],
+    'sat': ['temperature'],
+    'rain': ['daily_rain'],
+    'humidity': ['rh'],
+    'gust': ['wind_gust', 'wind_speed', 'wind_direction'],
+    'synoptic': ['wind_speed', 'wind_direction', 'smlp'],
+}
+COMMON_COLUMNS = ['station_code', 'latitude', 'longitude', 'observation_time_local']
+
+
+def product_signature(data, plot_type):
+    '''Return a hash of the data used by a product, and the hash of every station
+    (indexed by station code) to count how many of them changed'''
+    import pandas as pd
+
+    columns = [c for c in COMMON_COLUMNS + PRODUCT_COLUMNS.get(plot_type, []) if c in data]
+    rows = pd.util.hash_pandas_object(data[columns], index=False)
+    signature = hashlib.sha1(rows.values.tobytes())
+    if plot_type == 'sat':
+        # The satellite image changes on its own
+        import satellite
+
+        signature.update(satellite.imagery_slot().isoformat().encode())
+    if 'station_code' in data:
+        rows.index = data['station_code'].astype(str).values
+
+    return signature.hexdigest(), rows
+
+
+class LiveDaemon():
+    def __init__(self, jobs, interval=300, callback=None, publisher=None, keep_figures=True):
+        '''Render the live products in jobs, a list of (plot_type, projection, plot_filename),
+        every interval seconds but only when the data they use has changed since their
+        last rendering. callback, if given, is called with the job after every rendering
+        (e.g. to publish the new image). publisher, if given, is a publish.Publisher
+        uploading every new image while the others are rendered. With keep_figures the
+        maps are created once and reused by every rendering (see plot_live.map_figure).'''
+        self.jobs = jobs
+        self.keep_figures = keep_figures
+        self.interval = interval
+        self.callback = callback
+        self.publisher = publisher
+        self.signatures = {}
+        self.stations = {}
+        self.running = False
+
+    def run_once(self):
+        '''Download the data and render the products whose data changed.
+        Returns the list of jobs that were rendered.'''
+        import output
+
+        plot_live.keep_figures = self.keep_figures
+        datasets = {}
+        flags = {}
+        rendered = []
+        for job in self.jobs:
+            plot_type, projection, plot_filename = job
+            try:
+                key = plot_live.dataset_key(projection)
+                if key not in datasets:
+                    data = plot_live.fetch_data(projection)
+                    flags[key] = plot_live.check_data(key, data)
+                    datasets[key] = data
+                data = datasets[key]
+                signature, stations = product_signature(data, plot_type)
+                if self.signatures.get(job) == signature:
+                    continue
+                if job in self.stations:
+                    changed = (~stations.isin(self.stations[job].values)).sum()
+                    print('%s: %d stations changed' % (plot_filename, changed))
+                plot_live.plot_product(data, plot_type, plot_filename, projection, flags=flags[key])
+                self.signatures[job] = signature
+                self.stations[job] = stations
+                rendered.append(job)
+                if self.callback:
+                    self.callback(job)
+                if self.publisher:
+                    for filename in output.output_filenames(plot_filename):
+                        self.publisher.publish(filename)
+            except Exception as e:
+                print('Error in producing %s (%s, %s): %s' % (plot_filename, plot_type, projection, e))
+                plot_live.discard_figure()
+
+        return rendered
+
+    def run(self):
+        '''Poll and render until stopped with SIGTERM or SIGINT'''
+        import matplotlib
+        matplotlib.use("agg")
+
+        self.running = True
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        while self.running:
+            start = time.monotonic()
+            rendered = self.run_once()
+            if self.publisher:
+                self.publisher.wait()
+            print('%s: rendered %d of %d products' % (time.strftime('%Y-%m-%d %H:%M:%S'),
+                                                      len(rendered), len(self.jobs)))
+            if instrument.enabled:
+                instrument.write_outputs()
+            # Wait for the next poll, waking up regularly to check for stop requests
+            while self.running and time.monotonic() - start < self.interval:
+                time.sleep(min(1., self.interval - (time.monotonic() - start)))
+
+    def stop(self, *args):
+        '''Stop after the current poll'''
+        self.running = False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('jobs', help='Products to render, each given as plot_type:projection:filename '
+                        '(e.g. temperature:italy:temperature_live.png)', nargs='+')
+    parser.add_argument('-i', '--interval', help='Seconds between two polls of the realtime data',
+                        required=False, type=float, default=300)
+    parser.add_argument('--publish', help='Upload every product as soon as it is rendered, unless unchanged, '
+                        'to a local directory or ftp://user@host/directory (password in MNW_FTP_PASSWORD)',
+                        required=False, default=None)
+
+    args = parser.parse_args()
+
+    publisher = None
+    if args.publish:
+        import publish
+        publisher = publish.Publisher(publish.get_transport(args.publish))
+
+    LiveDaemon([plot_live.parse_job(job) for job in args.jobs], interval=args.interval,
+               publisher=publisher).run()
+    if publisher:
+        publisher.close()
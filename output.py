@@ -0,0 +1,141 @@
+# Encoding of the rendered maps in one or more image formats
+import importlib
+import os
+from functools import lru_cache
+import numpy as np
+import instrument
+
+# Formats that can be encoded from the rendered pixels, by extension
+FORMATS = {'png': 'PNG', 'webp': 'WEBP', 'avif': 'AVIF'}
+
+
+@lru_cache(maxsize=None)
+def has_pillow():
+    '''Whether Pillow is installed, checked only once'''
+    return importlib.util.find_spec('PIL') is not None
+
+
+def output_formats():
+    '''Formats saved besides the one of the file name, from MNW_OUTPUT_FORMATS
+    (e.g. "png,webp")'''
+    return [f.strip().lower() for f in os.environ.get('MNW_OUTPUT_FORMATS', '').split(',') if f.strip()]
+
+
+def output_filenames(plot_filename, formats=None):
+    '''Return all the files written by save_figure for plot_filename'''
+    root, extension = os.path.splitext(plot_filename)
+    filenames = [plot_filename]
+    for extension_format in formats if formats is not None else output_formats():
+        filename = '%s.%s' % (root, extension_format)
+        if filename not in filenames:
+            filenames.append(filename)
+    return filenames
+
+
+def tight_crop(fig, renderer, pad_inches=0.1):
+    '''Return the pixel rows and columns (top, bottom, left, right) of the canvas
+    containing all the artists, as bbox_inches='tight' would do, computed
+    from the last draw instead of drawing again. As in savefig, the area can
+    extend beyond the canvas: crop_pixels fills it with the figure background.'''
+    bbox = fig.get_tightbbox(renderer).padded(pad_inches)
+    height = int(renderer.height)
+    # savefig truncates the size of the tight canvas and shifts the figure to its corner
+    left = int(round(bbox.x0 * fig.dpi))
+    top = height - int(round(bbox.y0 * fig.dpi)) - int(bbox.height * fig.dpi)
+    return top, top + int(bbox.height * fig.dpi), left, left + int(bbox.width * fig.dpi)
+
+
+def crop_pixels(fig, pixels, crop):
+    '''Return the RGBA pixels of the canvas in crop (top, bottom, left, right),
+    padded with the background of fig where crop is beyond the canvas'''
+    top, bottom, left, right = crop
+    height, width = pixels.shape[:2]
+    if top >= 0 and left >= 0 and bottom <= height and right <= width:
+        return pixels[top:bottom, left:right]
+    from matplotlib.colors import to_rgba_array
+
+    cropped = np.empty((bottom - top, right - left, 4), dtype=np.uint8)
+    cropped[:] = np.round(to_rgba_array(fig.get_facecolor())[0] * 255).astype(np.uint8)
+    rows = slice(max(top, 0), min(bottom, height))
+    columns = slice(max(left, 0), min(right, width))
+    cropped[rows.start - top:rows.stop - top, columns.start - left:columns.stop - left] = pixels[rows, columns]
+    return cropped
+
+
+def encode(image, filename, image_format, level=6, palette=False, quality=90):
+    '''Save a PIL image with a compression level from 0 (fastest) to 9 (smallest)'''
+    if palette and image_format == 'PNG':
+        # Maps have few colors: 256 are enough and take a quarter of the bytes
+        from PIL import Image
+        image = image.quantize(256, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+    if image_format == 'PNG':
+        options = {'compress_level': level, 'optimize': level >= 9}
+    elif image_format == 'WEBP':
+        options = {'quality': quality, 'method': int(round(level * 6 / 9))}
+    else:
+        # The slowest AVIF speeds take seconds on a map
+        options = {'quality': quality, 'speed': 10 - int(round(level * 4 / 9))}
+    tmp_filename = '%s.tmp%d' % (filename, os.getpid())
+    image.save(tmp_filename, format=image_format, **options)
+    os.replace(tmp_filename, filename)
+
+
+def savefig_all(fig, filenames, dpi, pad_inches):
+    '''Save fig in every file of filenames with savefig, drawing it every time'''
+    for filename in filenames:
+        fig.savefig(filename, dpi=dpi, bbox_inches='tight', pad_inches=pad_inches)
+    return filenames
+
+
+@instrument.stage('savefig')
+def save_figure(fig, plot_filename, dpi=100, formats=None, level=None, palette=None,
+                quality=90, pad_inches=0.1):
+    '''Save fig like savefig(plot_filename, dpi=dpi, bbox_inches='tight') but rendering
+    it only once: the tight area is cropped from the pixels of that single draw
+    and encoded by Pillow, also in the other formats (png, webp, avif) listed in
+    formats, by default those of MNW_OUTPUT_FORMATS, with the same file name.
+    - level is the compression level from 0 (fastest) to 9 (smallest), by default
+      MNW_OUTPUT_LEVEL or 6
+    - palette reduces PNG images to 256 colors, by default if MNW_OUTPUT_PALETTE=1
+    - quality is the quality of the lossy formats (webp, avif)
+    Other formats, a missing Pillow, or artists drawn beyond the edges of the
+    figure (cut from the single draw) fall back to savefig.
+    Returns the list of files written.'''
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    if level is None:
+        level = int(os.environ.get('MNW_OUTPUT_LEVEL', 6))
+    if palette is None:
+        palette = os.environ.get('MNW_OUTPUT_PALETTE', '0') not in ('', '0')
+    filenames = output_filenames(plot_filename, formats)
+    extensions = [os.path.splitext(f)[1][1:].lower() for f in filenames]
+
+    if (not has_pillow() or not isinstance(fig.canvas, FigureCanvasAgg) or
+            any(extension not in FORMATS for extension in extensions)):
+        return savefig_all(fig, filenames, dpi, pad_inches)
+
+    from PIL import Image
+
+    with instrument.Stage('draw'):
+        if fig.dpi != dpi:
+            fig.set_dpi(dpi)
+        fig.canvas.draw()
+        renderer = fig.canvas.get_renderer()
+        pixels = np.asarray(fig.canvas.buffer_rgba())
+        top, bottom, left, right = crop = tight_crop(fig, renderer, pad_inches)
+        # Only the padding can be beyond the canvas, within a pixel of rounding
+        pad = int(np.ceil(pad_inches * dpi)) + 1
+        if min(top, left) < -pad or bottom > pixels.shape[0] + pad or right > pixels.shape[1] + pad:
+            return savefig_all(fig, filenames, dpi, pad_inches)
+        pixels = crop_pixels(fig, pixels, crop)
+
+    with instrument.Stage('encode') as stage:
+        image = Image.fromarray(pixels, 'RGBA')
+        if pixels[..., 3].min() == 255:
+            # Opaque, as the maps are: the alpha channel only takes space
+            image = image.convert('RGB')
+        for filename, extension in zip(filenames, extensions):
+            encode(image, filename, FORMATS[extension], level, palette, quality)
+        stage.add(bytes=sum(os.path.getsize(f) for f in filenames))
+
+    return filenames
@@ -0,0 +1,71 @@
+# Fast parsing of the meteonetwork api answers into typed DataFrames
+import importlib
+import numpy as np
+import pandas as pd
+
+if importlib.util.find_spec("orjson") is not None:
+    from orjson import loads
+else:
+    from json import loads
+
+# Types of the columns returned by every endpoint. Measurements are kept as float32,
+# coordinates as float64, codes and names that repeat a lot as categories.
+# Columns not listed here are returned with the type inferred by pandas.
+MEASUREMENTS = ['temperature', 'rh', 'dew_point', 'smlp', 'mslp', 'wind_speed', 'wind_gust',
+                'daily_rain', 'rain_rate', 'solar_radiation', 'uv', 'altitude',
+                't_min', 't_med', 't_max', 'rh_min', 'rh_med', 'rh_max',
+                'w_med', 'w_max', 'rain', 'mslp_min', 'mslp_med', 'mslp_max']
+CATEGORIES = ['station_code', 'wind_direction', 'country', 'region', 'region_name', 'area']
+
+SCHEMA = {'latitude': 'float64', 'longitude': 'float64',
+          'observation_time_local': 'datetime', 'observation_time_utc': 'datetime',
+          'observation_date': 'datetime'}
+SCHEMA.update({column: 'float32' for column in MEASUREMENTS})
+SCHEMA.update({column: 'category' for column in CATEGORIES})
+
+SCHEMAS = {
+    'data-realtime': SCHEMA,
+    'data-daily': SCHEMA,
+    'data-archive': SCHEMA,
+    'stations': SCHEMA,
+}
+
+
+def convert_column(values, dtype):
+    '''Convert a list of values decoded from json to an array of type dtype'''
+    if dtype in ('float32', 'float64'):
+        try:
+            return np.array([np.nan if v is None else v for v in values], dtype=dtype)
+        except (TypeError, ValueError):
+            # Some values are empty or non numeric strings
+            return pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').to_numpy(dtype=dtype)
+    elif dtype == 'category':
+        return pd.Categorical(values)
+    elif dtype == 'datetime':
+        return pd.to_datetime(pd.Series(values, dtype=object), errors='coerce', format='ISO8601')
+    else:
+        return pd.Series(values).infer_objects()
+
+
+def parse_records(content, endpoint, columns=None):
+    '''Parse the raw content (bytes) of an api answer into a DataFrame, using the
+    types declared in SCHEMAS for endpoint (e.g. data-realtime or data-daily/<station>).
+    If columns is given only those columns are created.'''
+    records = loads(content)
+    if isinstance(records, dict):
+        records = [records]
+    if not records:
+        return pd.DataFrame(columns=columns)
+
+    if columns is None:
+        # Keep the order of the answer, adding keys that only some records have
+        columns = list(records[0])
+        columns += sorted(set().union(*records).difference(columns))
+    schema = SCHEMAS.get(endpoint.split('/')[0], {})
+
+    data = {}
+    for column in columns:
+        values = [record.get(column) for record in records]
+        data[column] = convert_column(values, schema.get(column))
+
+    return pd.DataFrame(data, copy=False)
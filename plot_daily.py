@@ -1,21 +1,12 @@
-import utils
 from datetime import datetime, timedelta
 import argparse
-from api import MNWApi
+import sys
+import instrument
 
-mnw = MNWApi()
+# The api, numpy, matplotlib and the plotting utilities are imported by the
+# functions using them: importing this module, or printing --help, stays fast
+# and no connection is prepared before the first download (see api.get_api)
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-t','--plot_type', help='Type of the plot, can be temperature_max, temperature_min, rain or gust',
-                     required=False, default='temperature_max')
-parser.add_argument('-f','--plot_filename', help='Name of the output file',
-                     required=False, default='output.png')
-parser.add_argument('-p','--projection', help='Projection, at the moment only italy is supported',
-                     required=False, default='italy')
-parser.add_argument('-d','--date_download', help='Date to download with format YYYY-MM-DD',
-                     required=False, default=(datetime.now() - timedelta(1)).strftime(format='%Y-%m-%d'))
-
-args = parser.parse_args()
 
 def main(plot_type='temperature_max', date_download=(datetime.now() - timedelta(1)).strftime(format='%Y-%m-%d'),
          plot_filename='output.png', projection='italy'):
@@ -23,38 +14,97 @@ def main(plot_type='temperature_max', date_download=(datetime.now() - timedelta(
         import matplotlib
         matplotlib.use("agg")
 
-    data = mnw.get_daily_stations(observation_date=date_download, country='IT')
+    from api import get_api
+
+    data = get_api().get_daily_stations(observation_date=date_download, country='IT')
+    plot_product(data, plot_type, date_download, plot_filename, projection)
+
+
+def main_batch(jobs, date_download, workers=1, callback=None):
+    '''Render several products of the same day from a single download. jobs is a
+    list of (plot_type, projection, plot_filename) tuples. With workers > 1 the
+    products are rendered in parallel by that many processes (see render_pool).
+    A failure in one product does not stop the others. callback, if given,
+    is called with the job as soon as its product is ready.
+    Returns the list of jobs that failed.'''
+    import matplotlib
+    matplotlib.use("agg")
+    import matplotlib.pyplot as plt
+    from api import get_api
+
+    data = get_api().get_daily_stations(observation_date=date_download, country='IT')
+    if workers > 1:
+        import render_pool
+
+        jobs_by_filename = {job[2]: job for job in jobs}
+        errors = render_pool.render(
+            [('plot_daily', 'daily', (plot_type, date_download, plot_filename, projection), plot_filename)
+             for plot_type, projection, plot_filename in jobs],
+            {'daily': data}, max_workers=workers,
+            callback=(lambda plot_filename: callback(jobs_by_filename[plot_filename])) if callback else None)
+        failed_filenames = [plot_filename for plot_filename, e in errors]
+        return [job for job in jobs if job[2] in failed_filenames]
+
+    failed = []
+    for plot_type, projection, plot_filename in jobs:
+        try:
+            plot_product(data, plot_type, date_download, plot_filename, projection)
+            if callback:
+                callback((plot_type, projection, plot_filename))
+        except Exception as e:
+            print('Error in producing %s (%s, %s): %s' % (plot_filename, plot_type, projection, e))
+            # Not drawn over by the next product
+            plt.clf()
+            failed.append((plot_type, projection, plot_filename))
+
+    return failed
+
+
+@instrument.stage()
+def plot_product(data, plot_type='temperature_max', date_download=None,
+                 plot_filename='output.png', projection='italy', flags=None):
+    '''Compute the filtered fields for plot_type from the daily data and
+    render them on the map. Values failing the quality control are left out:
+    flags are the ones computed by qc.check on data, which is run here if not given.'''
+    import qc
+    import utils
+
+    if flags is None:
+        flags = qc.check(data)
 
     lats = data['latitude'].values
     lons = data['longitude'].values
 
     if plot_type == 'temperature_max':
-        temp_max = data['t_max'].values
-        temp_max_sparse = utils.filter_max_values(temp_max, lats, lons)
+        temp_max = qc.masked(data, flags, 't_max')
+        temp_max_sparse = utils.filter_max_values(temp_max, lats, lons, valid=qc.valid(flags, 't_max'))
         plot_temperature_max(projection, plot_type, temp_max_sparse, temp_max, lons, lats,
                              date_download, plot_filename)
     elif plot_type == 'temperature_min':
-        temp_min = data['t_min'].values
-        temp_min_sparse = utils.filter_min_values(temp_min, lats, lons)
+        temp_min = qc.masked(data, flags, 't_min')
+        temp_min_sparse = utils.filter_min_values(temp_min, lats, lons, valid=qc.valid(flags, 't_min'))
         plot_temperature_min(projection, plot_type, temp_min_sparse, temp_min, lons, lats,
                              date_download, plot_filename)
     elif plot_type == 'rain':
-        rain = data['rain'].values
-        rain_sparse = utils.filter_max_values(rain, lats, lons)
+        rain = qc.masked(data, flags, 'rain')
+        rain_sparse = utils.filter_max_values(rain, lats, lons, valid=qc.valid(flags, 'rain'))
         plot_rain(projection, rain_sparse, rain, lons,
                   lats, date_download, plot_filename)
     elif plot_type == 'gust':
-        gust = data['w_max'].values
-        gust_sparse = utils.filter_max_values(gust, lats, lons)
+        gust = qc.masked(data, flags, 'w_max')
+        gust_sparse = utils.filter_max_values(gust, lats, lons, valid=qc.valid(flags, 'w_max'))
         plot_gust(projection, gust_sparse, gust, lons,
                   lats, date_download, plot_filename)
     else:
-        print('Error, variable %s not found' % plot_type)
+        raise ValueError('Unknown plot_type %s' % plot_type)
 
 
+@instrument.stage()
 def plot_temperature_max(projection, plot_type, temp_sparse, temp,
                          lons, lats, date, plot_filename='output.png'):
     import matplotlib.pyplot as plt
+    import output
+    import utils
     '''Plot temperature on the map'''
     fig = plt.figure(1, figsize=(10, 10))
     ax = utils.get_projection(plt, projection, regions=False)
@@ -70,13 +120,16 @@ def plot_temperature_max(projection, plot_type, temp_sparse, temp,
         ax=plt.gca(), logo='meteonetwork_logo.png', zoom=0.3, pos=(0.15, 0.05))
     utils.add_hist_on_map(plt.gca(), temp, label='Temperatura [C]')
 
-    plt.savefig(plot_filename, dpi=100, bbox_inches='tight')
+    output.save_figure(plt.gcf(), plot_filename, dpi=100)
     plt.clf()
 
 
+@instrument.stage()
 def plot_temperature_min(projection, plot_type, temp_sparse, temp,
                          lons, lats, date, plot_filename='output.png'):
     import matplotlib.pyplot as plt
+    import output
+    import utils
     '''Plot temperature on the map'''
     fig = plt.figure(1, figsize=(10, 10))
     ax = utils.get_projection(plt, projection, regions=False)
@@ -92,13 +145,16 @@ def plot_temperature_min(projection, plot_type, temp_sparse, temp,
         ax=plt.gca(), logo='meteonetwork_logo.png', zoom=0.3, pos=(0.15, 0.05))
     utils.add_hist_on_map(plt.gca(), temp, label='Temperatura [C]')
 
-    plt.savefig(plot_filename, dpi=100, bbox_inches='tight')
+    output.save_figure(plt.gcf(), plot_filename, dpi=100)
     plt.clf()
 
 
+@instrument.stage()
 def plot_rain(projection, rain_sparse, rain,
               lons, lats, date, plot_filename='output.png'):
     import matplotlib.pyplot as plt
+    import output
+    import utils
     fig = plt.figure(1, figsize=(10, 10))
     ax = utils.get_projection(plt, projection, regions=False)
 
@@ -113,13 +169,16 @@ def plot_rain(projection, rain_sparse, rain,
         ax=plt.gca(), logo='meteonetwork_logo.png', zoom=0.3, pos=(0.15, 0.05))
     utils.add_hist_on_map(plt.gca(), rain, label='Pioggia giornaliera [mm]')
 
-    plt.savefig(plot_filename, dpi=100, bbox_inches='tight')
+    output.save_figure(plt.gcf(), plot_filename, dpi=100)
     plt.clf()
 
 
+@instrument.stage()
 def plot_gust(projection, gust_sparse, gust,
               lons, lats, date, plot_filename='output.png'):
     import matplotlib.pyplot as plt
+    import output
+    import utils
     fig = plt.figure(1, figsize=(10, 10))
     ax = utils.get_projection(plt, projection, regions=False)
 
@@ -134,9 +193,56 @@ def plot_gust(projection, gust_sparse, gust,
         ax=plt.gca(), logo='meteonetwork_logo.png', zoom=0.3, pos=(0.15, 0.05))
     utils.add_hist_on_map(plt.gca(), gust, label='Raffica [kmh/h]')
 
-    plt.savefig(plot_filename, dpi=100, bbox_inches='tight')
+    output.save_figure(plt.gcf(), plot_filename, dpi=100)
     plt.clf()
 
 
 if __name__ == "__main__":
-    main(plot_type=args.plot_type, plot_filename=args.plot_filename, projection=args.projection, date_download=args.date_download)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t','--plot_type', help='Type of the plot, can be temperature_max, temperature_min, rain or gust',
+                         required=False, default='temperature_max')
+    parser.add_argument('-f','--plot_filename', help='Name of the output file',
+                         required=False, default='output.png')
+    parser.add_argument('-p','--projection', help='Projection, at the moment only italy is supported',
+                         required=False, default='italy')
+    parser.add_argument('-d','--date_download', help='Date to download with format YYYY-MM-DD',
+                         required=False, default=(datetime.now() - timedelta(1)).strftime(format='%Y-%m-%d'))
+    parser.add_argument('-b','--batch', help='Render several products in one run, each given as plot_type:projection:filename '
+                        '(e.g. rain:italy:pioggia_daily.png). Data is downloaded only once',
+                        required=False, nargs='+', default=None)
+    parser.add_argument('-j','--workers', help='Number of processes rendering the batch products in parallel',
+                        required=False, type=int, default=1)
+    parser.add_argument('--publish', help='Upload every product as soon as it is ready, unless unchanged, to a '
+                        'local directory or ftp://user@host/directory (password in MNW_FTP_PASSWORD)',
+                        required=False, default=None)
+
+    args = parser.parse_args()
+
+    publisher = None
+    if args.publish:
+        import publish
+        publisher = publish.Publisher(publish.get_transport(args.publish))
+
+    def publish_outputs(plot_filename):
+        import output
+
+        # Also the other formats of the product, see MNW_OUTPUT_FORMATS
+        for filename in output.output_filenames(plot_filename):
+            publisher.publish(filename)
+
+    failed = []
+    if args.batch:
+        from plot_live import parse_job
+
+        failed = main_batch([parse_job(job) for job in args.batch], args.date_download, workers=args.workers,
+                            callback=(lambda job: publish_outputs(job[2])) if publisher else None)
+    else:
+        main(plot_type=args.plot_type, plot_filename=args.plot_filename, projection=args.projection, date_download=args.date_download)
+        if publisher:
+            publish_outputs(args.plot_filename)
+
+    if publisher:
+        failed += publisher.wait()
+        publisher.close()
+    if failed:
+        sys.exit(1)
@@ -1,30 +1,130 @@
-import utils
-import numpy as np
-from api import MNWApi
 import argparse
+import sys
+import instrument
 
-mnw = MNWApi()
+# The api, numpy, matplotlib and the plotting utilities are imported by the
+# functions using them: importing this module, or printing --help, stays fast
+# and no connection is prepared before the first download (see api.get_api)
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-t','--plot_type', help='Type of the plot, can be temperature, rain, humidity, gust or synoptic',
-                     required=False, default='temperature')
-parser.add_argument('-f','--plot_filename', help='Name of the output file',
-                     required=False, default='output.png')
-parser.add_argument('-p','--projection', help='Projection, at the moment only italy is supported',
-                     required=False, default='italy')
+# Whether the figures of the products are kept and reused by the next renderings
+# (see map_figure), as done by live_daemon
+keep_figures = False
+# Figures kept, by projection and map layers
+figures = {}
+
+
+def dataset_key(projection='italy'):
+    '''Return the key identifying the dataset needed by a projection.
+    Products that share the same key can be rendered from the same data.'''
+    if projection == 'italy':
+        return 'italy'
+    else:
+        return 'europe'
+
+
+@instrument.stage()
+def fetch_data(projection='italy'):
+    '''Download the realtime data needed to plot on a given projection'''
+    from api import get_api
+
+    if dataset_key(projection) == 'italy':
+        return get_api().get_realtime_stations(country='IT')
+    else:
+        return get_api().get_realtime_stations()
+
+
+def check_data(key, data):
+    '''Run the quality control on the data of the dataset key (see dataset_key),
+    comparing it with the snapshot saved by the previous run, which is then
+    replaced by data. Returns the flags of qc.check.'''
+    import qc
+
+    flags = qc.check(data, previous=qc.load_snapshot(key))
+    qc.save_snapshot(key, data)
+
+    return flags
+
+
+def parse_job(job):
+    '''Parse a batch job given as plot_type:projection:filename'''
+    parts = job.split(':')
+    if len(parts) != 3:
+        raise ValueError('Batch job %s should be given as plot_type:projection:filename' % job)
+    return tuple(parts)
 
-args = parser.parse_args()
 
 def main(plot_type='temperature', plot_filename='output.png', projection='italy'):
     if plot_filename:
         import matplotlib
         matplotlib.use("agg")
 
-    if projection == 'italy':
-        data = mnw.get_realtime_stations(country='IT')
-    else:
-        data = mnw.get_realtime_stations()
-
+    data = fetch_data(projection)
+    flags = check_data(dataset_key(projection), data)
+    plot_product(data, plot_type, plot_filename, projection, flags=flags)
+
+
+def main_batch(jobs, workers=1, callback=None):
+    '''Render several products in the same run. jobs is a list of
+    (plot_type, projection, plot_filename) tuples. Every distinct dataset is
+    downloaded only once and shared by all the products that need it.
+    With workers > 1 the products are rendered in parallel by that many
+    processes (see render_pool). A failure in one product does not stop the others.
+    callback, if given, is called with the job as soon as its product is ready
+    (e.g. to publish it while the others are rendered).
+    Returns the list of jobs that failed.'''
+    import matplotlib
+    matplotlib.use("agg")
+
+    datasets = {}
+    flags = {}
+    failed = []
+    tasks = []
+    for plot_type, projection, plot_filename in jobs:
+        try:
+            key = dataset_key(projection)
+            if key not in datasets:
+                # Both or none, so that a failure is retried by the next product
+                data = fetch_data(projection)
+                flags[key] = check_data(key, data)
+                datasets[key] = data
+            if workers > 1:
+                tasks.append((plot_type, projection, plot_filename))
+                continue
+            plot_product(datasets[key], plot_type, plot_filename, projection, flags=flags[key])
+            if callback:
+                callback((plot_type, projection, plot_filename))
+        except Exception as e:
+            print('Error in producing %s (%s, %s): %s' % (plot_filename, plot_type, projection, e))
+            discard_figure()
+            failed.append((plot_type, projection, plot_filename))
+
+    if tasks:
+        import render_pool
+
+        jobs_by_filename = {job[2]: job for job in tasks}
+        errors = render_pool.render(
+            [('plot_live', dataset_key(projection),
+              (plot_type, plot_filename, projection, flags[dataset_key(projection)]), plot_filename)
+             for plot_type, projection, plot_filename in tasks],
+            datasets, max_workers=workers,
+            callback=(lambda plot_filename: callback(jobs_by_filename[plot_filename])) if callback else None)
+        failed_filenames = [plot_filename for plot_filename, e in errors]
+        failed += [job for job in tasks if job[2] in failed_filenames]
+
+    return failed
+
+
+@instrument.stage()
+def plot_product(data, plot_type='temperature', plot_filename='output.png', projection='italy',
+                 flags=None):
+    '''Compute the filtered fields for plot_type from the realtime data and
+    render them on the map. Values failing the quality control are left out:
+    flags are the ones computed by qc.check on data, which is run here if not given.'''
+    import qc
+    import utils
+
+    if flags is None:
+        flags = qc.check(data)
     lats = data['latitude'].values
     lons = data['longitude'].values
 
@@ -32,163 +132,217 @@ def main(plot_type='temperature', plot_filename='output.png', projection='italy'
     # Modify max_density and num_bins to act on the filtering
 
     if plot_type == 'temperature':
-        temperature = data['temperature'].values
-        temperature_sparse = utils.filter_values(temperature, lats, lons)
+        temperature = qc.masked(data, flags, 'temperature')
+        temperature_sparse = utils.filter_values(temperature, lats, lons,
+                                                 valid=qc.valid(flags, 'temperature'))
         plot_temperature(projection, temperature_sparse,
                          temperature, lons, lats, data['observation_time_local'], plot_filename)
     elif plot_type == 'sat':
-        temperature = data['temperature'].values
+        temperature = qc.masked(data, flags, 'temperature')
+        valid = qc.valid(flags, 'temperature')
         if projection == 'italy':
-            temperature_sparse = utils.filter_values(temperature, lats, lons, num_bins=25)
+            temperature_sparse = utils.filter_values(temperature, lats, lons, num_bins=25, valid=valid)
         else:
-            temperature_sparse = utils.filter_values(temperature, lats, lons, num_bins=50)
+            temperature_sparse = utils.filter_values(temperature, lats, lons, num_bins=50, valid=valid)
 
         plot_sat_temp(projection, temperature_sparse,
                          temperature, lons, lats, data['observation_time_local'], plot_filename)
     elif plot_type == 'rain':
-        precipitation = data['daily_rain'].values
+        precipitation = qc.masked(data, flags, 'daily_rain')
         precipitation_sparse = utils.filter_values(
-            precipitation, lats, lons, max_density=1)
+            precipitation, lats, lons, max_density=1, valid=qc.valid(flags, 'daily_rain'))
         plot_rain(projection, precipitation_sparse, precipitation,
                   lons, lats, data['observation_time_local'], plot_filename)
     elif plot_type == 'humidity':
-        humidity = data['rh'].values
-        humidity_sparse = utils.filter_values(humidity, lats, lons)
+        humidity = qc.masked(data, flags, 'rh')
+        humidity_sparse = utils.filter_values(humidity, lats, lons, valid=qc.valid(flags, 'rh'))
         plot_humidity(projection, humidity_sparse, humidity,
                       lons, lats, data['observation_time_local'], plot_filename)
     elif plot_type == 'gust':
-        gust = data['wind_gust'].values
+        gust = qc.masked(data, flags, 'wind_gust')
         u, v = utils.wind_components(
-            data['wind_speed'].values, data['wind_direction'].values)
-        u_sparse = utils.filter_values(u, lats, lons, max_density=1)
-        v_sparse = utils.filter_values(v, lats, lons, max_density=1)
-        gust_sparse = utils.filter_values(gust, lats, lons, max_density=1)
+            qc.masked(data, flags, 'wind_speed'), data['wind_direction'].values)
+        removed = utils.station_selection(lats, lons, max_density=1,
+                                          valid=qc.valid(flags, 'wind_gust') & qc.valid(flags, 'wind_speed'))
+        u_sparse, v_sparse, gust_sparse = utils.apply_selection(removed, u, v, gust)
         plot_gust(projection, gust_sparse, gust, u_sparse, v_sparse,
                   lons, lats, data['observation_time_local'], plot_filename)
     elif plot_type == 'synoptic':
         u, v = utils.wind_components(
-            data['wind_speed'].values, data['wind_direction'].values)
-        u_sparse = utils.filter_values(
-            u, lats, lons, max_density=1, num_bins=35)
-        v_sparse = utils.filter_values(
-            v, lats, lons, max_density=1, num_bins=35)
-        mslp = data['smlp'].values
-        mslp_sparse = utils.filter_values(
-            mslp, lats, lons, max_density=1, num_bins=35)
-        mslp_sparse[mslp_sparse == 0] = np.nan
+            qc.masked(data, flags, 'wind_speed'), data['wind_direction'].values)
+        # Pressures of 0 and the other implausible ones are removed by the quality control
+        mslp = qc.masked(data, flags, 'smlp')
+        removed = utils.station_selection(lats, lons, max_density=1, num_bins=35,
+                                          valid=qc.valid(flags, 'smlp'))
+        u_sparse, v_sparse, mslp_sparse = utils.apply_selection(removed, u, v, mslp)
         plot_synoptic(projection, u_sparse, v_sparse, mslp_sparse,
                       lons, lats, data['observation_time_local'], plot_filename)
     else:
-        print('Error, variable %s not found' % plot_type)
+        raise ValueError('Unknown plot_type %s' % plot_type)
 
 
+def map_figure(projection='italy', figsize=(12, 12), **layers):
+    '''Return the figure and the map axis (see utils.get_projection with layers)
+    of a product, with the logos. With keep_figures the map is created only once
+    for every projection and layers, and later renderings only remove what the
+    previous one drew on it (values, barbs, histogram) before drawing again.
+    Maps with the satellite are created again for every new image.'''
+    import matplotlib.pyplot as plt
+    import utils
+
+    if not keep_figures:
+        fig = plt.figure(1, figsize=figsize)
+        ax = utils.get_projection(plt, projection, **layers)
+        add_logos(ax)
+        return fig, ax
+
+    key = (projection, figsize, tuple(sorted(layers.items())))
+    version = None
+    if layers.get('sat'):
+        import satellite
+
+        version = satellite.imagery_slot()
+    if key in figures and figures[key][0] != version:
+        plt.close(figures[key][1])
+        del figures[key]
+    if key not in figures:
+        fig = plt.figure(figsize=figsize)
+        ax = utils.get_projection(plt, projection, **layers)
+        add_logos(ax)
+        # Drawn once, so that whatever the first draw adds is part of the map
+        fig.canvas.draw()
+        figures[key] = (version, fig, ax, list(fig.axes), set(ax.get_children()))
+    version, fig, ax, axes, children = figures[key]
+    for other in fig.axes:
+        if other not in axes:
+            other.remove()
+    for child in ax.get_children():
+        if child not in children:
+            child.remove()
+    plt.figure(fig.number)
+    fig.sca(ax)
+
+    return fig, ax
+
+
+def add_logos(ax):
+    import utils
+
+    logos = [utils.add_logo_on_map(
+                 ax=ax, logo='meteoindiretta_logo.png', zoom=0.15, pos=(0.92, 0.1)),
+             utils.add_logo_on_map(
+                 ax=ax, logo='meteonetwork_logo.png', zoom=0.3, pos=(0.15, 0.05))]
+    for logo in logos:
+        # Above the values, which are added later on the same zorder
+        logo.set_zorder(3.5)
+
+
+def release_figure(fig):
+    '''Clear the figure after saving a product, unless it is kept (see map_figure)'''
+    if not keep_figures:
+        fig.clf()
+
+
+def discard_figure():
+    '''Clear what a product that failed left on the figure, so that the next
+    one is not drawn over it. Kept figures are cleaned by map_figure anyway.'''
+    if not keep_figures and 'matplotlib.pyplot' in sys.modules:
+        import matplotlib.pyplot as plt
+
+        plt.clf()
+
+
+@instrument.stage()
 def plot_temperature(projection, temp_sparse, temp,
                      lons, lats, date, plot_filename):
-    import matplotlib.pyplot as plt
+    import output
+    import utils
     '''Plot temperature on the map'''
-    fig = plt.figure(1, figsize=(12, 12))
-
-    ax = utils.get_projection(plt, projection, regions=False)
+    fig, ax = map_figure(projection, regions=False)
 
     utils.add_vals_on_map(ax=ax, projection=projection,
                           var=temp_sparse, lons=lons, lats=lats)
 
-    plt.title('Temperature live | Ultimo aggiornamento %s' % date[0])
+    ax.set_title('Temperature live | Ultimo aggiornamento %s' % date[0])
 
-    utils.add_logo_on_map(
-        ax=ax, logo='meteoindiretta_logo.png', zoom=0.15, pos=(0.92, 0.1))
-    utils.add_logo_on_map(
-        ax=ax, logo='meteonetwork_logo.png', zoom=0.3, pos=(0.15, 0.05))
     utils.add_hist_on_map(ax=ax, var=temp, label='Temperatura [C]')
 
-    plt.savefig(plot_filename, dpi=100, bbox_inches='tight')
-    plt.clf()
+    output.save_figure(fig, plot_filename, dpi=100)
+    release_figure(fig)
 
 
+@instrument.stage()
 def plot_sat_temp(projection, temp_sparse, temp,
                      lons, lats, date, plot_filename):
-    import matplotlib.pyplot as plt
+    import output
+    import utils
     '''Plot temperature on the map'''
-    fig = plt.figure(1, figsize=(12, 12))
-
     if projection == 'italy':
-        ax = utils.get_projection(plt, projection, regions=True,
-                                  sat=True, background=False,
-                                  coastlines=True)
+        fig, ax = map_figure(projection, regions=True, sat=True,
+                             background=False, coastlines=True)
     else:
-        ax = utils.get_projection(plt, projection, regions=False,
-                                  sat=True, background=False,
-                                  coastlines=True)
+        fig, ax = map_figure(projection, regions=False, sat=True,
+                             background=False, coastlines=True)
 
     utils.add_vals_on_map(ax=ax, projection=projection,
                           var=temp_sparse, lons=lons, lats=lats)
 
-    plt.title('Temperature live | Ultimo aggiornamento %s' % date[0])
-
-    utils.add_logo_on_map(
-        ax=ax, logo='meteoindiretta_logo.png', zoom=0.15, pos=(0.92, 0.1))
-    utils.add_logo_on_map(
-        ax=ax, logo='meteonetwork_logo.png', zoom=0.3, pos=(0.15, 0.05))
+    ax.set_title('Temperature live | Ultimo aggiornamento %s' % date[0])
 
     if projection == 'italy':
         utils.add_hist_on_map(ax=ax, var=temp, label='Temperatura [C]')
     else:
         utils.add_hist_on_map(ax=ax, var=temp, label='Temperatura [C]', loc=2, width="25%")
 
-    plt.savefig(plot_filename, dpi=100, bbox_inches='tight')
-    plt.clf()
+    output.save_figure(fig, plot_filename, dpi=100)
+    release_figure(fig)
 
 
+@instrument.stage()
 def plot_humidity(projection, hum_sparse, hum,
                   lons, lats, date, plot_filename):
-    import matplotlib.pyplot as plt
+    import output
+    import utils
 
-    fig = plt.figure(1, figsize=(12, 12))
-    ax = utils.get_projection(plt, projection, regions=False)
+    fig, ax = map_figure(projection, regions=False)
 
     utils.add_vals_on_map(ax=ax, var=hum_sparse, projection=projection,
                           lons=lons, lats=lats, minval=0, maxval=100, cmap='jet_r')
 
-    plt.title('Umidita live | Ultimo aggiornamento %s' % date[0])
+    ax.set_title('Umidita live | Ultimo aggiornamento %s' % date[0])
 
-    utils.add_logo_on_map(
-        ax=ax, logo='meteoindiretta_logo.png', zoom=0.15, pos=(0.92, 0.1))
-    utils.add_logo_on_map(
-        ax=ax, logo='meteonetwork_logo.png', zoom=0.3, pos=(0.15, 0.05))
     utils.add_hist_on_map(ax=ax, var=hum, label='Umidita [%]')
 
-    plt.savefig(plot_filename, dpi=100, bbox_inches='tight')
-    plt.clf()
+    output.save_figure(fig, plot_filename, dpi=100)
+    release_figure(fig)
 
 
+@instrument.stage()
 def plot_rain(projection, rain_sparse, rain,
               lons, lats, date, plot_filename):
-    import matplotlib.pyplot as plt
+    import output
+    import utils
 
-    fig = plt.figure(1, figsize=(12, 12))
-    ax = utils.get_projection(plt, projection, regions=False)
+    fig, ax = map_figure(projection, regions=False)
 
     utils.add_vals_on_map(ax=ax, var=rain_sparse, projection=projection,
                           lons=lons, lats=lats, minval=0, maxval=150, cmap='gist_stern_r')
 
-    plt.title('Precipitazioni live | Ultimo aggiornamento %s' % date[0])
+    ax.set_title('Precipitazioni live | Ultimo aggiornamento %s' % date[0])
 
-    utils.add_logo_on_map(
-        ax=ax, logo='meteoindiretta_logo.png', zoom=0.15, pos=(0.92, 0.1))
-    utils.add_logo_on_map(
-        ax=ax, logo='meteonetwork_logo.png', zoom=0.3, pos=(0.15, 0.05))
     utils.add_hist_on_map(ax=ax, var=rain, label='Pioggia giornaliera [mm]')
 
-    plt.savefig(plot_filename, dpi=100, bbox_inches='tight')
-    plt.clf()
+    output.save_figure(fig, plot_filename, dpi=100)
+    release_figure(fig)
 
 
+@instrument.stage()
 def plot_gust(projection, gust_sparse, gust, u, v,
               lons, lats, date, plot_filename):
-    import matplotlib.pyplot as plt
+    import output
+    import utils
 
-    fig = plt.figure(1, figsize=(12, 12))
-    ax = utils.get_projection(plt, projection, regions=False)
+    fig, ax = map_figure(projection, regions=False)
 
     utils.add_vals_on_map(ax=ax, var=gust_sparse, projection=projection,
                           lons=lons, lats=lats, minval=0, maxval=150, cmap='gist_stern_r', fontsize=10)
@@ -196,24 +350,21 @@ def plot_gust(projection, gust_sparse, gust, u, v,
     utils.add_barbs_on_map(ax=ax, projection=projection, u=u, v=v,
                            lons=lons, lats=lats)
 
-    plt.title('Raffiche live | Ultimo aggiornamento %s' % date[0])
+    ax.set_title('Raffiche live | Ultimo aggiornamento %s' % date[0])
 
-    utils.add_logo_on_map(
-        ax=ax, logo='meteoindiretta_logo.png', zoom=0.15, pos=(0.92, 0.1))
-    utils.add_logo_on_map(
-        ax=ax, logo='meteonetwork_logo.png', zoom=0.3, pos=(0.15, 0.05))
     utils.add_hist_on_map(ax=ax, var=gust, label='Raffica [km/h]')
 
-    plt.savefig(plot_filename, dpi=100, bbox_inches='tight')
-    plt.clf()
+    output.save_figure(fig, plot_filename, dpi=100)
+    release_figure(fig)
 
 
+@instrument.stage()
 def plot_synoptic(projection, u, v, mslp,
                   lons, lats, date, plot_filename):
-    import matplotlib.pyplot as plt
+    import output
+    import utils
 
-    fig = plt.figure(1, figsize=(12, 12))
-    ax = utils.get_projection(plt, projection, regions=False)
+    fig, ax = map_figure(projection, regions=False)
 
     utils.add_vals_on_map(ax=ax, var=mslp, projection=projection,
                           lons=lons, lats=lats, minval=960, maxval=1050, colors=False, fontsize=8)
@@ -221,16 +372,54 @@ def plot_synoptic(projection, u, v, mslp,
     utils.add_barbs_on_map(ax=ax, projection=projection, u=u, v=v,
                            lons=lons, lats=lats, magnitude=True)
 
-    plt.title('Pressione e venti  | Ultimo aggiornamento %s' % date[0])
-
-    utils.add_logo_on_map(
-        ax=ax, logo='meteoindiretta_logo.png', zoom=0.15, pos=(0.92, 0.1))
-    utils.add_logo_on_map(
-        ax=ax, logo='meteonetwork_logo.png', zoom=0.3, pos=(0.15, 0.05))
+    ax.set_title('Pressione e venti  | Ultimo aggiornamento %s' % date[0])
 
-    plt.savefig(plot_filename, dpi=100, bbox_inches='tight')
-    plt.clf()
+    output.save_figure(fig, plot_filename, dpi=100)
+    release_figure(fig)
 
 
 if __name__ == "__main__":
-    main(plot_type=args.plot_type, plot_filename=args.plot_filename, projection=args.projection)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t','--plot_type', help='Type of the plot, can be temperature, rain, humidity, gust or synoptic',
+                         required=False, default='temperature')
+    parser.add_argument('-f','--plot_filename', help='Name of the output file',
+                         required=False, default='output.png')
+    parser.add_argument('-p','--projection', help='Projection, at the moment only italy is supported',
+                         required=False, default='italy')
+    parser.add_argument('-b','--batch', help='Render several products in one run, each given as plot_type:projection:filename '
+                        '(e.g. temperature:italy:temperature_live.png). Data is downloaded only once per projection',
+                        required=False, nargs='+', default=None)
+    parser.add_argument('-j','--workers', help='Number of processes rendering the batch products in parallel',
+                        required=False, type=int, default=1)
+    parser.add_argument('--publish', help='Upload every product as soon as it is ready, unless unchanged, to a '
+                        'local directory or ftp://user@host/directory (password in MNW_FTP_PASSWORD)',
+                        required=False, default=None)
+
+    args = parser.parse_args()
+
+    publisher = None
+    if args.publish:
+        import publish
+        publisher = publish.Publisher(publish.get_transport(args.publish))
+
+    def publish_outputs(plot_filename):
+        import output
+
+        # Also the other formats of the product, see MNW_OUTPUT_FORMATS
+        for filename in output.output_filenames(plot_filename):
+            publisher.publish(filename)
+
+    failed = []
+    if args.batch:
+        failed = main_batch([parse_job(job) for job in args.batch], workers=args.workers,
+                            callback=(lambda job: publish_outputs(job[2])) if publisher else None)
+    else:
+        main(plot_type=args.plot_type, plot_filename=args.plot_filename, projection=args.projection)
+        if publisher:
+            publish_outputs(args.plot_filename)
+
+    if publisher:
+        failed += publisher.wait()
+        publisher.close()
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,228 @@
+# Upload of the rendered products, skipping the ones that did not change
+import argparse
+import ftplib
+import hashlib
+import json
+import os
+import queue
+import shutil
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urlsplit
+
+STATE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'meteonetwork', 'published')
+
+
+class DirectoryTransport():
+    def __init__(self, path):
+        '''Publish by copying the files in a local directory (e.g. served by a
+        web server, or to test the publishing without a remote server)'''
+        self.path = path
+        self.key = 'dir:%s' % os.path.abspath(path)
+
+    def upload(self, filename, remote_name):
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = os.path.join(self.path, '.%s.tmp' % remote_name)
+        shutil.copyfile(filename, tmp_path)
+        os.replace(tmp_path, os.path.join(self.path, remote_name))
+
+    def close(self):
+        pass
+
+
+class FTPTransport():
+    def __init__(self, host, user='anonymous', password='', directory='', port=21,
+                 connections=2, tls=False, timeout=60):
+        '''Publish on an FTP server through up to connections sessions which are
+        opened on the first upload and reused for all the following ones.
+        Files are uploaded with a temporary name and then renamed, so that
+        clients never download a partial image.'''
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.directory = directory
+        self.tls = tls
+        self.timeout = timeout
+        self.key = 'ftp:%s@%s:%d/%s' % (user, host, port, directory)
+        self.idle = queue.LifoQueue()
+        self.slots = threading.Semaphore(connections)
+
+    def connect(self):
+        ftp = (ftplib.FTP_TLS if self.tls else ftplib.FTP)(timeout=self.timeout)
+        ftp.connect(self.host, self.port)
+        ftp.login(self.user, self.password)
+        if self.tls:
+            ftp.prot_p()
+        if self.directory:
+            ftp.cwd(self.directory)
+        return ftp
+
+    def upload(self, filename, remote_name):
+        with self.slots:
+            try:
+                ftp = self.idle.get_nowait()
+            except queue.Empty:
+                ftp = self.connect()
+            try:
+                try:
+                    self.store(ftp, filename, remote_name)
+                except (ftplib.error_temp, OSError, EOFError):
+                    # The server may have closed an idle session, retry once on a new one
+                    self.discard(ftp)
+                    ftp = None
+                    ftp = self.connect()
+                    self.store(ftp, filename, remote_name)
+            except Exception:
+                # A session in an unknown state is not reused
+                if ftp is not None:
+                    self.discard(ftp)
+                raise
+            self.idle.put(ftp)
+
+    def store(self, ftp, filename, remote_name):
+        tmp_name = '.%s.tmp' % remote_name
+        with open(filename, 'rb') as f:
+            ftp.storbinary('STOR %s' % tmp_name, f)
+        try:
+            # Most servers replace the old file, which is then never missing
+            ftp.rename(tmp_name, remote_name)
+        except ftplib.error_perm:
+            # Others refuse to rename over an existing file
+            try:
+                ftp.delete(remote_name)
+            except ftplib.error_perm:
+                pass
+            ftp.rename(tmp_name, remote_name)
+
+    def discard(self, ftp):
+        try:
+            ftp.close()
+        except Exception:
+            pass
+
+    def close(self):
+        while not self.idle.empty():
+            ftp = self.idle.get_nowait()
+            try:
+                ftp.quit()
+            except Exception:
+                ftp.close()
+
+
+def get_transport(target, connections=2):
+    '''Return the transport for target, either a local directory or an url
+    ftp://user@host[:port]/directory (ftps:// for TLS), whose password is
+    taken from the url or from MNW_FTP_PASSWORD'''
+    url = urlsplit(target)
+    if url.scheme in ('ftp', 'ftps'):
+        password = unquote(url.password) if url.password else os.environ.get('MNW_FTP_PASSWORD', '')
+        return FTPTransport(url.hostname, unquote(url.username or 'anonymous'), password,
+                            unquote(url.path.lstrip('/')), url.port or 21,
+                            connections=connections, tls=url.scheme == 'ftps')
+    if url.scheme == 'file':
+        return DirectoryTransport(unquote(url.path))
+    return DirectoryTransport(target)
+
+
+def file_hash(filename):
+    '''Hash of the content of a file'''
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Publisher():
+    def __init__(self, transport, state_path=None, max_workers=2):
+        '''Upload files through transport in background threads as soon as they
+        are published, skipping the ones whose content is the same of the last
+        version uploaded to the same target. The hashes of the uploaded versions
+        are kept in a state file in ~/.cache/meteonetwork/published (or
+        MNW_PUBLISH_STATE_DIR), one per target.'''
+        self.transport = transport
+        if state_path is None:
+            state_dir = os.environ.get('MNW_PUBLISH_STATE_DIR', STATE_PATH)
+            state_path = os.path.join(state_dir, '%s.json' % hashlib.sha1(
+                transport.key.encode()).hexdigest()[:16])
+        self.state_path = state_path
+        self.state = self.read_state()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write_state(self):
+        '''Atomically save the state, call it while holding the lock'''
+        os.makedirs(os.path.dirname(os.path.abspath(self.state_path)), exist_ok=True)
+        tmp_path = '%s.%d.tmp' % (self.state_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(tmp_path, self.state_path)
+
+    def upload(self, filename, remote_name):
+        '''Upload a file unless unchanged, returning whether it was uploaded'''
+        digest = file_hash(filename)
+        with self.lock:
+            if self.state.get(remote_name) == digest:
+                return False
+        self.transport.upload(filename, remote_name)
+        with self.lock:
+            self.state[remote_name] = digest
+            self.write_state()
+        return True
+
+    def publish(self, filename, remote_name=None):
+        '''Start publishing filename (as remote_name, by default its base name)'''
+        remote_name = remote_name or os.path.basename(filename)
+        self.futures[filename] = self.executor.submit(self.upload, filename, remote_name)
+
+    def wait(self):
+        '''Wait for all the uploads started so far and return the list of
+        (filename, error) of the ones that failed'''
+        failed = []
+        for filename, future in self.futures.items():
+            try:
+                uploaded = future.result()
+                print('%s %s' % (filename, 'published' if uploaded else 'unchanged, not published'))
+            except Exception as e:
+                print('Error in publishing %s: %s' % (filename, e))
+                failed.append((filename, e))
+        self.futures = {}
+
+        return failed
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.transport.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('target', help='Where to publish: a local directory or ftp://user@host/directory')
+    parser.add_argument('files', help='Files to publish', nargs='+')
+    parser.add_argument('-c', '--connections', help='Number of concurrent uploads',
+                        required=False, type=int, default=2)
+
+    args = parser.parse_args()
+
+    with Publisher(get_transport(args.target, args.connections), max_workers=args.connections) as publisher:
+        for filename in args.files:
+            publisher.publish(filename)
+        failed = publisher.wait()
+    if failed:
+        sys.exit(1)
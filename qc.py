@@ -0,0 +1,278 @@
+# Quality control of the station snapshots, on top of the data_quality of the server
+import hashlib
+import os
+import time
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import instrument
+from stations import StationIndex
+
+# Bits of the flags, a station can fail several checks
+RANGE = 1
+BUDDY = 2
+SPIKE = 4
+STUCK = 8
+
+# Plausible values of every variable
+LIMITS = {
+    'temperature': (-40., 50.), 't_min': (-40., 50.), 't_med': (-40., 50.), 't_max': (-40., 50.),
+    'dew_point': (-50., 40.),
+    'rh': (1., 100.), 'rh_min': (1., 100.), 'rh_med': (1., 100.), 'rh_max': (1., 100.),
+    'smlp': (920., 1080.), 'mslp': (920., 1080.),
+    'mslp_min': (920., 1080.), 'mslp_med': (920., 1080.), 'mslp_max': (920., 1080.),
+    'wind_speed': (0., 250.), 'wind_gust': (0., 300.), 'w_med': (0., 250.), 'w_max': (0., 300.),
+    'daily_rain': (0., 800.), 'rain': (0., 800.), 'rain_rate': (0., 500.),
+    'solar_radiation': (0., 1500.), 'uv': (0., 20.),
+}
+# Largest difference from the median of the neighbours, for the variables which
+# are smooth in space. Temperatures are compared at sea level when the altitude
+# of the stations is known.
+BUDDY_LIMITS = {
+    'temperature': 8., 't_min': 8., 't_med': 8., 't_max': 8., 'dew_point': 10.,
+    'smlp': 6., 'mslp': 6., 'mslp_min': 6., 'mslp_med': 6., 'mslp_max': 6.,
+}
+LAPSE_RATE = 0.0065
+LAPSE_COLUMNS = ['temperature', 't_min', 't_med', 't_max', 'dew_point']
+# Largest change in one hour between two snapshots, and the change of the
+# neighbours above which a station whose value did not change at all is stuck
+SPIKE_LIMITS = {'temperature': 10., 'dew_point': 12., 'rh': 60., 'smlp': 6., 'mslp': 6.}
+STUCK_LIMITS = {'temperature': 1.5, 'dew_point': 2., 'rh': 10., 'smlp': 1.5, 'mslp': 1.5}
+
+# Last snapshot of every dataset, compared with the next one by the checks of
+# the runs which do not keep it in memory (e.g. plot_live from cron)
+SNAPSHOT_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'meteonetwork', 'snapshots')
+# Older snapshots are not compared anymore
+SNAPSHOT_MAX_AGE = 3 * 3600
+SNAPSHOT_COLUMNS = ['station_code', 'observation_time_utc', 'observation_time_local']
+
+# Recently computed neighbours, see neighbours
+neighbours_cache = OrderedDict()
+NEIGHBOURS_CACHE_SIZE = 4
+
+
+def neighbours(lats, lons, k=8, max_distance=50.):
+    '''Return the positions of the k nearest neighbours of every station (itself
+    excluded) within max_distance km, -1 where there are fewer. They only depend
+    on the positions, so the last ones are kept in memory and reused.'''
+    lats = np.ascontiguousarray(lats, dtype=float)
+    lons = np.ascontiguousarray(lons, dtype=float)
+    key = (hashlib.sha1(lats.tobytes() + lons.tobytes()).hexdigest(), k, max_distance)
+    if key in neighbours_cache:
+        neighbours_cache.move_to_end(key)
+        return neighbours_cache[key]
+
+    located = np.flatnonzero(np.isfinite(lats) & np.isfinite(lons))
+    result = np.full((len(lats), k), -1, dtype=np.int64)
+    if len(located) > 1:
+        index = StationIndex(pd.DataFrame({'station_code': located, 'latitude': lats[located],
+                                           'longitude': lons[located]}))
+        n = min(k + 1, len(located))
+        indices, distances = index.nearest(lats[located], lons[located], n)
+        # Leave out the station itself, which is not always the first one
+        # when other stations have the same position
+        itself = indices == np.arange(len(located))[:, np.newaxis]
+        itself[itself.sum(axis=1) == 0, -1] = True
+        indices = indices[~itself].reshape(len(located), n - 1)
+        distances = distances[~itself].reshape(len(located), n - 1)
+        found = np.where(distances <= max_distance, located[indices], -1)
+        result[located, :n - 1] = found
+    result.setflags(write=False)
+    neighbours_cache[key] = result
+    if len(neighbours_cache) > NEIGHBOURS_CACHE_SIZE:
+        neighbours_cache.popitem(last=False)
+
+    return result
+
+
+def neighbour_values(values, indices):
+    '''Values of the neighbours given by indices (see neighbours), NaN where missing'''
+    padded = np.append(values, np.nan)
+    return padded[indices]
+
+
+def row_median(values):
+    '''Median of every row ignoring NaN, like np.nanmedian(values, axis=1) but
+    much faster on many short rows (NaN for rows without values)'''
+    values = np.sort(values, axis=1)
+    count = np.isfinite(values).sum(axis=1)
+    rows = np.arange(len(values))
+    low = values[rows, np.maximum(count - 1, 0) // 2]
+    high = values[rows, np.minimum(count // 2, values.shape[1] - 1)]
+    return np.where(count > 0, (low + high) / 2, np.nan)
+
+
+def range_flags(values, column, limits=None):
+    '''RANGE for the values outside of the plausible limits of column'''
+    low, high = (limits or LIMITS)[column]
+    with np.errstate(invalid='ignore'):
+        return np.where((values < low) | (values > high), RANGE, 0).astype(np.uint8)
+
+
+def buddy_flags(values, indices, limit, min_buddies=3):
+    '''BUDDY for the values differing from the median of their neighbours by more
+    than limit, or than 4 times the spread of the neighbours if larger.
+    Stations with fewer than min_buddies valid neighbours are not checked.'''
+    buddies = neighbour_values(values, indices)
+    count = np.isfinite(buddies).sum(axis=1)
+    checked = (count >= min_buddies) & np.isfinite(values)
+    flags = np.zeros(len(values), dtype=np.uint8)
+    if not checked.any():
+        return flags
+    buddies = buddies[checked]
+    median = row_median(buddies)
+    spread = 1.4826 * row_median(np.abs(buddies - median[:, np.newaxis]))
+    flags[checked] = np.where(np.abs(values[checked] - median) > np.maximum(limit, 4 * spread), BUDDY, 0)
+
+    return flags
+
+
+def stuck_flags(change, hours, indices, limit, min_buddies=3):
+    '''STUCK for the values which did not change at all in hours while the median
+    change of at least min_buddies neighbours was larger than limit'''
+    flags = np.zeros(len(change), dtype=np.uint8)
+    candidates = np.flatnonzero((hours > 0) & (change == 0))
+    if len(candidates) == 0:
+        return flags
+    moved = np.abs(neighbour_values(change, indices[candidates]))
+    checked = np.isfinite(moved).sum(axis=1) >= min_buddies
+    candidates, moved = candidates[checked], moved[checked]
+    if len(candidates):
+        flags[candidates] = np.where(row_median(moved) > limit, STUCK, 0)
+
+    return flags
+
+
+def previous_positions(data, previous):
+    '''Return the rows of previous with the same stations of data (-1 for the new
+    ones) and the hours between the two observations (1 if unknown)'''
+    codes = pd.Index(previous['station_code'].astype(str))
+    # The last row of every station, as drop_duplicates(keep='last') would keep
+    last = ~codes.duplicated(keep='last')
+    rows = np.flatnonzero(last)
+    positions = pd.Index(codes[last]).get_indexer(data['station_code'].astype(str))
+    positions = np.where(positions >= 0, rows[positions], -1)
+    hours = np.ones(len(data))
+    time_column = 'observation_time_utc' if 'observation_time_utc' in data else 'observation_time_local'
+    if time_column in data and time_column in previous:
+        now = pd.to_datetime(data[time_column]).to_numpy()
+        before = pd.to_datetime(previous[time_column]).to_numpy()[positions]
+        hours = np.where(positions >= 0, (now - before) / np.timedelta64(1, 'h'), np.nan)
+
+    return positions, hours
+
+
+@instrument.stage('qc')
+def check(data, previous=None, columns=None, k=8, max_distance=50., min_buddies=3):
+    '''Run the quality checks over a snapshot of the stations (e.g. from
+    get_realtime_stations or get_daily_stations) and return their flags,
+    a DataFrame of uint8 with the rows of data and one column per checked
+    variable, 0 where the value passed all the checks (see valid):
+    - RANGE: outside of the plausible values in LIMITS
+    - BUDDY: too far from the median of its k nearest neighbours within
+      max_distance km (BUDDY_LIMITS)
+    - SPIKE: changed too fast since the previous snapshot, if given (SPIKE_LIMITS)
+    - STUCK: did not change at all since the previous snapshot while its
+      neighbours did (STUCK_LIMITS)
+    columns are the variables to check, by default all the ones in data
+    having limits.'''
+    if columns is None:
+        columns = [c for c in LIMITS if c in data]
+    instrument.add(stations=len(data))
+    flags = pd.DataFrame(index=data.index)
+    if data.empty:
+        for column in columns:
+            flags[column] = np.zeros(0, dtype=np.uint8)
+        return flags
+
+    lats = data['latitude'].to_numpy(dtype=float)
+    lons = data['longitude'].to_numpy(dtype=float)
+    indices = None
+    if any(c in BUDDY_LIMITS or c in STUCK_LIMITS for c in columns):
+        indices = neighbours(lats, lons, k, max_distance)
+    positions = None
+    if previous is not None and 'station_code' in data and 'station_code' in previous:
+        positions, hours = previous_positions(data, previous)
+    altitude = None
+    if 'altitude' in data:
+        altitude = np.nan_to_num(data['altitude'].to_numpy(dtype=float))
+
+    for column in columns:
+        values = data[column].to_numpy(dtype=float)
+        column_flags = range_flags(values, column)
+        # Values out of range are not used by the other checks
+        values = np.where(column_flags > 0, np.nan, values)
+        if column in BUDDY_LIMITS:
+            compared = values
+            if altitude is not None and column in LAPSE_COLUMNS:
+                compared = values + LAPSE_RATE * altitude
+            column_flags |= buddy_flags(compared, indices, BUDDY_LIMITS[column], min_buddies)
+        if positions is not None and column in previous:
+            before = np.append(previous[column].to_numpy(dtype=float), np.nan)[positions]
+            change = values - before
+            with np.errstate(invalid='ignore'):
+                if column in SPIKE_LIMITS:
+                    # Only between close snapshots, at least one hour worth of change is allowed
+                    recent = (hours > 0) & (hours <= 3)
+                    spike = recent & (np.abs(change) > SPIKE_LIMITS[column] * np.maximum(hours, 1))
+                    column_flags |= np.where(spike, SPIKE, 0).astype(np.uint8)
+                if column in STUCK_LIMITS:
+                    column_flags |= stuck_flags(change, hours, indices, STUCK_LIMITS[column], min_buddies)
+        flags[column] = column_flags
+
+    return flags
+
+
+def valid(flags, column):
+    '''Boolean mask of the stations whose value of column passed all the checks
+    (all True if column was not checked)'''
+    if column not in flags:
+        return np.ones(len(flags), dtype=bool)
+    return flags[column].to_numpy() == 0
+
+
+def masked(data, flags, column):
+    '''Values of column as floats, NaN where they failed a check'''
+    return np.where(valid(flags, column), data[column].to_numpy(dtype=float), np.nan)
+
+
+def summary(flags):
+    '''Number of stations failing every check, by variable'''
+    names = {'range': RANGE, 'buddy': BUDDY, 'spike': SPIKE, 'stuck': STUCK}
+    return pd.DataFrame({name: [(flags[c].to_numpy() & bit > 0).sum() for c in flags]
+                         for name, bit in names.items()}, index=flags.columns)
+
+
+def snapshot_filename(key):
+    path = os.environ.get('MNW_SNAPSHOT_DIR', SNAPSHOT_PATH)
+    return os.path.join(path, '%s.parquet' % key)
+
+
+def load_snapshot(key, max_age=SNAPSHOT_MAX_AGE):
+    '''Return the snapshot of the dataset key saved by save_snapshot, or None if
+    missing or saved more than max_age seconds ago'''
+    filename = snapshot_filename(key)
+    try:
+        if time.time() - os.path.getmtime(filename) > max_age:
+            return None
+        return pd.read_parquet(filename)
+    except Exception:
+        # Missing, corrupted or written by a different version: no comparison
+        return None
+
+
+def save_snapshot(key, data):
+    '''Save the columns of data needed by the checks between snapshots, as the
+    previous snapshot of the dataset key for the next run (see load_snapshot).
+    Failures only skip those checks in the next run.'''
+    columns = [c for c in SNAPSHOT_COLUMNS + list(SPIKE_LIMITS) + list(STUCK_LIMITS) if c in data]
+    filename = snapshot_filename(key)
+    tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        data[list(dict.fromkeys(columns))].to_parquet(tmp_filename, compression='zstd', index=False)
+        os.replace(tmp_filename, filename)
+    except Exception as e:
+        print('Could not save the snapshot %s: %s' % (key, e))
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
@@ -0,0 +1,146 @@
+# Parallel rendering of several products from data shared between processes
+import importlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+
+# Frames attached by a worker, by name of the shared memory block
+attached = {}
+
+
+class SharedFrame():
+    def __init__(self, spec, shm):
+        '''DataFrame whose numeric, categorical and datetime columns live in a
+        shared memory block, so that worker processes can use them without
+        copies. Create it with SharedFrame.create(data) in the parent, pass
+        spec to the workers and rebuild it there with SharedFrame.attach(spec).'''
+        self.spec = spec
+        self.shm = shm
+
+    @classmethod
+    def create(cls, data):
+        '''Copy data in a new shared memory block'''
+        columns = []
+        arrays = []
+        offset = 0
+        for name, column in data.items():
+            entry = {'name': name}
+            if isinstance(column.dtype, pd.CategoricalDtype):
+                values = column.cat.codes.to_numpy()
+                entry['categories'] = column.cat.categories.tolist()
+            elif pd.api.types.is_datetime64_dtype(column.dtype):
+                values = column.to_numpy().view('int64')
+                entry['datetime'] = column.dtype.str
+            elif column.dtype.kind in 'biuf':
+                values = column.to_numpy()
+            else:
+                # Strings are few and small, they travel with the spec
+                entry['values'] = column.tolist()
+                columns.append(entry)
+                continue
+            entry.update(dtype=values.dtype.str, offset=offset)
+            columns.append(entry)
+            arrays.append((offset, values))
+            # Keep every column aligned
+            offset += -(-values.nbytes // 8) * 8
+
+        shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for start, values in arrays:
+            np.ndarray(values.shape, values.dtype, shm.buf, start)[:] = values
+
+        return cls({'shm': shm.name, 'length': len(data), 'columns': columns}, shm)
+
+    @classmethod
+    def attach(cls, spec):
+        '''Open the shared memory block of a SharedFrame created by another process'''
+        # Workers share the resource tracker of their parent, so attaching
+        # does not make the block owned by them
+        return cls(spec, shared_memory.SharedMemory(name=spec['shm']))
+
+    def frame(self):
+        '''Return the DataFrame, whose columns are views of the shared memory'''
+        length = self.spec['length']
+        data = {}
+        for entry in self.spec['columns']:
+            if 'values' in entry:
+                data[entry['name']] = entry['values']
+                continue
+            values = np.ndarray(length, np.dtype(entry['dtype']), self.shm.buf, entry['offset'])
+            # Read only, as products must not change data used by the others
+            values.flags.writeable = False
+            if 'categories' in entry:
+                values = pd.Categorical.from_codes(values, entry['categories'])
+            elif 'datetime' in entry:
+                values = values.view(entry['datetime'])
+            data[entry['name']] = values
+
+        return pd.DataFrame(data, copy=False)
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        '''Free the block, to be called by the creator when all workers are done'''
+        self.shm.close()
+        self.shm.unlink()
+
+
+def init_worker():
+    import matplotlib
+    matplotlib.use("agg")
+
+
+def render_task(module_name, spec, args):
+    '''Render a product in a worker: module_name.plot_product(data, *args)
+    with data rebuilt from the shared memory described by spec'''
+    if spec['shm'] not in attached:
+        shared = SharedFrame.attach(spec)
+        attached[spec['shm']] = (shared, shared.frame())
+    data = attached[spec['shm']][1]
+    start = time.perf_counter()
+    try:
+        importlib.import_module(module_name).plot_product(data, *args)
+    except Exception:
+        # The next product of this worker must not be drawn over it
+        import matplotlib.pyplot as plt
+
+        plt.clf()
+        raise
+
+    return time.perf_counter() - start
+
+
+def render(tasks, datasets, max_workers=None, callback=None):
+    '''Render tasks, a list of (module_name, dataset_key, args, plot_filename), where
+    args are passed to module_name.plot_product after the data, over a pool of
+    max_workers processes (by default one per core), each with its own figure.
+    datasets maps every dataset_key to its DataFrame, which is shared with
+    the workers without copies. A failure in one product does not stop the others.
+    callback, if given, is called with plot_filename as soon as a product is ready.
+    Returns the list of (plot_filename, error) of the products that failed.'''
+    failed = []
+    shared = {}
+    try:
+        for key, data in datasets.items():
+            shared[key] = SharedFrame.create(data)
+        max_workers = min(max_workers or os.cpu_count() or 1, len(tasks)) or 1
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker) as executor:
+            futures = {executor.submit(render_task, module_name, shared[key].spec, args): plot_filename
+                       for module_name, key, args, plot_filename in tasks}
+            for future in as_completed(futures):
+                plot_filename = futures[future]
+                try:
+                    print('%s rendered in %.1f s' % (plot_filename, future.result()))
+                    if callback:
+                        callback(plot_filename)
+                except Exception as e:
+                    print('Error in producing %s: %s' % (plot_filename, e))
+                    failed.append((plot_filename, e))
+    finally:
+        for frame in shared.values():
+            frame.unlink()
+
+    return failed
@@ -0,0 +1,155 @@
+# On-disk cache of the DataFrames returned by the meteonetwork api
+import hashlib
+import importlib
+import json
+import os
+import shutil
+import time
+from datetime import datetime, timedelta
+import pandas as pd
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'meteonetwork', 'responses')
+# Fraction of max_size left after an eviction
+EVICT_TARGET = 0.8
+
+
+class ResponseCache():
+    def __init__(self, path=None, max_size=512 * 1024 ** 2, realtime_ttl=120,
+                 stations_ttl=86400, recent_ttl=600, settle_time=6 * 3600):
+        '''Cache api answers on disk in path, by default ~/.cache/meteonetwork/responses
+        or the directory defined in MNW_CACHE_DIR. Each entry is a parquet file if pyarrow
+        is available, a pickle otherwise.
+        - realtime_ttl is how long (seconds) realtime data is kept
+        - stations_ttl is how long the stations metadata is kept
+        - daily and archive data of a day are kept forever once the day is over by
+          more than settle_time seconds (to leave time for late uploads), and for
+          recent_ttl seconds before that
+        - when the cache grows over max_size bytes the least recently used entries
+          are removed, down to EVICT_TARGET of max_size'''
+        self.path = path or os.environ.get('MNW_CACHE_DIR', DEFAULT_PATH)
+        self.max_size = max_size
+        self.realtime_ttl = realtime_ttl
+        self.stations_ttl = stations_ttl
+        self.recent_ttl = recent_ttl
+        self.settle_time = settle_time
+        if importlib.util.find_spec("pyarrow") is not None:
+            self.extension = 'parquet'
+        else:
+            self.extension = 'pkl'
+        os.makedirs(self.path, exist_ok=True)
+        # Size of the cache, computed on the first write and then kept
+        # up to date to avoid scanning the directory every time
+        self._size = None
+
+    def ttl(self, endpoint, params, written=None):
+        '''Return how long (seconds) an answer written at the unix time written
+        (now by default) can be kept, None if forever. Answers of a day written
+        before it settled are never kept forever, as they may be incomplete.'''
+        if endpoint.startswith('data-realtime'):
+            return self.realtime_ttl
+        if endpoint.startswith('stations'):
+            return self.stations_ttl
+        observation_date = params.get('observation_date', 'today')
+        try:
+            day = datetime.strptime(observation_date, '%Y-%m-%d')
+        except (TypeError, ValueError):
+            return self.recent_ttl
+        settled = (day + timedelta(days=1, seconds=self.settle_time)).timestamp()
+        if (time.time() if written is None else written) > settled:
+            return None
+        return self.recent_ttl
+
+    def filename(self, endpoint, params):
+        '''Path of the entry for a request, given its endpoint and parameters'''
+        key = json.dumps([endpoint, sorted((k, str(v)) for k, v in params.items())])
+        name = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.path, '%s.%s' % (name, self.extension))
+
+    def get(self, endpoint, params, columns=None):
+        '''Return the cached DataFrame, or None if missing or expired.
+        If columns is given only those columns are read.'''
+        filename = self.filename(endpoint, params)
+        try:
+            written = os.path.getmtime(filename)
+        except OSError:
+            return None
+        ttl = self.ttl(endpoint, params, written)
+        if ttl is not None and time.time() - written > ttl:
+            return None
+        try:
+            if self.extension == 'parquet':
+                try:
+                    data = pd.read_parquet(filename, columns=columns)
+                except (KeyError, ValueError):
+                    # Some of the columns are not in the answer
+                    data = pd.read_parquet(filename).reindex(columns=columns)
+            else:
+                data = pd.read_pickle(filename)
+                if columns is not None:
+                    data = data.reindex(columns=columns)
+        except Exception:
+            # Corrupted or written by a different version: just download again
+            return None
+        # Keep the modification time, which marks when the entry was written,
+        # and use the access time to find the least recently used entries
+        os.utime(filename, (time.time(), written))
+
+        return data
+
+    def set(self, endpoint, params, data):
+        '''Save the DataFrame returned by a request'''
+        if self.ttl(endpoint, params) == 0:
+            return
+        filename = self.filename(endpoint, params)
+        tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        try:
+            if self.extension == 'parquet':
+                data.to_parquet(tmp_filename, compression='zstd')
+            else:
+                data.to_pickle(tmp_filename)
+            size = os.path.getsize(tmp_filename)
+            os.replace(tmp_filename, filename)
+        except Exception as e:
+            print('Could not save %s in the cache: %s' % (endpoint, e))
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            return
+        if self._size is None:
+            self.evict()
+        else:
+            self._size += size
+            if self._size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        '''Remove the least recently used entries until the cache fits in
+        EVICT_TARGET of max_size, so that the next writes do not scan it again'''
+        entries = []
+        for entry in os.scandir(self.path):
+            # Subdirectories are the caches of other servers, which evict their own entries
+            if entry.name.endswith('.tmp') or not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size * EVICT_TARGET:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self._size = total
+
+    def clear(self):
+        '''Remove all the entries, also the ones of the caches of other servers'''
+        for entry in os.scandir(self.path):
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+        self._size = 0
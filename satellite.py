@@ -0,0 +1,138 @@
+# Local cache of the EUMETSAT satellite imagery shown on the maps
+import glob
+import os
+import re
+import time
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import requests
+import instrument
+
+WMS_URL = 'https://view.eumetsat.int/geoserver/wms'
+WMS_LAYER = 'msg_fes:rgb_eview'
+# Domain downloaded at once, so that all the projections inside it needing the
+# same or a coarser resolution share the same image
+DOMAIN = [-18, 40, 30, 70]
+# Largest image of the whole domain: finer resolutions (e.g. the Italy maps) only
+# download the extents needed, which costs a second, much smaller, download
+# instead of a domain image several times larger
+MAX_DOMAIN_PIXELS = 4e6
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'meteonetwork', 'satellite')
+
+
+def imagery_slot(interval=15, delay=5, now=None):
+    '''Return the time of the latest satellite image (UTC), assuming a new image
+    every interval minutes available delay minutes later'''
+    now = (now or datetime.now(timezone.utc)) - timedelta(minutes=delay)
+    return now.replace(minute=now.minute - now.minute % interval, second=0, microsecond=0)
+
+
+def covers(outer, inner):
+    '''Whether the extents outer contain the extents inner'''
+    return (outer[0] <= inner[0] and inner[1] <= outer[1] and
+            outer[2] <= inner[2] and inner[3] <= outer[3])
+
+
+@instrument.stage('wms_download')
+def download_image(extent, resolution, url=None, layer=WMS_LAYER, timeout=(5, 30)):
+    '''Download the satellite image of the extents [lon_min, lon_max, lat_min, lat_max]
+    with resolution pixels per degree from the WMS server at url (by default the
+    EUMETSAT one or the one defined in MNW_WMS_URL). Returns the png content.'''
+    url = url or os.environ.get('MNW_WMS_URL', WMS_URL)
+    lon_min, lon_max, lat_min, lat_max = extent
+    params = {
+        'service': 'WMS',
+        'version': '1.1.1',
+        'request': 'GetMap',
+        'layers': layer,
+        'styles': '',
+        'srs': 'EPSG:4326',
+        'bbox': '%s,%s,%s,%s' % (lon_min, lat_min, lon_max, lat_max),
+        'width': int(round((lon_max - lon_min) * resolution)),
+        'height': int(round((lat_max - lat_min) * resolution)),
+        'format': 'image/png',
+    }
+    response = requests.get(url, params=params, timeout=timeout)
+    response.raise_for_status()
+    if not response.headers.get('Content-Type', '').startswith('image/'):
+        raise ValueError('The WMS server did not return an image: %s' % response.text[:200])
+    instrument.add(bytes=len(response.content))
+
+    return response.content
+
+
+def get_satellite_image(extent, width, height, max_resolution=100, max_age=1800,
+                        url=None, layer=WMS_LAYER, cache_dir=None):
+    '''Return the latest satellite image covering extents [lon_min, lon_max, lat_min, lat_max]
+    to be shown on width x height pixels, together with its exact extents.
+    Images are saved in ~/.cache/meteonetwork/satellite (or MNW_SATELLITE_DIR) and
+    downloaded again only when a new image should be available. A cached image is
+    reused, by cropping it, for every extents it contains with enough resolution:
+    the image of DOMAIN serves all the maps inside it at most as fine as the first
+    one, while finer maps download their own extents.
+    If the new image cannot be downloaded (not yet published, slow server...)
+    the newest cached one covering the extents is used instead.
+    max_resolution (pixels per degree, about the 1 km of the finest channels) avoids
+    downloading more than the imagery has: the maps need less, about 80 for Italy
+    and 20 for Europe. Images older than max_age seconds are removed.'''
+    from matplotlib.image import imread
+
+    cache_dir = cache_dir or os.environ.get('MNW_SATELLITE_DIR', CACHE_PATH)
+    os.makedirs(cache_dir, exist_ok=True)
+    slot = imagery_slot().strftime('%Y%m%d%H%M')
+    layer_key = re.sub('[^A-Za-z0-9]', '-', layer)
+    resolution = min(max(width / (extent[1] - extent[0]), height / (extent[3] - extent[2])),
+                     max_resolution)
+
+    image = None
+    fallback = None
+    for filename in sorted(glob.glob(os.path.join(cache_dir, '*.png')), reverse=True):
+        name = os.path.basename(filename)[:-4].split('_')
+        if time.time() - os.path.getmtime(filename) > max_age:
+            os.remove(filename)
+            continue
+        image_extent = [float(e) for e in name[2:6]]
+        if name[1] != layer_key or not covers(image_extent, extent):
+            continue
+        if name[0] == slot and float(name[6]) >= resolution:
+            image = filename
+            break
+        # File names start with the slot, so the first one is the newest
+        if fallback is None:
+            fallback = filename, image_extent
+
+    if image is None:
+        image_extent = list(extent)
+        domain_pixels = (DOMAIN[1] - DOMAIN[0]) * (DOMAIN[3] - DOMAIN[2]) * resolution ** 2
+        if covers(DOMAIN, extent) and domain_pixels <= MAX_DOMAIN_PIXELS:
+            image_extent = DOMAIN
+        # Never below the required resolution, which would prevent any reuse
+        image_resolution = np.ceil(resolution * 100) / 100
+        try:
+            content = download_image(image_extent, image_resolution, url=url, layer=layer)
+        except Exception as e:
+            if fallback is None:
+                raise
+            image, image_extent = fallback
+            print('Could not download the satellite image (%s), using %s' % (e, os.path.basename(image)))
+        else:
+            image = os.path.join(cache_dir, '%s_%s_%s_%s_%s_%s_%s.png' % (
+                slot, layer_key, *image_extent, image_resolution))
+            tmp_image = '%s.%d.tmp' % (image, os.getpid())
+            with open(tmp_image, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_image, image)
+
+    img = imread(image)
+    # Crop to the pixels containing the requested extents
+    rows, cols = img.shape[:2]
+    lon_res = cols / (image_extent[1] - image_extent[0])
+    lat_res = rows / (image_extent[3] - image_extent[2])
+    col_min = int(np.floor((extent[0] - image_extent[0]) * lon_res))
+    col_max = int(np.ceil((extent[1] - image_extent[0]) * lon_res))
+    row_min = int(np.floor((image_extent[3] - extent[3]) * lat_res))
+    row_max = int(np.ceil((image_extent[3] - extent[2]) * lat_res))
+    crop_extent = [image_extent[0] + col_min / lon_res, image_extent[0] + col_max / lon_res,
+                   image_extent[3] - row_max / lat_res, image_extent[3] - row_min / lat_res]
+
+    return img[row_min:row_max, col_min:col_max], crop_extent
@@ -0,0 +1,121 @@
+# Local spatial index of the meteonetwork stations
+import importlib
+import numpy as np
+
+EARTH_RADIUS = 6371.
+# Indexes already built by StationIndex.from_api
+index_cache = {}
+# Number of distances computed at once by the search without scipy
+BRUTE_FORCE_CHUNK_SIZE = 1 << 20
+
+
+def to_xyz(lats, lons):
+    '''Convert latitudes and longitudes (degrees) to cartesian coordinates (km)
+    on the sphere, where euclidean distances are chords between the points'''
+    lats = np.deg2rad(np.asarray(lats, dtype=float))
+    lons = np.deg2rad(np.asarray(lons, dtype=float))
+    cos_lats = np.cos(lats)
+
+    return EARTH_RADIUS * np.stack([cos_lats * np.cos(lons), cos_lats * np.sin(lons),
+                                    np.sin(lats)], axis=-1)
+
+
+def chord_to_km(chord):
+    '''Convert a chord length to the distance along the surface (km)'''
+    return 2 * EARTH_RADIUS * np.arcsin(np.clip(chord / (2 * EARTH_RADIUS), 0, 1))
+
+
+def km_to_chord(km):
+    '''Convert a distance along the surface (km) to the chord length'''
+    return 2 * EARTH_RADIUS * np.sin(np.minimum(km, np.pi * EARTH_RADIUS) / (2 * EARTH_RADIUS))
+
+
+class StationIndex():
+    def __init__(self, meta):
+        '''Index the stations in meta, a DataFrame with at least station_code,
+        latitude and longitude (e.g. from MNWApi.get_stations_meta), to answer
+        spatial queries without asking the server.
+        Queries return positions in meta, use meta.iloc[...] to get the stations.
+        A KD-tree is used if scipy is available, otherwise a brute force search.'''
+        meta = meta[meta['latitude'].notna() & meta['longitude'].notna()]
+        self.meta = meta.reset_index(drop=True)
+        self.lats = self.meta['latitude'].to_numpy(dtype=float)
+        self.lons = self.meta['longitude'].to_numpy(dtype=float)
+        self.xyz = to_xyz(self.lats, self.lons)
+        if importlib.util.find_spec("scipy") is not None:
+            from scipy.spatial import cKDTree
+            self.tree = cKDTree(self.xyz)
+        else:
+            self.tree = None
+
+    @classmethod
+    def from_api(cls, mnw=None, **kwargs):
+        '''Build the index of the stations returned by get_stations_meta(**kwargs).
+        The metadata is cached on disk by MNWApi and the index in memory.'''
+        key = tuple(sorted(kwargs.items()))
+        if key not in index_cache:
+            if mnw is None:
+                from api import MNWApi
+                mnw = MNWApi()
+            index_cache[key] = cls(mnw.get_stations_meta(**kwargs))
+        return index_cache[key]
+
+    def nearest(self, lat, lon, n=1):
+        '''Return the positions of the n nearest stations to the point(s) lat, lon
+        and their distances in km, sorted by distance. With arrays of points
+        the results have one row per point.'''
+        points = to_xyz(lat, lon)
+        n = min(n, len(self.xyz))
+        if self.tree is not None:
+            chords, indices = self.tree.query(points, k=n)
+            if n == 1:
+                chords, indices = np.asarray(chords)[..., np.newaxis], np.asarray(indices)[..., np.newaxis]
+        else:
+            shape = points.shape[:-1]
+            points = points.reshape(-1, 3)
+            indices = np.empty((len(points), n), dtype=int)
+            chords = np.empty((len(points), n))
+            # Points are searched in chunks, so that the distance matrix stays
+            # within about BRUTE_FORCE_CHUNK_SIZE values
+            step = max(1, BRUTE_FORCE_CHUNK_SIZE // max(1, len(self.xyz)))
+            for start in range(0, len(points), step):
+                chunk = slice(start, start + step)
+                distances = np.linalg.norm(points[chunk, np.newaxis, :] - self.xyz, axis=-1)
+                nearest = np.argpartition(distances, n - 1, axis=-1)[:, :n]
+                distances = np.take_along_axis(distances, nearest, axis=-1)
+                order = np.argsort(distances, axis=-1)
+                indices[chunk] = np.take_along_axis(nearest, order, axis=-1)
+                chords[chunk] = np.take_along_axis(distances, order, axis=-1)
+            indices = indices.reshape(shape + (n,))
+            chords = chords.reshape(shape + (n,))
+
+        return indices, chord_to_km(chords)
+
+    def within_radius(self, lat, lon, range_km):
+        '''Return the positions of the stations within range_km of the point lat, lon
+        and their distances in km, sorted by distance'''
+        point = to_xyz(lat, lon)
+        if self.tree is not None:
+            indices = np.asarray(self.tree.query_ball_point(point, km_to_chord(range_km)), dtype=int)
+        else:
+            indices = np.flatnonzero(np.linalg.norm(self.xyz - point, axis=-1) <= km_to_chord(range_km))
+        distances = chord_to_km(np.linalg.norm(self.xyz[indices] - point, axis=-1))
+        order = np.argsort(distances)
+
+        return indices[order], distances[order]
+
+    def within_bbox(self, lon_min, lon_max, lat_min, lat_max):
+        '''Return the positions of the stations inside a lat/lon box'''
+        return np.flatnonzero((lon_min <= self.lons) & (self.lons <= lon_max) &
+                              (lat_min <= self.lats) & (self.lats <= lat_max))
+
+    def join(self, data, columns=None):
+        '''Add to data (e.g. from get_realtime_stations or get_daily_stations) the
+        metadata of its stations, matched by station_code. columns selects
+        the metadata to add, all by default.'''
+        meta = self.meta if columns is None else self.meta[['station_code'] + list(columns)]
+        meta = meta.astype({'station_code': str})
+
+        return data.merge(meta, how='left', suffixes=('', '_meta'),
+                          left_on=data['station_code'].astype(str), right_on='station_code') \
+            .drop(columns=['key_0', 'station_code_meta'], errors='ignore')
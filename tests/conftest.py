@@ -0,0 +1,59 @@
+# The modules are not installed: tests import them from the repository and
+# use the synthetic answers of the benchmarks
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import matplotlib
+matplotlib.use('agg')
+
+
+class FakeResponse():
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.text = content.decode()
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            import requests
+            raise requests.HTTPError('%d error' % self.status_code, response=self)
+
+
+class FakeSession():
+    '''Stand-in of the session of MNWApi, answering every request with the
+    content returned by answer(endpoint, params), which can also raise'''
+    def __init__(self, answer):
+        self.answer = answer
+        self.requests = []
+
+    def request(self, method, url, params=None, **kwargs):
+        import api
+
+        endpoint = url[len(api.API_URL) + 1:]
+        params = dict(params or {})
+        # list.append is atomic, requests come from many threads
+        self.requests.append((endpoint, params))
+        return FakeResponse(self.answer(endpoint, params))
+
+    def close(self):
+        pass
+
+
+def stub_api(monkeypatch, tmp_path, answer):
+    '''Make every MNWApi created afterwards download from answer (see FakeSession)
+    with tokens, cache and token store kept in tmp_path. Returns the session.'''
+    import api
+
+    session = FakeSession(answer)
+    monkeypatch.setattr(api.MNWApi, 'create_session', lambda self, **kwargs: session)
+    monkeypatch.delenv('MNW_API_URL', raising=False)
+    monkeypatch.setenv('MNW_TOKEN', 'token')
+    monkeypatch.setenv('MNW_BULK_TOKEN', 'bulk-token')
+    monkeypatch.setenv('MNW_TOKEN_CACHE', str(tmp_path / 'tokens.json'))
+    monkeypatch.setenv('MNW_CACHE_DIR', str(tmp_path / 'responses'))
+
+    return session
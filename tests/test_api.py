@@ -0,0 +1,112 @@
+# Downloads of the archive through the api
+import threading
+import pandas as pd
+import api
+from api import MNWApi
+from conftest import stub_api
+from parsing import parse_records
+import synthetic
+
+STATIONS = ['s%d' % i for i in range(10)]
+
+
+def archive_answer(failing=()):
+    '''Answer of the archive of every station and day, failing for the (station, day) in failing'''
+    def answer(endpoint, params):
+        station_code = endpoint.split('/')[-1]
+        if (station_code, params['observation_date']) in failing:
+            raise ConnectionError('No answer')
+        return synthetic.payload(synthetic.realtime_frame(2).drop(columns='station_code'))
+    return answer
+
+
+def requested(session):
+    return sorted((endpoint.split('/')[-1], params['observation_date']) for endpoint, params in session.requests)
+
+
+def pairs(stations, dates):
+    return sorted((station_code, observation_date) for station_code in stations for observation_date in dates)
+
+
+DATES = ['2020-01-%02d' % day for day in range(1, 6)]
+
+
+def test_windows_of_pending_downloads(tmp_path, monkeypatch):
+    session = stub_api(monkeypatch, tmp_path, archive_answer())
+    pending = []
+    wait = api.wait
+
+    def record(futures, **kwargs):
+        pending.append(len(futures))
+        return wait(futures, **kwargs)
+
+    monkeypatch.setattr(api, 'wait', record)
+    data, failed = MNWApi(cache=False).get_archive_range(STATIONS, '2020-01-01', '2020-01-05', max_workers=2)
+    assert failed == []
+    assert requested(session) == pairs(STATIONS, DATES)
+    assert len(data) == 2 * 50 and set(data['station_code']) == set(STATIONS)
+    # Never more than 4 station/days per worker at a time, refilled as they complete
+    assert max(pending) == 8 and len(pending) > 50 // 8
+
+
+def test_failed_days_do_not_stop_the_download(tmp_path, monkeypatch, capsys):
+    failing = {('s3', '2020-01-02'), ('s7', '2020-01-05')}
+    session = stub_api(monkeypatch, tmp_path, archive_answer(failing))
+    data, failed = MNWApi(cache=False).get_archive_range(STATIONS, '2020-01-01', '2020-01-05', max_workers=4)
+    assert sorted((station_code, observation_date) for station_code, observation_date, e in failed) == sorted(failing)
+    assert all(isinstance(e, ConnectionError) for station_code, observation_date, e in failed)
+    assert requested(session) == pairs(STATIONS, DATES)
+    assert len(data) == 2 * 48
+    assert 'Could not get 2 out of 50 station/days' in capsys.readouterr().out
+
+
+def test_callback(tmp_path, monkeypatch):
+    stub_api(monkeypatch, tmp_path, archive_answer())
+    received = []
+    lock = threading.Lock()
+
+    def callback(station_code, observation_date, data):
+        if (station_code, observation_date) == ('s1', '2020-01-01'):
+            raise OSError('Disk full')
+        with lock:
+            received.append((station_code, observation_date, len(data)))
+
+    data, failed = MNWApi(cache=False).get_archive_range(STATIONS[:2], '2020-01-01', '2020-01-02',
+                                                         callback=callback)
+    assert data is None
+    assert [(station_code, observation_date) for station_code, observation_date, e in failed] == [
+        ('s1', '2020-01-01')]
+    assert sorted(received) == [('s0', '2020-01-01', 2), ('s0', '2020-01-02', 2), ('s1', '2020-01-02', 2)]
+
+
+def test_resumed_from_the_checkpoints(tmp_path, monkeypatch):
+    checkpoint_dir = str(tmp_path / 'checkpoints')
+    session = stub_api(monkeypatch, tmp_path, archive_answer({('s3', '2020-01-02')}))
+    mnw = MNWApi(cache=False)
+    first, failed = mnw.get_archive_range(STATIONS, '2020-01-01', '2020-01-05', checkpoint_dir=checkpoint_dir)
+    assert len(failed) == 1
+    assert len(list((tmp_path / 'checkpoints').iterdir())) == 49
+
+    session.answer = archive_answer()
+    session.requests.clear()
+    data, failed = mnw.get_archive_range(STATIONS, '2020-01-01', '2020-01-05', checkpoint_dir=checkpoint_dir)
+    assert failed == []
+    # Only the missing station/day is downloaded again
+    assert requested(session) == [('s3', '2020-01-02')]
+    assert len(data) == 2 * 50
+    chunk = pd.read_pickle(tmp_path / 'checkpoints' / 's0_2020-01-01.pkl')
+    assert len(chunk) == 2 and (chunk['station_code'] == 's0').all()
+    assert len(first) == 2 * 49
+
+
+def test_skipped_days(tmp_path, monkeypatch):
+    session = stub_api(monkeypatch, tmp_path, archive_answer())
+    skip = set(pairs(STATIONS[:5], DATES))
+    data, failed = MNWApi(cache=False).get_archive_range(STATIONS, '2020-01-01', '2020-01-05', skip=skip)
+    assert failed == []
+    assert requested(session) == pairs(STATIONS[5:], DATES)
+    assert set(data['station_code']) == set(STATIONS[5:])
+    # Nothing left to download
+    session.requests.clear()
+    data, failed = MNWApi(cache=False).get_archive_range(STATIONS[:5], '2020-01-01', '2020-01-05', skip=skip)
+    assert session.requests == [] and data.empty and failed == []
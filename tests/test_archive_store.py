@@ -0,0 +1,138 @@
+# Local partitioned store of the historical data
+import os
+from datetime import datetime
+import pandas as pd
+from api import MNWApi
+from conftest import stub_api
+from archive_store import ArchiveStore, EMPTY_MARKER, PROVISIONAL_MARKER
+from parsing import parse_records
+import synthetic
+
+
+class FakeApi():
+    '''Answers of the api without the server, counting the requests'''
+    get_archive_range = MNWApi.get_archive_range
+
+    def __init__(self, empty=(), failing=()):
+        self.requests = []
+        self.empty = empty
+        self.failing = failing
+
+    def get_daily_stations(self, observation_date, **kwargs):
+        self.requests.append(observation_date)
+        if observation_date in self.failing:
+            raise ConnectionError('No answer')
+        if observation_date in self.empty:
+            return pd.DataFrame()
+        data = synthetic.daily_frame(20, seed=int(observation_date[-2:]))
+        data['observation_date'] = observation_date
+        return parse_records(synthetic.payload(data), 'data-daily')
+
+    def get_archive_station(self, station_code, observation_date, data_quality=True, columns=None):
+        self.requests.append((station_code, observation_date))
+        if (station_code, observation_date) in self.failing:
+            raise ConnectionError('No answer')
+        data = synthetic.realtime_frame(3).drop(columns='station_code')
+        return parse_records(synthetic.payload(data), 'data-archive')
+
+
+def test_daily_backfill_is_incremental(tmp_path):
+    mnw = FakeApi(empty=['2020-01-02'])
+    store = ArchiveStore(str(tmp_path), mnw=mnw)
+    assert store.backfill('daily', '2020-01-01', '2020-01-03', max_workers=2) == []
+    assert store.partitions('daily') == {'2020-01-01', '2020-01-02', '2020-01-03'}
+    assert os.path.exists(os.path.join(store.partition_path('daily', '2020-01-02'), EMPTY_MARKER))
+
+    mnw.requests = []
+    store.backfill('daily', '2020-01-01', '2020-01-04')
+    assert mnw.requests == ['2020-01-04']
+
+
+def test_failed_days_are_reported_and_retried(tmp_path):
+    mnw = FakeApi(failing=['2020-01-02'])
+    store = ArchiveStore(str(tmp_path), mnw=mnw)
+    failed = store.backfill('daily', '2020-01-01', '2020-01-03')
+    assert [observation_date for observation_date, e in failed] == ['2020-01-02']
+    mnw.failing = ()
+    mnw.requests = []
+    assert store.backfill('daily', '2020-01-01', '2020-01-03') == []
+    assert mnw.requests == ['2020-01-02']
+
+
+def test_recent_days_are_provisional(tmp_path):
+    mnw = FakeApi()
+    store = ArchiveStore(str(tmp_path), mnw=mnw)
+    today = datetime.now().strftime('%Y-%m-%d')
+    store.backfill('daily', today, today)
+    assert os.path.exists(os.path.join(store.partition_path('daily', today), PROVISIONAL_MARKER))
+    assert store.partitions('daily') == set()
+
+    # Downloaded again and replaced by the next backfill
+    store.backfill('daily', today, today)
+    assert mnw.requests == [today, today]
+    assert len(store.query('daily', today, today)) == 20
+    assert not [name for name in os.listdir(os.path.join(tmp_path, 'daily')) if name.startswith('.')]
+
+
+def test_query(tmp_path):
+    store = ArchiveStore(str(tmp_path), mnw=FakeApi())
+    store.backfill('daily', '2020-01-01', '2020-01-03')
+    data = store.query('daily', '2020-01-02', '2020-01-03', columns=['station_code', 't_max', 'date'])
+    assert len(data) == 40
+    assert list(data.columns) == ['station_code', 't_max', 'date']
+    assert set(data['date']) == {'2020-01-02', '2020-01-03'}
+
+    stations = store.query('daily', stations=['st000001', 'st000002'])
+    assert set(stations['station_code'].astype(str)) == {'st000001', 'st000002'}
+    assert len(stations) == 6
+    filtered = store.query('daily', filters=[('t_max', '>', 30.)])
+    assert (filtered['t_max'] > 30).all()
+    bbox = store.query('daily', bbox=[9, 12, 44, 46])
+    assert bbox['longitude'].between(9, 12).all() and bbox['latitude'].between(44, 46).all()
+
+    statistics = store.station_statistics('daily', 't_max')
+    assert (statistics['count'] == 3).all()
+
+
+def test_query_of_an_empty_store(tmp_path):
+    assert ArchiveStore(str(tmp_path)).query('daily', columns=['t_max']).empty
+
+
+def test_archive_backfill(tmp_path):
+    mnw = FakeApi(failing=[('b', '2020-01-02')])
+    store = ArchiveStore(str(tmp_path), mnw=mnw)
+    failed = store.backfill('archive', '2020-01-01', '2020-01-02', stations=['a', 'b'], max_workers=2)
+    assert [(station_code, observation_date) for station_code, observation_date, e in failed] == [('b', '2020-01-02')]
+    assert store.partitions('archive') == {('a', '2020-01-01'), ('a', '2020-01-02'), ('b', '2020-01-01')}
+
+    mnw.failing = ()
+    mnw.requests = []
+    assert store.backfill('archive', '2020-01-01', '2020-01-02', stations=['a', 'b']) == []
+    assert mnw.requests == [('b', '2020-01-02')]
+    data = store.query('archive', stations=['b'])
+    assert len(data) == 6 and set(data['station']) == {'b'}
+
+
+def test_settled_days_are_downloaded_again_from_the_server(tmp_path, monkeypatch):
+    stations = {'count': 20}
+
+    def answer(endpoint, params):
+        data = synthetic.daily_frame(stations['count'])
+        data['observation_date'] = params['observation_date']
+        return synthetic.payload(data)
+
+    session = stub_api(monkeypatch, tmp_path, answer)
+    # The day is not settled yet
+    store = ArchiveStore(str(tmp_path / 'archive'), settle_time=10 ** 10)
+    store.backfill('daily', '2020-01-01', '2020-01-01')
+    assert len(store.query('daily')) == 20
+
+    # Late uploads arrived, and the day is settled now
+    stations['count'] = 30
+    store.settle_time = 0
+    assert store.backfill('daily', '2020-01-01', '2020-01-01') == []
+    assert [endpoint for endpoint, params in session.requests] == ['data-daily', 'data-daily']
+    assert len(store.query('daily')) == 30
+    assert store.partitions('daily') == {'2020-01-01'}
+    # The answers are not kept a second time in the response cache
+    assert not os.path.exists(tmp_path / 'responses') or not os.listdir(tmp_path / 'responses')
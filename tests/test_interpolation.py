@@ -0,0 +1,72 @@
+# Interpolation of the station values on regular grids
+import numpy as np
+import pandas as pd
+import pytest
+import interpolation
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(interpolation, 'weights_cache', interpolation.OrderedDict())
+
+
+def snapshot(seed=0):
+    '''Stations on the nodes of a 0.5 degrees grid over the north of Italy, and between them'''
+    lons, lats = np.meshgrid(np.arange(7, 14, 0.5), np.arange(44, 47, 0.5))
+    rng = np.random.default_rng(0)
+    lons = np.concatenate([lons.ravel(), rng.uniform(7, 13.5, 100)])
+    lats = np.concatenate([lats.ravel(), rng.uniform(44, 46.5, 100)])
+    values = np.random.default_rng(seed).normal(20, 5, len(lons))
+    return pd.DataFrame({'station_code': ['s%d' % i for i in range(len(lons))],
+                         'latitude': lats, 'longitude': lons, 'temperature': values})
+
+
+def test_idw_is_exact_at_the_stations():
+    data = snapshot()
+    lons, lats, grid = interpolation.interpolate(data, 'temperature', [7, 13.5, 44, 46.5], resolution=0.5)
+    assert grid.shape == (len(lats), len(lons)) == (6, 14)
+    on_grid = data.iloc[:84]
+    rows = np.round((on_grid['latitude'] - 44) / 0.5).astype(int)
+    cols = np.round((on_grid['longitude'] - 7) / 0.5).astype(int)
+    np.testing.assert_allclose(grid[rows, cols], on_grid['temperature'], rtol=1e-4)
+
+
+def test_values_between_the_stations():
+    data = snapshot()
+    for method in ['idw', 'barnes']:
+        lons, lats, grid = interpolation.interpolate(data, 'temperature', [7, 13.5, 44, 46.5],
+                                                     resolution=0.1, method=method)
+        assert np.isfinite(grid).all()
+        assert data['temperature'].min() <= grid.min() and grid.max() <= data['temperature'].max()
+
+
+def test_missing_values_and_far_points():
+    data = snapshot()
+    data.loc[0, 'temperature'] = np.nan
+    lons, lats, grid = interpolation.interpolate(data, 'temperature', [5, 13.5, 44, 46.5], resolution=0.5,
+                                                 max_distance=60.)
+    # Renormalised over the other stations
+    assert np.isfinite(grid[0, 4])
+    # Too far from every station
+    assert np.isnan(grid[:, 0]).all()
+
+
+def test_weights_are_reused():
+    extent = [7, 13.5, 44, 46.5]
+    weights = interpolation.get_weights(snapshot(), extent)
+    # Another snapshot of the same stations
+    later = snapshot(seed=1)
+    assert interpolation.get_weights(later, extent) is weights
+    np.testing.assert_allclose(weights.interpolate(later, 'temperature'),
+                               interpolation.InterpolationWeights(weights.index, extent).interpolate(
+                                   later, 'temperature'))
+    assert interpolation.get_weights(snapshot(), extent, method='barnes') is not weights
+    moved = snapshot()
+    moved.loc[0, 'latitude'] += 0.1
+    assert interpolation.get_weights(moved, extent) is not weights
+    assert len(interpolation.weights_cache) == 3
+
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        interpolation.get_weights(snapshot(), [7, 13.5, 44, 46.5], method='kriging')
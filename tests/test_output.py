@@ -0,0 +1,65 @@
+# Encoding of the rendered maps
+import numpy as np
+import pytest
+import matplotlib
+matplotlib.use('agg')
+import matplotlib.pyplot as plt
+from PIL import Image
+import output
+
+
+def figure(outside=False):
+    fig = plt.figure(figsize=(6, 4), facecolor='lightblue')
+    ax = fig.add_axes([0.2, 0.2, 0.6, 0.6])
+    mesh = ax.pcolormesh(np.arange(100).reshape(10, 10))
+    fig.colorbar(mesh, ax=ax)
+    ax.set_title('A title')
+    # Within the padding of the edges of the figure
+    fig.text(0.005, 0.01, 'Credits')
+    if outside:
+        fig.text(0.5, 1.05, 'Beyond the top of the figure', fontsize=20)
+    return fig
+
+
+def read(filename):
+    return np.asarray(Image.open(filename).convert('RGB'), dtype=int)
+
+
+@pytest.mark.parametrize('dpi', [72, 100, 150])
+def test_crop_matches_savefig(tmp_path, dpi):
+    fig = figure()
+    fig.savefig(tmp_path / 'expected.png', dpi=dpi, bbox_inches='tight', pad_inches=0.1)
+    assert output.save_figure(fig, str(tmp_path / 'map.png'), dpi=dpi) == [str(tmp_path / 'map.png')]
+    plt.close(fig)
+
+    expected, pixels = read(tmp_path / 'expected.png'), read(tmp_path / 'map.png')
+    assert pixels.shape == expected.shape
+    # savefig shifts the drawing by a fraction of a pixel, only antialiasing differs
+    assert np.abs(pixels - expected).max(axis=2).mean() < 4
+
+
+def test_artists_beyond_the_figure_are_saved(tmp_path, monkeypatch):
+    fig = figure(outside=True)
+    fig.savefig(tmp_path / 'expected.png', dpi=100, bbox_inches='tight', pad_inches=0.1)
+    savefig = fig.savefig
+    calls = []
+    monkeypatch.setattr(fig, 'savefig', lambda *args, **kwargs: calls.append(1) or savefig(*args, **kwargs))
+    output.save_figure(fig, str(tmp_path / 'map.png'))
+    plt.close(fig)
+    # Drawn again, since they are not in the pixels of the canvas
+    assert calls == [1]
+    np.testing.assert_array_equal(read(tmp_path / 'map.png'), read(tmp_path / 'expected.png'))
+
+
+def test_other_formats(tmp_path, monkeypatch):
+    monkeypatch.setenv('MNW_OUTPUT_FORMATS', 'webp, png')
+    fig = figure()
+    filenames = output.save_figure(fig, str(tmp_path / 'map.png'), palette=True)
+    assert filenames == [str(tmp_path / 'map.png'), str(tmp_path / 'map.webp')]
+    png, webp = Image.open(filenames[0]), Image.open(filenames[1])
+    assert png.mode == 'P' and webp.format == 'WEBP' and png.size == webp.size
+    # Unknown to Pillow: drawn by savefig
+    assert output.save_figure(fig, str(tmp_path / 'map.pdf'), formats=[]) == [str(tmp_path / 'map.pdf')]
+    assert (tmp_path / 'map.pdf').read_bytes().startswith(b'%PDF')
+    plt.close(fig)
+    assert sorted(f.name for f in tmp_path.iterdir()) == ['map.pdf', 'map.png', 'map.webp']
@@ -0,0 +1,50 @@
+# Parsing of the api answers with the typed schema
+import io
+import numpy as np
+import pandas as pd
+from parsing import parse_records
+import synthetic
+
+
+def test_same_values_as_read_json():
+    content = synthetic.payload(synthetic.realtime_frame(500))
+    data = parse_records(content, 'data-realtime')
+    reference = pd.read_json(io.BytesIO(content))
+    assert list(data.columns) == list(reference.columns)
+    for column in ['temperature', 'smlp', 'rh', 'daily_rain', 'latitude', 'longitude']:
+        np.testing.assert_allclose(data[column].to_numpy(dtype=float),
+                                   reference[column].to_numpy(dtype=float), rtol=1e-6)
+    assert (data['station_code'].astype(str) == reference['station_code'].astype(str)).all()
+    assert (data['observation_time_local'] == pd.to_datetime(reference['observation_time_local'])).all()
+
+
+def test_types():
+    data = parse_records(synthetic.payload(synthetic.daily_frame(50)), 'data-daily')
+    assert data['t_max'].dtype == np.float32
+    assert data['latitude'].dtype == np.float64
+    assert isinstance(data['station_code'].dtype, pd.CategoricalDtype)
+    assert pd.api.types.is_datetime64_dtype(data['observation_date'])
+    assert data['rain'].isna().any()
+
+
+def test_missing_and_invalid_values():
+    content = b'[{"station_code": "a", "temperature": 12.5, "smlp": ""},' \
+              b' {"station_code": "b", "temperature": null, "rh": 50}]'
+    data = parse_records(content, 'data-realtime')
+    # Keys that only some records have are added at the end
+    assert list(data.columns) == ['station_code', 'temperature', 'smlp', 'rh']
+    assert np.isnan(data['temperature'][1])
+    assert data['smlp'].isna().all()
+    assert np.isnan(data['rh'][0]) and data['rh'][1] == 50
+
+
+def test_columns():
+    content = synthetic.payload(synthetic.realtime_frame(10))
+    data = parse_records(content, 'data-realtime', columns=['station_code', 'temperature'])
+    assert list(data.columns) == ['station_code', 'temperature']
+
+
+def test_single_record_and_empty_answer():
+    data = parse_records(b'{"station_code": "a", "t_max": 30}', 'data-daily/a')
+    assert len(data) == 1 and data['t_max'].dtype == np.float32
+    assert parse_records(b'[]', 'data-realtime', columns=['temperature']).empty
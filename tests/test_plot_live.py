@@ -0,0 +1,103 @@
+# Rendering of the live products
+import os
+from collections import Counter
+import pytest
+from conftest import ROOT
+from parsing import parse_records
+import output
+import plot_live
+import synthetic
+import utils
+
+
+@pytest.fixture(autouse=True)
+def environment(tmp_path, monkeypatch):
+    '''Maps on the background image, caches in tmp_path and the data of a synthetic network'''
+    # The logos and the background are read from the repository
+    monkeypatch.chdir(ROOT)
+    monkeypatch.setattr(utils, 'has_cartopy', lambda: False)
+    for name in ['MNW_SELECTION_DIR', 'MNW_SNAPSHOT_DIR', 'MNW_TEMPLATE_DIR']:
+        monkeypatch.setenv(name, str(tmp_path / name))
+    monkeypatch.setattr(plot_live, 'keep_figures', False)
+    monkeypatch.setattr(plot_live, 'figures', {})
+    data = parse_records(synthetic.payload(synthetic.realtime_frame(500)), 'data-realtime')
+    monkeypatch.setattr(plot_live, 'fetch_data', lambda projection='italy': data)
+
+
+@pytest.fixture
+def saved(monkeypatch):
+    '''Artists of every figure saved, by file name'''
+    artists = {}
+    save_figure = output.save_figure
+
+    def record(fig, plot_filename, *args, **kwargs):
+        artists[os.path.basename(plot_filename)] = (
+            len(fig.axes), Counter(type(child).__name__ for ax in fig.axes for child in ax.get_children()))
+        return save_figure(fig, plot_filename, *args, **kwargs)
+
+    monkeypatch.setattr(output, 'save_figure', record)
+    return artists
+
+
+def jobs(tmp_path, *plot_types):
+    return [(plot_type, 'italy', str(tmp_path / ('%s.png' % plot_type))) for plot_type in plot_types]
+
+
+def test_failed_products_leave_nothing_behind(tmp_path, monkeypatch, saved):
+    assert plot_live.main_batch(jobs(tmp_path, 'humidity')) == []
+    expected = saved.pop('humidity.png')
+
+    add_hist_on_map = utils.add_hist_on_map
+    calls = []
+
+    def fail_once(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError('Broken histogram')
+        return add_hist_on_map(*args, **kwargs)
+
+    monkeypatch.setattr(utils, 'add_hist_on_map', fail_once)
+    failed = plot_live.main_batch(jobs(tmp_path, 'temperature', 'humidity'))
+    assert [job[0] for job in failed] == ['temperature']
+    assert saved['humidity.png'] == expected
+
+
+def test_failed_checks_do_not_stop_the_batch(tmp_path, monkeypatch):
+    check_data = plot_live.check_data
+    calls = []
+
+    def fail_once(key, data):
+        calls.append(key)
+        if len(calls) == 1:
+            raise RuntimeError('Broken snapshot')
+        return check_data(key, data)
+
+    monkeypatch.setattr(plot_live, 'check_data', fail_once)
+    failed = plot_live.main_batch(jobs(tmp_path, 'temperature', 'humidity', 'rain'), workers=2)
+    assert [job[0] for job in failed] == ['temperature']
+    assert os.path.exists(tmp_path / 'humidity.png') and os.path.exists(tmp_path / 'rain.png')
+
+
+def test_reused_maps_keep_nothing_of_the_previous_products(tmp_path, monkeypatch, saved):
+    from PIL import Image
+    import numpy as np
+
+    # Barbs and histogram, barbs only, histogram only, rendered fresh and then on one reused map
+    products = ['gust', 'synoptic', 'temperature', 'humidity']
+    (tmp_path / 'fresh').mkdir()
+    for plot_type in products:
+        assert plot_live.main_batch(jobs(tmp_path / 'fresh', plot_type)) == []
+    fresh = dict(saved)
+
+    monkeypatch.setattr(plot_live, 'keep_figures', True)
+    (tmp_path / 'kept').mkdir()
+    saved.clear()
+    # The last gust map is drawn after all the others
+    assert plot_live.main_batch(jobs(tmp_path / 'kept', *products, 'gust')) == []
+    # A single map for all of them
+    assert len(plot_live.figures) == 1
+    assert saved == fresh
+    for plot_type in products:
+        filename = '%s.png' % plot_type
+        np.testing.assert_array_equal(np.asarray(Image.open(tmp_path / 'kept' / filename)),
+                                      np.asarray(Image.open(tmp_path / 'fresh' / filename)))
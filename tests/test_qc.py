@@ -0,0 +1,141 @@
+# Quality checks of the station snapshots
+import importlib
+import os
+import time
+import warnings
+import numpy as np
+import pandas as pd
+import pytest
+from parsing import parse_records
+import qc
+import stations
+import synthetic
+
+
+@pytest.fixture(autouse=True)
+def snapshot_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv('MNW_SNAPSHOT_DIR', str(tmp_path))
+    qc.neighbours_cache.clear()
+
+
+def realtime(num_stations=2000, seed=0):
+    return parse_records(synthetic.payload(synthetic.realtime_frame(num_stations, seed=seed)), 'data-realtime')
+
+
+def later(data, hours=1):
+    '''The same snapshot observed hours later'''
+    data = data.copy()
+    for column in ['observation_time_local', 'observation_time_utc']:
+        data[column] = data[column] + pd.Timedelta(hours=hours)
+    return data
+
+
+def test_range():
+    data = realtime()
+    data.loc[0, 'temperature'] = 70
+    data.loc[1, 'smlp'] = 0
+    flags = qc.check(data)
+    assert flags.loc[0, 'temperature'] & qc.RANGE
+    assert flags.loc[1, 'smlp'] & qc.RANGE
+    assert not qc.valid(flags, 'temperature')[0] and np.isnan(qc.masked(data, flags, 'smlp')[1])
+
+
+def test_buddy():
+    data = realtime()
+    # A station in the middle of the densest cluster
+    crowded = np.argmax(qc.neighbours(data['latitude'], data['longitude'])[:, -1] >= 0)
+    data.loc[crowded, 'temperature'] += 15
+    flags = qc.check(data, columns=['temperature'])
+    assert flags.loc[crowded, 'temperature'] == qc.BUDDY
+    # The synthetic network is smooth, only few of the others fail
+    assert (flags['temperature'] > 0).mean() < 0.01
+
+
+def test_altitude_is_taken_into_account():
+    data = realtime()
+    crowded = np.argmax(qc.neighbours(data['latitude'], data['longitude'])[:, -1] >= 0)
+    data['altitude'] = 0.
+    data.loc[crowded, 'altitude'] = 2000.
+    data.loc[crowded, 'temperature'] -= 13
+    assert qc.check(data, columns=['temperature']).loc[crowded, 'temperature'] == 0
+
+
+def test_spike_and_stuck():
+    before = realtime()
+    now = later(before)
+    rng = np.random.default_rng(0)
+    now['temperature'] += rng.uniform(2, 3, len(now)).astype(np.float32)
+    now.loc[0, 'temperature'] += 15
+    now.loc[1, 'temperature'] = before.loc[1, 'temperature']
+    flags = qc.check(now, previous=before, columns=['temperature'])
+    assert flags.loc[0, 'temperature'] & qc.SPIKE
+    assert flags.loc[1, 'temperature'] & qc.STUCK
+    assert qc.summary(flags).loc['temperature', 'spike'] == 1
+
+    # Not compared with snapshots too far apart
+    flags = qc.check(later(now, 12), previous=before, columns=['temperature'])
+    assert not (flags['temperature'] & qc.SPIKE).any()
+
+
+def test_stations_are_matched_by_code():
+    before = realtime()
+    now = later(before).iloc[::-1].reset_index(drop=True)
+    flags = qc.check(now, previous=before.iloc[:1000])
+    assert not (flags.to_numpy() & (qc.SPIKE | qc.STUCK)).any()
+
+
+def test_empty_snapshot():
+    flags = qc.check(realtime().iloc[:0])
+    assert flags.empty and 'temperature' in flags
+
+
+def test_row_median():
+    values = np.random.default_rng(0).normal(size=(500, 8))
+    values[values > 1] = np.nan
+    values[0] = np.nan
+    with warnings.catch_warnings():
+        # All NaN rows
+        warnings.simplefilter('ignore', RuntimeWarning)
+        expected = np.nanmedian(values, axis=1)
+    np.testing.assert_allclose(qc.row_median(values), expected)
+
+
+def test_neighbours():
+    lats = np.array([45., 45., 45.1, 45.2, 40.])
+    lons = np.array([9., 9., 9.1, 9.2, 15.])
+    indices = qc.neighbours(lats, lons, k=3, max_distance=50.)
+    # The station itself is left out, also when another one has the same position
+    assert (indices != np.arange(5)[:, np.newaxis]).all()
+    assert sorted(indices[0]) == [1, 2, 3]
+    assert (indices[4] == -1).all()
+
+
+def test_neighbours_without_scipy(monkeypatch):
+    data = realtime(3000)
+    lats, lons = data['latitude'].to_numpy(), data['longitude'].to_numpy()
+    expected = qc.neighbours(lats, lons)
+    qc.neighbours_cache.clear()
+    find_spec = importlib.util.find_spec
+    monkeypatch.setattr(importlib.util, 'find_spec',
+                        lambda name, *args: None if name == 'scipy' else find_spec(name, *args))
+    # Searched in many chunks
+    monkeypatch.setattr(stations, 'BRUTE_FORCE_CHUNK_SIZE', 100000)
+    assert stations.StationIndex(pd.DataFrame({'latitude': lats, 'longitude': lons})).tree is None
+    indices = qc.neighbours(lats, lons)
+    # Ties between stations at the same distance may be broken differently
+    np.testing.assert_array_equal(np.sort(indices, axis=1), np.sort(expected, axis=1))
+
+
+def test_snapshots():
+    data = realtime(100)
+    assert qc.load_snapshot('italy') is None
+    qc.save_snapshot('italy', data)
+    snapshot = qc.load_snapshot('italy')
+    assert 'temperature' in snapshot and 'wind_gust' not in snapshot
+    assert (snapshot['station_code'].astype(str) == data['station_code'].astype(str)).all()
+    flags = qc.check(later(data), previous=snapshot)
+    assert flags.shape == (100, len(flags.columns))
+
+    old = time.time() - qc.SNAPSHOT_MAX_AGE - 60
+    os.utime(qc.snapshot_filename('italy'), (old, old))
+    assert qc.load_snapshot('italy') is None
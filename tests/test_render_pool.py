@@ -0,0 +1,54 @@
+# Parallel rendering from data shared between processes
+import numpy as np
+import pandas as pd
+from parsing import parse_records
+from render_pool import SharedFrame, render
+import synthetic
+
+
+def plot_product(data, plot_filename, fail=False):
+    '''Stand-in for the plot_product of the scripts, run by the workers'''
+    if fail:
+        raise ValueError('Broken product')
+    with open(plot_filename, 'w') as f:
+        f.write('%d %.3f %s' % (len(data), np.nansum(data['temperature']), data['station_code'].iloc[-1]))
+
+
+def realtime(num_stations):
+    return parse_records(synthetic.payload(synthetic.realtime_frame(num_stations)), 'data-realtime')
+
+
+def test_shared_frame_round_trip():
+    data = realtime(100)
+    data['place'] = data['place'].astype(object)
+    shared = SharedFrame.create(data)
+    try:
+        attached = SharedFrame.attach(shared.spec)
+        copy = attached.frame()
+        pd.testing.assert_frame_equal(copy, data, check_dtype=False)
+        for column in ['temperature', 'latitude', 'observation_time_utc']:
+            assert copy[column].dtype == data[column].dtype
+        assert isinstance(copy['station_code'].dtype, pd.CategoricalDtype)
+        assert not copy['temperature'].to_numpy().flags.writeable
+        attached.close()
+    finally:
+        shared.unlink()
+
+
+def test_render(tmp_path):
+    datasets = {'italy': realtime(300), 'europe': realtime(50)}
+    filenames = [str(tmp_path / ('%s.txt' % name)) for name in ['a', 'b', 'c', 'broken']]
+    tasks = [('test_render_pool', 'italy', (filenames[0],), filenames[0]),
+             ('test_render_pool', 'europe', (filenames[1],), filenames[1]),
+             ('test_render_pool', 'italy', (filenames[2],), filenames[2]),
+             ('test_render_pool', 'italy', (filenames[3], True), filenames[3])]
+    ready = []
+    failed = render(tasks, datasets, max_workers=2, callback=ready.append)
+
+    assert [plot_filename for plot_filename, e in failed] == [filenames[3]]
+    assert sorted(ready) == sorted(filenames[:3])
+    for plot_filename, key in zip(filenames[:3], ['italy', 'europe', 'italy']):
+        data = datasets[key]
+        expected = '%d %.3f %s' % (len(data), np.nansum(data['temperature']), data['station_code'].iloc[-1])
+        with open(plot_filename) as f:
+            assert f.read() == expected
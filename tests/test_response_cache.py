@@ -0,0 +1,123 @@
+# On-disk cache of the api answers
+import os
+import time
+from datetime import datetime, timedelta
+import pandas as pd
+from response_cache import ResponseCache
+
+
+def frame(n=10):
+    return pd.DataFrame({'station_code': ['s%d' % i for i in range(n)],
+                         'temperature': [float(i) for i in range(n)]})
+
+
+def test_round_trip(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    data = frame()
+    cache.set('data-realtime', {'country': 'IT'}, data)
+    pd.testing.assert_frame_equal(cache.get('data-realtime', {'country': 'IT'}), data)
+    assert cache.get('data-realtime', {'country': 'FR'}) is None
+
+
+def test_columns_are_read_as_asked(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    cache.set('data-realtime', {}, frame())
+    assert list(cache.get('data-realtime', {}, columns=['temperature']).columns) == ['temperature']
+    missing = cache.get('data-realtime', {}, columns=['temperature', 'rh'])
+    assert list(missing.columns) == ['temperature', 'rh']
+    assert missing['rh'].isna().all()
+
+
+def test_ttl(tmp_path):
+    cache = ResponseCache(str(tmp_path), realtime_ttl=120, stations_ttl=86400, recent_ttl=600)
+    assert cache.ttl('data-realtime', {}) == 120
+    assert cache.ttl('stations', {}) == 86400
+    assert cache.ttl('data-daily', {'observation_date': '2020-01-01'}) is None
+    today = datetime.now().strftime('%Y-%m-%d')
+    assert cache.ttl('data-daily', {'observation_date': today}) == 600
+    assert cache.ttl('data-daily', {}) == 600
+
+
+def test_expired_entries_are_missing(tmp_path):
+    cache = ResponseCache(str(tmp_path), realtime_ttl=120)
+    cache.set('data-realtime', {}, frame())
+    filename = cache.filename('data-realtime', {})
+    written = time.time() - 300
+    os.utime(filename, (written, written))
+    assert cache.get('data-realtime', {}) is None
+
+
+def test_settled_days_never_expire(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    params = {'observation_date': (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')}
+    cache.set('data-daily', params, frame())
+    written = time.time() - 10 * 86400
+    os.utime(cache.filename('data-daily', params), (written, written))
+    assert cache.get('data-daily', params) is not None
+
+
+def test_answers_written_before_the_day_settled_expire(tmp_path):
+    cache = ResponseCache(str(tmp_path), recent_ttl=600, settle_time=6 * 3600)
+    day = datetime.now() - timedelta(days=3)
+    params = {'observation_date': day.strftime('%Y-%m-%d')}
+    cache.set('data-daily', params, frame())
+    # Written during the day, when the answer could still change
+    written = (day.replace(hour=12) if day.hour < 12 else day).timestamp()
+    os.utime(cache.filename('data-daily', params), (written, written))
+    assert cache.ttl('data-daily', params) is None
+    assert cache.ttl('data-daily', params, written) == 600
+    assert cache.get('data-daily', params) is None
+
+
+def test_no_caching_with_zero_ttl(tmp_path):
+    cache = ResponseCache(str(tmp_path), realtime_ttl=0)
+    cache.set('data-realtime', {}, frame())
+    assert os.listdir(tmp_path) == []
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    for day in range(3):
+        params = {'observation_date': '2020-01-0%d' % (day + 1)}
+        cache.set('data-daily', params, frame(1000))
+        # Older days were used less recently
+        used = time.time() - 1000 * (3 - day)
+        os.utime(cache.filename('data-daily', params), (used, used))
+    size = os.path.getsize(cache.filename('data-daily', {'observation_date': '2020-01-03'}))
+    cache.max_size = 2 * size
+    cache.evict()
+    assert cache.get('data-daily', {'observation_date': '2020-01-01'}) is None
+    assert cache.get('data-daily', {'observation_date': '2020-01-03'}) is not None
+
+
+def test_eviction_leaves_room_for_the_next_entries(tmp_path, monkeypatch):
+    cache = ResponseCache(str(tmp_path))
+    cache.set('data-daily', {'observation_date': '2020-01-01'}, frame(1000))
+    size = os.path.getsize(cache.filename('data-daily', {'observation_date': '2020-01-01'}))
+    cache.max_size = int(4.5 * size)
+    scans = []
+    evict = cache.evict
+    monkeypatch.setattr(cache, 'evict', lambda: scans.append(1) or evict())
+    for day in range(2, 20):
+        cache.set('data-daily', {'observation_date': '2020-01-%02d' % day}, frame(1000))
+    assert sum(os.path.getsize(entry.path) for entry in os.scandir(tmp_path)) <= cache.max_size
+    # Not on every write once full
+    assert len(scans) < 10
+
+
+def test_clear_removes_the_caches_of_other_servers(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    cache.set('data-realtime', {}, frame())
+    other = ResponseCache(os.path.join(cache.path, 'local'))
+    other.set('data-realtime', {}, frame())
+    cache.evict()
+    assert other.get('data-realtime', {}) is not None
+    cache.clear()
+    assert os.listdir(tmp_path) == []
+
+
+def test_corrupted_entries_are_missing(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    with open(cache.filename('data-realtime', {}), 'w') as f:
+        f.write('garbage')
+    assert cache.get('data-realtime', {}) is None
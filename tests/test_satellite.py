@@ -0,0 +1,56 @@
+# Local cache of the satellite imagery
+import io
+import numpy as np
+from PIL import Image
+import pytest
+import satellite
+
+
+@pytest.fixture
+def downloads(monkeypatch):
+    '''Extents and resolutions downloaded, answered with blank images'''
+    requested = []
+
+    def download_image(extent, resolution, url=None, layer=satellite.WMS_LAYER):
+        requested.append((list(extent), resolution))
+        width = int(round((extent[1] - extent[0]) * resolution))
+        height = int(round((extent[3] - extent[2]) * resolution))
+        content = io.BytesIO()
+        Image.new('RGB', (width, height)).save(content, format='png')
+        return content.getvalue()
+
+    monkeypatch.setattr(satellite, 'download_image', download_image)
+    return requested
+
+
+def test_maps_share_the_domain_image(tmp_path, downloads):
+    img, extent = satellite.get_satellite_image([-18, 40, 30, 70], 980, 680, cache_dir=str(tmp_path))
+    assert downloads == [([-18, 40, 30, 70], 17.)]
+    assert img.shape[:2] == (680, 986)
+    # Coarser maps inside the domain are cropped from the same image
+    img, extent = satellite.get_satellite_image([0, 20, 40, 50], 300, 150, cache_dir=str(tmp_path))
+    assert len(downloads) == 1
+    assert extent[0] <= 0 and extent[1] >= 20 and extent[2] <= 40 and extent[3] >= 50
+    assert [f.name for f in tmp_path.iterdir() if not f.name.endswith('.png')] == []
+
+
+def test_finer_maps_download_their_extents(tmp_path, downloads):
+    satellite.get_satellite_image([-18, 40, 30, 70], 980, 680, cache_dir=str(tmp_path))
+    satellite.get_satellite_image([6, 19, 36, 48], 930, 860, cache_dir=str(tmp_path))
+    assert downloads[1] == ([6, 19, 36, 48], 71.67)
+    # Then reused by the next renderings of the slot
+    satellite.get_satellite_image([6, 19, 36, 48], 930, 860, cache_dir=str(tmp_path))
+    assert len(downloads) == 2
+
+
+def test_failed_downloads_use_the_last_image(tmp_path, downloads, monkeypatch):
+    satellite.get_satellite_image([6, 19, 36, 48], 930, 860, cache_dir=str(tmp_path))
+    old = satellite.imagery_slot() - satellite.timedelta(minutes=15)
+    monkeypatch.setattr(satellite, 'imagery_slot', lambda: old + satellite.timedelta(minutes=30))
+
+    def unavailable(*args, **kwargs):
+        raise ConnectionError('Not published yet')
+
+    monkeypatch.setattr(satellite, 'download_image', unavailable)
+    img, extent = satellite.get_satellite_image([6, 19, 36, 48], 930, 860, cache_dir=str(tmp_path))
+    assert img.shape[1] >= 930 and np.allclose(extent, [6, 19, 36, 48], atol=0.1)
@@ -0,0 +1,24 @@
+# The scripts must start without importing the heavy modules
+import subprocess
+import sys
+import pytest
+from conftest import ROOT
+import run_benchmarks
+
+HEAVY_MODULES = ['requests', 'pandas', 'numpy', 'matplotlib', 'cartopy', 'pyarrow']
+
+
+@pytest.mark.parametrize('script', run_benchmarks.SCRIPTS)
+def test_import_is_light(script):
+    code = 'import sys, %s; print(" ".join(m for m in %r if m in sys.modules))' % (script, HEAVY_MODULES)
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True,
+                            capture_output=True, text=True)
+    assert result.stdout.split() == []
+
+
+def test_startup_time():
+    results = {}
+    for stage, args in run_benchmarks.startup_commands().items():
+        wall_time, peak = run_benchmarks.measure_startup(args, repeat=3)
+        results['startup|%s|0' % stage] = {'time': wall_time}
+    assert run_benchmarks.check_startup(results, max_startup=0.1) == []
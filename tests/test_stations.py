@@ -0,0 +1,60 @@
+# Local spatial index of the stations
+import numpy as np
+import pandas as pd
+import pytest
+import stations
+from stations import StationIndex
+import synthetic
+
+
+def haversine(lat, lon, lats, lons):
+    lat, lon, lats, lons = map(np.deg2rad, (lat, lon, lats, lons))
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * stations.EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+@pytest.fixture(params=['kdtree', 'brute_force'])
+def index(request, monkeypatch):
+    lats, lons = synthetic.clustered_stations(3000, 'europe')
+    meta = pd.DataFrame({'station_code': ['s%d' % i for i in range(len(lats))],
+                         'latitude': lats, 'longitude': lons})
+    # Stations without position are left out
+    meta.loc[10, 'latitude'] = np.nan
+    index = StationIndex(meta)
+    if request.param == 'brute_force':
+        index.tree = None
+        monkeypatch.setattr(stations, 'BRUTE_FORCE_CHUNK_SIZE', 50000)
+    return index
+
+
+def test_nearest(index):
+    assert len(index.meta) == 2999
+    points = np.array([[45.46, 9.19], [41.9, 12.5], [60., -10.], [36.5, 39.]])
+    indices, distances = index.nearest(points[:, 0], points[:, 1], 5)
+    assert indices.shape == (4, 5)
+    for (lat, lon), found, found_distances in zip(points, indices, distances):
+        expected = haversine(lat, lon, index.lats, index.lons)
+        np.testing.assert_allclose(found_distances, np.sort(expected)[:5], rtol=1e-6)
+        np.testing.assert_allclose(expected[found], found_distances, rtol=1e-6)
+
+    indices, distances = index.nearest(45.46, 9.19)
+    assert indices.shape == (1,) and distances[0] == pytest.approx(haversine(
+        45.46, 9.19, index.lats, index.lons).min(), rel=1e-6)
+
+
+def test_within_radius(index):
+    indices, distances = index.within_radius(45.46, 9.19, 50.)
+    expected = haversine(45.46, 9.19, index.lats, index.lons)
+    assert sorted(indices) == sorted(np.flatnonzero(expected <= 50.))
+    assert (np.diff(distances) >= 0).all()
+    np.testing.assert_allclose(distances, expected[indices], rtol=1e-6)
+
+
+def test_within_bbox_and_join(index):
+    inside = index.within_bbox(6, 19, 36, 48)
+    assert (index.lons[inside] >= 6).all() and (index.lats[inside] <= 48).all()
+    data = pd.DataFrame({'station_code': ['s1', 's2', 'unknown'], 'temperature': [1., 2., 3.]})
+    joined = index.join(data, columns=['latitude'])
+    assert list(joined.columns) == ['station_code', 'temperature', 'latitude']
+    assert joined['latitude'].tolist()[:2] == index.meta['latitude'].tolist()[1:3]
+    assert np.isnan(joined['latitude'][2])
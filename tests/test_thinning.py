@@ -0,0 +1,69 @@
+# The vectorised thinning must remove the same stations as the original loops
+import numpy as np
+import pytest
+import synthetic
+import utils
+
+
+def loop_filter(var, lats, lons, max_density=1., num_bins=30, keep='any'):
+    '''The filters as they were written before being vectorised'''
+    var_sparse = np.copy(var)
+    lon_bins = np.linspace(lons.min(), lons.max(), num_bins)
+    lat_bins = np.linspace(lats.min(), lats.max(), num_bins)
+    density, xedges, yedges = np.histogram2d(lats, lons, [lat_bins, lon_bins])
+
+    for i, j in zip(np.where(density > max_density)[0], np.where(density > max_density)[1]):
+        indices = np.where((lons <= yedges[j + 1]) & (lons >= yedges[j]) & (
+            xedges[i] <= lats) & (lats <= xedges[i + 1]))[0]
+        if keep == 'any':
+            var_sparse[indices[np.arange(len(indices)) != 1]] = np.nan
+        elif not np.isnan(var_sparse[indices]).sum() == len(var_sparse[indices]):
+            chosen = np.nanargmax if keep == 'max' else np.nanargmin
+            var_sparse[indices[np.arange(len(indices)) != chosen(var_sparse[indices])]] = np.nan
+
+    return var_sparse
+
+
+@pytest.fixture(autouse=True)
+def selection_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv('MNW_SELECTION_DIR', str(tmp_path))
+    utils.selection_cache.clear()
+
+
+def network(num_stations, seed, decimals=None):
+    lats, lons = synthetic.clustered_stations(num_stations, seed=seed)
+    if decimals is not None:
+        # Many stations on the edges of the boxes
+        lats, lons = lats.round(decimals), lons.round(decimals)
+    rng = np.random.default_rng(seed)
+    var = rng.normal(20, 5, num_stations)
+    var[rng.random(num_stations) < 0.2] = np.nan
+    return var, lats, lons
+
+
+@pytest.mark.parametrize('num_stations,seed,decimals', [(50, 0, None), (2000, 1, None), (2000, 2, 0), (5000, 3, 1)])
+@pytest.mark.parametrize('num_bins,max_density', [(30, 1), (25, 1), (50, 2)])
+def test_filters_match_the_loops(num_stations, seed, decimals, num_bins, max_density):
+    var, lats, lons = network(num_stations, seed, decimals)
+    for function, keep in [(utils.filter_values, 'any'), (utils.filter_max_values, 'max'),
+                           (utils.filter_min_values, 'min')]:
+        np.testing.assert_array_equal(function(var, lats, lons, max_density=max_density, num_bins=num_bins),
+                                      loop_filter(var, lats, lons, max_density, num_bins, keep))
+
+
+def test_selection_is_reused(tmp_path):
+    var, lats, lons = network(1000, 4)
+    removed = utils.station_selection(lats, lons)
+    utils.selection_cache.clear()
+    # Read back from disk by a later run
+    np.testing.assert_array_equal(utils.station_selection(lats, lons), removed)
+    np.testing.assert_array_equal(utils.apply_selection(removed, var), utils.filter_values(var, lats, lons))
+
+
+def test_invalid_values_are_never_kept():
+    var, lats, lons = network(2000, 5)
+    valid = np.random.default_rng(5).random(len(var)) > 0.3
+    for function in [utils.filter_values, utils.filter_max_values, utils.filter_min_values]:
+        sparse = function(var, lats, lons, valid=valid)
+        assert np.isnan(sparse[~valid]).all()
+        assert np.isfinite(sparse).any()
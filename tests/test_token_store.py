@@ -0,0 +1,57 @@
+# Tokens cached on disk and shared between runs
+import base64
+import json
+import os
+import time
+import pytest
+from token_store import TokenStore, token_expiry
+
+
+def jwt(claims):
+    payload = base64.urlsafe_b64encode(json.dumps(claims).encode()).decode().rstrip('=')
+    return 'header.%s.signature' % payload
+
+
+def test_expiry_from_expires_in():
+    assert token_expiry({'access_token': 'abc', 'expires_in': 3600}) == pytest.approx(time.time() + 3600, abs=5)
+
+
+def test_expiry_from_jwt_claim():
+    assert token_expiry({'access_token': jwt({'exp': 2000000000})}) == 2000000000
+
+
+def test_expiry_default():
+    assert token_expiry({'access_token': 'opaque'}, default_ttl=60) == pytest.approx(time.time() + 60, abs=5)
+
+
+def test_set_and_get(tmp_path):
+    store = TokenStore(str(tmp_path / 'tokens.json'))
+    expires_at = time.time() + 3600
+    with store.lock():
+        store.set('standard', 'abc', expires_at)
+    assert store.get('standard') == ('abc', expires_at)
+    assert store.get('bulk') == (None, None)
+    # Another store on the same file sees the token
+    assert TokenStore(store.path).get('standard') == ('abc', expires_at)
+    assert os.stat(store.path).st_mode & 0o777 == 0o600
+
+
+def test_tokens_close_to_expiry_are_expired(tmp_path):
+    store = TokenStore(str(tmp_path / 'tokens.json'), margin=300)
+    store.set('standard', 'abc', time.time() + 100)
+    assert store.get('standard') == (None, None)
+
+
+def test_invalidate_keeps_newer_tokens(tmp_path):
+    store = TokenStore(str(tmp_path / 'tokens.json'))
+    store.set('standard', 'new', time.time() + 3600)
+    store.invalidate('standard', 'old')
+    assert store.get('standard')[0] == 'new'
+    store.invalidate('standard', 'new')
+    assert store.get('standard') == (None, None)
+
+
+def test_corrupted_store_is_empty(tmp_path):
+    path = tmp_path / 'tokens.json'
+    path.write_text('{not json')
+    assert TokenStore(str(path)).read() == {}
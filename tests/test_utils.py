@@ -0,0 +1,68 @@
+# Plotting utilities
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import utils
+
+
+def save_many(filename, value):
+    img = np.full((200, 200, 4), value, dtype=np.uint8)
+    for i in range(20):
+        utils.save_template(filename, img)
+
+
+def test_templates_saved_by_concurrent_processes(tmp_path):
+    filename = str(tmp_path / 'templates' / 'map.npy')
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        for future in [executor.submit(save_many, filename, value) for value in range(4)]:
+            future.result()
+    assert np.load(filename).shape == (200, 200, 4)
+    assert [f.name for f in (tmp_path / 'templates').iterdir()] == ['map.npy']
+
+
+def test_templates_without_a_cache_directory(tmp_path, monkeypatch):
+    # A file where the directory should be
+    (tmp_path / 'templates').write_text('')
+    monkeypatch.setenv('MNW_TEMPLATE_DIR', str(tmp_path / 'templates'))
+    monkeypatch.setattr(utils, 'template_cache', {})
+    rendered = []
+
+    def render_template(extent, width, height, dpi=100, **layers):
+        rendered.append(extent)
+        return np.zeros((height, width, 4), dtype=np.uint8)
+
+    monkeypatch.setattr(utils, 'render_template', render_template)
+    img = utils.get_template([6, 19, 36, 48], 30, 20, borders=True)
+    assert img.shape == (20, 30, 4)
+    # Kept in memory anyway
+    assert utils.get_template([6, 19, 36, 48], 30, 20, borders=True) is img
+    assert len(rendered) == 1
+
+
+def loop_wind_components(speed, wdir):
+    '''wind_components as it was written before using the lookup table'''
+    wdir = np.array([utils.wind_degrees_from_direction(d) for d in wdir], dtype=float)
+    return -speed * np.sin(wdir), -speed * np.cos(wdir)
+
+
+def test_wind_components_match_the_loop():
+    import pandas as pd
+    from parsing import parse_records
+    import synthetic
+
+    directions = list(utils.WIND_DIRECTIONS) + ['XYZ', '', 'n', None, np.nan, 'N']
+    speed = np.arange(len(directions), dtype=float) + 1
+    expected = loop_wind_components(speed, directions)
+    for wdir in [directions, np.array(directions, dtype=object), pd.Series(directions, dtype=object)]:
+        u, v = utils.wind_components(speed, wdir)
+        np.testing.assert_allclose(u, expected[0], atol=1e-12)
+        np.testing.assert_allclose(v, expected[1], atol=1e-12)
+    # Unknown and missing directions give NaN
+    assert np.isnan(u[len(utils.WIND_DIRECTIONS):-1]).all() and np.isfinite(u[-1])
+
+    # As parsed from the answers, with categorical directions
+    data = parse_records(synthetic.payload(synthetic.realtime_frame(1000)), 'data-realtime')
+    u, v = utils.wind_components(data['wind_speed'].values, data['wind_direction'].values)
+    expected = loop_wind_components(data['wind_speed'].to_numpy(dtype=float), data['wind_direction'].tolist())
+    np.testing.assert_allclose(u, expected[0], rtol=1e-6, atol=1e-12)
+    np.testing.assert_allclose(v, expected[1], rtol=1e-6, atol=1e-12)
+    assert np.isnan(u).any()
@@ -0,0 +1,98 @@
+# File backed store for the meteonetwork api tokens, shared between processes
+import base64
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory locks available (e.g. Windows): processes will not be
+    # serialized but the store will still work
+    fcntl = None
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'meteonetwork', 'tokens.json')
+
+
+def token_expiry(js, default_ttl=86400):
+    '''Get the expiry time (unix timestamp) of a token from the login response js.
+    Use expires_in if the server provides it, otherwise the exp claim of the
+    token if it is a JWT, otherwise assume it lasts default_ttl seconds.'''
+    if js.get('expires_in'):
+        return time.time() + float(js['expires_in'])
+    try:
+        payload = js['access_token'].split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return time.time() + default_ttl
+
+
+class TokenStore():
+    def __init__(self, path=None, margin=300):
+        '''Keep the tokens with their expiry in a json file, by default
+        ~/.cache/meteonetwork/tokens.json or the file defined in MNW_TOKEN_CACHE.
+        Tokens expiring in less than margin seconds are considered expired.'''
+        self.path = path or os.environ.get('MNW_TOKEN_CACHE', DEFAULT_PATH)
+        self.margin = margin
+
+    @contextmanager
+    def lock(self):
+        '''Exclusive lock on the store, held while a token is refreshed so that
+        concurrent processes do not all log in at the same time'''
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + '.lock', 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read(self):
+        '''Return all the entries of the store'''
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write(self, entries):
+        '''Atomically replace the content of the store, readable only by the owner'''
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tokens')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def get(self, kind):
+        '''Return the token of the given kind (standard or bulk) and its expiry,
+        or (None, None) if missing or expired.'''
+        entry = self.read().get(kind)
+        if entry and entry['expires_at'] - self.margin > time.time():
+            return entry['token'], entry['expires_at']
+        return None, None
+
+    def set(self, kind, token, expires_at):
+        '''Save a token of the given kind. Call it while holding the lock.'''
+        entries = self.read()
+        entries[kind] = {'token': token, 'expires_at': expires_at}
+        self.write(entries)
+
+    def invalidate(self, kind, token):
+        '''Remove a token that has been rejected by the server, unless another
+        process has already replaced it with a new one.'''
+        with self.lock():
+            entries = self.read()
+            if kind in entries and entries[kind]['token'] == token:
+                del entries[kind]
+                self.write(entries)
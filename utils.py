@@ -1,128 +1,411 @@
 # Common libraries for meteonetwork/meteoindiretta plotting routines
+# matplotlib, pandas and cartopy are imported by the functions using them, so that
+# importing this module (e.g. for the filters or from a script printing --help)
+# stays fast
 import numpy as np
-import matplotlib.colors as mplcolors
-import matplotlib.cm as mplcm
-from matplotlib.offsetbox import AnnotationBbox, OffsetImage
-from matplotlib.image import imread as read_png
-from matplotlib import patheffects
-from mpl_toolkits.axes_grid1.inset_locator import inset_axes
+import instrument
 import importlib
-
-
-def filter_values(var, lats, lons, max_density=1., num_bins=30):
+import hashlib
+import json
+import os
+from functools import lru_cache
+from collections import OrderedDict
+
+# Recently computed station selections, see station_selection
+selection_cache = OrderedDict()
+SELECTION_CACHE_SIZE = 16
+SELECTION_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'meteonetwork', 'selections')
+# Selections kept on disk, the least recently used are removed
+SELECTION_FILES = 64
+# Static map layers already rendered, see get_template
+template_cache = {}
+TEMPLATE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'meteonetwork', 'templates')
+# Cardinal directions, clockwise from north every 22.5 degrees, and their sine and
+# cosine with a trailing NaN which is picked by the code -1 of unknown directions
+WIND_DIRECTIONS = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE',
+                   'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
+WIND_SIN = np.append(np.sin(np.deg2rad(np.arange(16) * 22.5)), np.nan)
+WIND_COS = np.append(np.cos(np.deg2rad(np.arange(16) * 22.5)), np.nan)
+
+
+def bin_index(x, edges):
+    '''Return the index of the bin of edges containing every value of x,
+    with the same convention of np.histogram (last bin closed on the right)'''
+    index = np.searchsorted(edges, x, side='right') - 1
+    index[x == edges[-1]] = len(edges) - 2
+
+    return index
+
+
+def thinning_cells(lats, lons, num_bins=30):
+    '''Divide the domain in (num_bins - 1)**2 boxes and return, for every box
+    containing stations, the stations that belong to it as (stations, cells)
+    pairs sorted by cell and station, together with the number of stations
+    counted in every cell.
+    Stations lying exactly on an inner edge are counted in one box only, but
+    belong to both boxes sharing the edge.'''
+    lon_bins = np.linspace(lons.min(), lons.max(), num_bins)
+    lat_bins = np.linspace(lats.min(), lats.max(), num_bins)
+    n = num_bins - 1
+    i = bin_index(lats, lat_bins)
+    j = bin_index(lons, lon_bins)
+    cells = i * n + j
+    density = np.bincount(cells, minlength=n * n)
+
+    on_lat_edge = (i > 0) & (lats == lat_bins[i])
+    on_lon_edge = (j > 0) & (lons == lon_bins[j])
+    on_both_edges = on_lat_edge & on_lon_edge
+    stations = np.concatenate([np.arange(len(cells)), np.flatnonzero(on_lat_edge),
+                               np.flatnonzero(on_lon_edge), np.flatnonzero(on_both_edges)])
+    cells = np.concatenate([cells, cells[on_lat_edge] - n,
+                            cells[on_lon_edge] - 1, cells[on_both_edges] - n - 1])
+    order = np.lexsort((stations, cells))
+
+    return stations[order], cells[order], density
+
+
+def thinning_mask(lats, lons, var=None, max_density=1., num_bins=30, keep='any'):
+    '''Return a boolean array which is True for the stations to be removed
+    so that no box of the domain contains more than max_density stations.
+    In every crowded box only one station is preserved: with keep='any' the
+    choice does not depend on the values, with keep='max' or keep='min' the
+    station with the maximum or minimum value of var is preserved and boxes
+    where var is all NaN are left untouched.'''
+    stations, cells, density = thinning_cells(lats, lons, num_bins)
+    crowded = density[cells] > max_density
+    stations, cells = stations[crowded], cells[crowded]
+    removed = np.zeros(len(lats), dtype=bool)
+
+    # Position of every station inside its box
+    new_cell = np.ones(len(cells), dtype=bool)
+    new_cell[1:] = cells[1:] != cells[:-1]
+    starts = np.flatnonzero(new_cell)
+    group = np.cumsum(new_cell) - 1
+    rank = np.arange(len(cells)) - starts[group]
+
+    if keep == 'any':
+        # Keep the second station of every box, as it has always been done
+        removed[stations[rank != 1]] = True
+        return removed
+
+    values = np.asarray(var, dtype=float)
+    # Boxes sharing a station (on an edge) depend on each other and are
+    # done one by one afterwards, all the others at once
+    shared = np.bincount(stations, minlength=len(lats))[stations] > 1
+    coupled = np.zeros(len(starts), dtype=bool)
+    coupled[group[shared]] = True
+    independent = ~coupled[group]
+
+    st, gr = stations[independent], group[independent]
+    sign = -1. if keep == 'max' else 1.
+    vals = values[st]
+    order = np.lexsort((st, sign * vals, np.isnan(vals), gr))
+    st, gr, vals = st[order], gr[order], vals[order]
+    first = np.ones(len(gr), dtype=bool)
+    first[1:] = gr[1:] != gr[:-1]
+    # The first station of every box is the one to keep, unless it is NaN,
+    # which means that the box is all NaN
+    has_values = np.zeros(len(starts), dtype=bool)
+    has_values[gr[first]] = ~np.isnan(vals[first])
+    removed[st[~first & has_values[gr]]] = True
+
+    choose = np.nanargmax if keep == 'max' else np.nanargmin
+    current = np.where(removed, np.nan, values)
+    for g in np.flatnonzero(coupled):
+        indices = stations[group == g]
+        if not np.isnan(current[indices]).all():
+            others = indices[np.arange(len(indices)) != choose(current[indices])]
+            current[others] = np.nan
+            removed[others] = True
+
+    return removed
+
+
+def station_selection(lats, lons, max_density=1., num_bins=30, valid=None):
+    '''Return the boolean mask of the stations removed by filter_values.
+    It only depends on the station positions, so it can be computed once and
+    applied to any number of variables with apply_selection. The last selections
+    are kept in memory and in ~/.cache/meteonetwork/selections (or MNW_SELECTION_DIR),
+    and reused as long as the station positions do not change, also by later runs.
+    valid, if given, is the mask of the stations that can be kept (e.g. from
+    qc.valid): the others are always removed and do not take part in the selection.'''
+    if valid is not None:
+        removed = np.ones(len(lats), dtype=bool)
+        if not np.any(valid):
+            return removed
+        removed[valid] = station_selection(np.asarray(lats)[valid], np.asarray(lons)[valid],
+                                           max_density, num_bins)
+        return removed
+
+    lats = np.ascontiguousarray(lats)
+    lons = np.ascontiguousarray(lons)
+    key = (hashlib.sha1(lats.tobytes() + lons.tobytes()).hexdigest(),
+           lats.dtype.str, lons.dtype.str, max_density, num_bins)
+    if key in selection_cache:
+        selection_cache.move_to_end(key)
+        return selection_cache[key]
+
+    path = os.environ.get('MNW_SELECTION_DIR', SELECTION_PATH)
+    filename = os.path.join(path, hashlib.sha1(json.dumps(key).encode()).hexdigest() + '.npy')
+    try:
+        removed = np.load(filename)
+        if removed.shape != lats.shape:
+            raise ValueError('Selection of %d stations instead of %d' % (len(removed), len(lats)))
+        # Mark it as recently used
+        os.utime(filename)
+    except (OSError, ValueError):
+        removed = thinning_mask(lats, lons, max_density=max_density, num_bins=num_bins)
+        save_selection(path, filename, removed)
+    removed.setflags(write=False)
+    selection_cache[key] = removed
+    if len(selection_cache) > SELECTION_CACHE_SIZE:
+        selection_cache.popitem(last=False)
+
+    return removed
+
+
+def save_selection(path, filename, removed):
+    '''Save a selection of station_selection, removing the least recently used
+    ones beyond SELECTION_FILES. Failures only cost a new computation later.'''
+    try:
+        os.makedirs(path, exist_ok=True)
+        tmp_filename = '%s.tmp%d.npy' % (filename[:-4], os.getpid())
+        np.save(tmp_filename, removed)
+        os.replace(tmp_filename, filename)
+        files = [os.path.join(path, f) for f in os.listdir(path) if f.endswith('.npy') and '.tmp' not in f]
+        if len(files) > SELECTION_FILES:
+            files.sort(key=lambda f: os.stat(f).st_mtime)
+            for old in files[:-SELECTION_FILES]:
+                os.remove(old)
+    except OSError as e:
+        print('Could not save the station selection: %s' % e)
+
+
+def apply_selection(removed, *variables):
+    '''Put NaN in the stations removed by a selection (see station_selection)
+    for every variable. Returns the new arrays, or the new array if only one
+    variable is given.'''
+    sparse = [np.where(removed, np.nan, var) for var in variables]
+    if len(sparse) == 1:
+        return sparse[0]
+    return sparse
+
+
+@instrument.stage()
+def filter_values(var, lats, lons, max_density=1., num_bins=30, valid=None):
     '''Attempts to remove overlapping points by binning the results and 
     removing stations within a box with a certain density. For now the algorithm
     just randomly choose one of the station in the box.
+    valid, if given, is the mask of the values passing the quality control
+    (see qc.valid): the others are removed and never chosen in a box.
     Returns the new array of the input array.'''
 
+    instrument.add(stations=len(var))
     var_sparse = np.copy(var)
-    # First compute density of stations
-    lon_bins = np.linspace(lons.min(), lons.max(), num_bins)
-    lat_bins = np.linspace(lats.min(), lats.max(), num_bins)
-    density, xedges, yedges = np.histogram2d(lats, lons, [lat_bins, lon_bins])
-
-    # Then loop throught the boxes in the histogram and put np.NaN
-    # in all but one of the stations that pertain to that box
-    for i, j in zip(np.where(density > max_density)[0], np.where(density > max_density)[1]):
-        indices = np.where((lons <= yedges[j + 1]) & (lons >= yedges[j]) & (
-            xedges[i] <= lats) & (lats <= xedges[i + 1]))[0]
-        # Select all points but one to be masked
-        var_sparse[indices[np.arange(len(indices)) != 1]] = np.nan
+    var_sparse[station_selection(lats, lons, max_density=max_density, num_bins=num_bins,
+                                 valid=valid)] = np.nan
 
     return(var_sparse)
 
 
-def filter_max_values(var, lats, lons, max_density=1, num_bins=30):
+@instrument.stage()
+def filter_max_values(var, lats, lons, max_density=1, num_bins=30, valid=None):
     '''Attempts to remove overlapping points by binning the results and 
     removing stations within a box with a certain density. Differently
     from what is done in filter_values, here the maximum value is 
     preserved within a cell.
+    valid, if given, is the mask of the values passing the quality control
+    (see qc.valid): the others are removed and never chosen in a box.
     Returns the new array of the input array.'''
 
+    instrument.add(stations=len(var))
     var_sparse = np.copy(var)
-    # First compute density of stations
-    lon_bins = np.linspace(lons.min(), lons.max(), num_bins)
-    lat_bins = np.linspace(lats.min(), lats.max(), num_bins)
-    density, xedges, yedges = np.histogram2d(lats, lons, [lat_bins, lon_bins])
-
-    # Then loop throught the boxes in the histogram and put np.NaN
-    # in all but one of the stations that pertain to that box
-    for i, j in zip(np.where(density > max_density)[0], np.where(density > max_density)[1]):
-        indices = np.where((lons <= yedges[j + 1]) & (lons >= yedges[j]) & (
-            xedges[i] <= lats) & (lats <= xedges[i + 1]))[0]
-        # Select all points but one to be masked
-        # check before if the slice is all NaNs
-        if not np.isnan(var_sparse[indices]).sum() == len(var_sparse[indices]):
-            var_sparse[indices[np.arange(len(indices)) != np.nanargmax(
-                var_sparse[indices])]] = np.nan
+    if valid is not None:
+        var_sparse = np.where(valid, var_sparse, np.nan)
+    var_sparse[thinning_mask(lats, lons, var_sparse, max_density=max_density,
+                             num_bins=num_bins, keep='max')] = np.nan
 
     return(var_sparse)
 
 
-def filter_min_values(var, lats, lons, max_density=1, num_bins=30):
+@instrument.stage()
+def filter_min_values(var, lats, lons, max_density=1, num_bins=30, valid=None):
     '''Attempts to remove overlapping points by binning the results and
     removing stations within a box with a certain density. Differently
     from what is done in filter_values, here the minimum value is
     preserved within a cell.
+    valid, if given, is the mask of the values passing the quality control
+    (see qc.valid): the others are removed and never chosen in a box.
     Returns the new array of the input array.'''
 
+    instrument.add(stations=len(var))
     var_sparse = np.copy(var)
-    # First compute density of stations
-    lon_bins = np.linspace(lons.min(), lons.max(), num_bins)
-    lat_bins = np.linspace(lats.min(), lats.max(), num_bins)
-    density, xedges, yedges = np.histogram2d(lats, lons, [lat_bins, lon_bins])
-
-    # Then loop throught the boxes in the histogram and put np.NaN
-    # in all but one of the stations that pertain to that box
-    for i, j in zip(np.where(density > max_density)[0], np.where(density > max_density)[1]):
-        indices = np.where((lons <= yedges[j + 1]) & (lons >= yedges[j]) & (
-            xedges[i] <= lats) & (lats <= xedges[i + 1]))[0]
-        # Select all points but one to be masked
-        # check before if the slice is all NaNs
-        if not np.isnan(var_sparse[indices]).sum() == len(var_sparse[indices]):
-            var_sparse[indices[np.arange(len(indices)) != np.nanargmin(
-                var_sparse[indices])]] = np.nan
+    if valid is not None:
+        var_sparse = np.where(valid, var_sparse, np.nan)
+    var_sparse[thinning_mask(lats, lons, var_sparse, max_density=max_density,
+                             num_bins=num_bins, keep='min')] = np.nan
 
     return(var_sparse)
 
 
+@lru_cache(maxsize=None)
+def has_cartopy():
+    '''Whether cartopy is installed, checked only once'''
+    return importlib.util.find_spec("cartopy") is not None
+
+
+def map_extent(projection='italy'):
+    '''Return the extents [lon_min, lon_max, lat_min, lat_max] of a projection'''
+    if projection == 'italy':
+        return [6, 19, 36, 48]
+    else:
+        return [-18, 40, 30, 70]
+
+
+def add_map_layers(ax, background=True, regions=False, borders=True, coastlines=False):
+    '''Add the static layers (land, sea, borders...) to a cartopy axis'''
+    import cartopy.feature as cfeature
+
+    if background:
+        ax.add_feature(cfeature.LAND.with_scale('50m'), facecolor='#64B6AC')
+        ax.add_feature(cfeature.LAKES.with_scale('50m'), facecolor='#2081C3')
+        ax.add_feature(cfeature.OCEAN.with_scale('50m'), facecolor='#2081C3')
+    if borders:
+        ax.add_feature(cfeature.BORDERS.with_scale('50m'), linestyle='-', alpha=.5,
+                       edgecolor='white', linewidth=1.)
+    if coastlines:
+        ax.coastlines(resolution='10m', linestyle='-', alpha=.5,
+                       color='white', linewidth=1.)
+    if regions:
+        states_provinces = cfeature.NaturalEarthFeature(
+            category='cultural',
+            name='admin_1_states_provinces_lines',
+            scale='10m',
+            facecolor='none')
+        ax.add_feature(states_provinces, edgecolor='white', alpha=.5)
+
+
+@instrument.stage()
+def render_template(extent, width, height, dpi=100, **layers):
+    '''Render the static layers of a map with the given extents on a transparent
+    image of width x height pixels and return it as a RGBA array'''
+    import cartopy.crs as ccrs
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    fig.patch.set_alpha(0)
+    ax = fig.add_axes([0, 0, 1, 1], projection=ccrs.PlateCarree())
+    ax.set_extent(extent, ccrs.PlateCarree())
+    # Fill the whole image, the aspect ratio is already the one of the map
+    ax.set_aspect('auto')
+    ax.patch.set_visible(False)
+    ax.spines['geo'].set_visible(False)
+    add_map_layers(ax, **layers)
+    canvas.draw()
+
+    return np.asarray(canvas.buffer_rgba()).copy()
+
+
+def get_template(extent, width, height, dpi=100, **layers):
+    '''Return the static layers of a map rendered by render_template.
+    Templates are kept in memory and saved in ~/.cache/meteonetwork/templates
+    (or MNW_TEMPLATE_DIR), so that they are drawn only once.'''
+    import cartopy
+
+    key = json.dumps([cartopy.__version__, [float(e) for e in extent], width, height, dpi,
+                      sorted(layers.items())])
+    if key in template_cache:
+        return template_cache[key]
+
+    path = os.environ.get('MNW_TEMPLATE_DIR', TEMPLATE_PATH)
+    filename = os.path.join(path, hashlib.sha1(key.encode()).hexdigest() + '.npy')
+    try:
+        img = np.load(filename)
+    except (OSError, ValueError):
+        img = render_template(extent, width, height, dpi, **layers)
+        save_template(filename, img)
+    template_cache[key] = img
+
+    return img
+
+
+def save_template(filename, img):
+    '''Save a template of get_template. Processes rendering the same template
+    at the same time write their own temporary file, and failures only cost
+    a new rendering later.'''
+    tmp_filename = '%s.tmp%d.npy' % (filename[:-4], os.getpid())
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        np.save(tmp_filename, img)
+        os.replace(tmp_filename, filename)
+    except OSError as e:
+        print('Could not save the map template: %s' % e)
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def map_size(ax):
+    '''Return the size in pixels that the map in ax will have in the figure'''
+    fig = ax.get_figure()
+    ax.apply_aspect()
+    position = ax.get_position()
+    width, height = fig.get_size_inches() * fig.dpi * [position.width, position.height]
+
+    return int(round(width)), int(round(height))
+
+
+@instrument.stage()
+def add_satellite_on_map(ax, extent):
+    '''Show the latest satellite image on a cartopy axis, using the
+    local satellite cache (see satellite.get_satellite_image).
+    If the image cannot be downloaded the map is done without it.'''
+    import cartopy.crs as ccrs
+    from satellite import get_satellite_image
+
+    width, height = map_size(ax)
+    try:
+        img, img_extent = get_satellite_image(extent, width, height)
+    except Exception as e:
+        print('Could not get the satellite image: %s' % e)
+        return None
+    sat = ax.imshow(img, origin='upper', extent=img_extent, transform=ccrs.PlateCarree(),
+                    interpolation='bilinear', zorder=0)
+    ax.set_extent(extent, ccrs.PlateCarree())
+
+    return sat
+
+
+@instrument.stage()
 def get_projection(plt, projection='italy', background=True,
-                   regions=False, borders=True, sat=False, coastlines=False):
-    '''Retrieve the projection using cartopy'''
+                   regions=False, borders=True, sat=False, coastlines=False,
+                   template=True):
+    '''Retrieve the projection using cartopy.
+    With template=True the static layers are drawn from a cached image
+    (see get_template) instead of being drawn every time.'''
     # Fist check if we have cartopy, otherwise just plot on a background image,
     # which hopefully has the same extents...
-    if (importlib.util.find_spec("cartopy") is not None):
+    if has_cartopy():
         import cartopy.crs as ccrs
-        import cartopy.feature as cfeature
 
         ax = plt.axes(projection=ccrs.PlateCarree())
-
-        if projection == 'italy':
-            ax.set_extent([6, 19, 36, 48], ccrs.PlateCarree())
-        else:
-            ax.set_extent([-18, 40, 30, 70], ccrs.PlateCarree())
+        extent = map_extent(projection)
+        ax.set_extent(extent, ccrs.PlateCarree())
 
         if sat:
-            ax.add_wms(wms='https://view.eumetsat.int/geoserver/wms',
-                       layers=["msg_fes:rgb_eview"])
-
-        if background:
-            ax.add_feature(cfeature.LAND.with_scale('50m'), facecolor='#64B6AC')
-            ax.add_feature(cfeature.LAKES.with_scale('50m'), facecolor='#2081C3')
-            ax.add_feature(cfeature.OCEAN.with_scale('50m'), facecolor='#2081C3')
-        if borders:
-            ax.add_feature(cfeature.BORDERS.with_scale('50m'), linestyle='-', alpha=.5,
-                           edgecolor='white', linewidth=1.)
-        if coastlines:
-            ax.coastlines(resolution='10m', linestyle='-', alpha=.5,
-                           color='white', linewidth=1.)
-        if regions:
-            states_provinces = cfeature.NaturalEarthFeature(
-                category='cultural',
-                name='admin_1_states_provinces_lines',
-                scale='10m',
-                facecolor='none')
-            ax.add_feature(states_provinces, edgecolor='white', alpha=.5)
+            add_satellite_on_map(ax, extent)
+
+        layers = dict(background=background, regions=regions,
+                      borders=borders, coastlines=coastlines)
+        if template:
+            width, height = map_size(ax)
+            img = get_template(extent, width, height, int(ax.get_figure().dpi), **layers)
+            ax.imshow(img, origin='upper', extent=extent, transform=ccrs.PlateCarree(),
+                      interpolation='nearest', zorder=1)
+            ax.set_extent(extent, ccrs.PlateCarree())
+        else:
+            add_map_layers(ax, **layers)
 
         return(ax)
     else:
@@ -141,6 +424,7 @@ def add_background(plt, projection, image='background.png'):
     return plt.gca()
 
 
+@instrument.stage()
 def add_vals_on_map(ax, projection, var, lons, lats, minval=None, maxval=None,
                     cmap='rainbow', shift_x=0., shift_y=0., fontsize=12, colors=True):
     '''Given an input projection, a variable containing the values and a plot put
@@ -148,7 +432,12 @@ def add_vals_on_map(ax, projection, var, lons, lats, minval=None, maxval=None,
     outside of the map boundaries, which can happen.
     - minval, maxval set the extents for the colorscale cmap
     - shift_x and shift_y apply a shifting offset to all text labels
-    - colors indicate whether the colorscale cmap should be used to map the values of the array'''
+    - colors indicate whether the colorscale cmap should be used to map the values of the array
+    Returns the StationLabels artist, whose values can be updated with set_data.'''
+    import matplotlib.colors as mplcolors
+    import matplotlib.cm as mplcm
+    from labels import StationLabels
+
     if not minval:
         minval = np.nanmin(var)
     if not maxval:
@@ -157,7 +446,7 @@ def add_vals_on_map(ax, projection, var, lons, lats, minval=None, maxval=None,
     norm = mplcolors.Normalize(vmin=minval, vmax=maxval)
     m = mplcm.ScalarMappable(norm=norm, cmap=cmap)
 
-    if (importlib.util.find_spec("cartopy") is not None):
+    if has_cartopy():
         extents = ax.get_extent()
     else:
         if projection == 'italy':
@@ -168,31 +457,35 @@ def add_vals_on_map(ax, projection, var, lons, lats, minval=None, maxval=None,
     # Remove values outside of the extents and NaN
     # somehow np.isnan has to be used as this condition var == np.nan does not recognize
     # the NaN
-    inds = np.argwhere((lon_min <= lons) & (lons <= lon_max) & (
+    # Then draw all the values with a single artist
+    inside = ((lon_min <= lons) & (lons <= lon_max) & (
         lat_min <= lats) & (lats <= lat_max) & (np.isnan(var) != True))
-    var = var[inds]
-    lons = lons[inds]
-    lats = lats[inds]
+    var = var[inside]
+    instrument.add(stations=len(var))
+    xy = np.column_stack([lons[inside] + shift_x, lats[inside] + shift_y])
 
-    for i, txt in enumerate(var):
-        if colors:
-            ax.annotate(('%d' % txt), (lons[i] + shift_x, lats[i] + shift_y),
-                        color=m.to_rgba(float(txt)), weight='bold', fontsize=fontsize,
-                        path_effects=[patheffects.withStroke(linewidth=1, foreground="black")])
-        else:
-            ax.annotate(('%d' % txt), (lons[i] + shift_x, lats[i] + shift_y),
-                        color='white', weight='bold', fontsize=fontsize,
-                        path_effects=[patheffects.withStroke(linewidth=1, foreground="black")])
+    if colors:
+        label_colors = m.to_rgba(var.astype(float))
+    else:
+        label_colors = 'white'
+    labels = StationLabels(xy, np.char.mod('%d', var), colors=label_colors,
+                           fontsize=fontsize, transform=ax.transData)
+    ax.add_artist(labels)
+
+    return labels
 
 
+@instrument.stage()
 def add_barbs_on_map(ax, projection, u, v, lons, lats,
                      shift_x=0., shift_y=0., magnitude=False, cmap='gnuplot_r', minval=0, maxval=30):
     '''Given an input projection, a variable containing the values and a plot put
     the values on a map exlcuing NaNs and taking care of not going
     outside of the map boundaries, which can happen.
-    - shift_x and shift_y apply a shifting offset to all text labels'''
+    - shift_x and shift_y apply a shifting offset to all text labels
+    Returns the Barbs artist.'''
+    import matplotlib.colors as mplcolors
 
-    if (importlib.util.find_spec("cartopy") is not None):
+    if has_cartopy():
         extents = ax.get_extent()
     else:
         if projection == 'italy':
@@ -207,15 +500,39 @@ def add_barbs_on_map(ax, projection, u, v, lons, lats,
                         (lats <= lat_max) & (np.isnan(u) != True) & (np.isnan(v) != True)))
     u = u[inds]
     v = v[inds]
+    instrument.add(stations=len(u))
     lons = lons[inds]
     lats = lats[inds]
 
     if magnitude:
         norm = mplcolors.Normalize(vmin=minval, vmax=maxval)
-        ax.barbs(lons + shift_x, lats + shift_y, u, v, (u**2 + v**2)**(0.5),
-                 zorder=6, length=4, cmap=cmap, norm=norm)
+        return ax.barbs(lons + shift_x, lats + shift_y, u, v, (u**2 + v**2)**(0.5),
+                        zorder=6, length=4, cmap=cmap, norm=norm)
     else:
-        ax.barbs(lons + shift_x, lats + shift_y, u, v, zorder=6, length=6)
+        return ax.barbs(lons + shift_x, lats + shift_y, u, v, zorder=6, length=6)
+
+
+@instrument.stage()
+def add_contourf_on_map(ax, grid_lons, grid_lats, grid, levels=None,
+                        cmap='rainbow', alpha=0.6, minval=None, maxval=None):
+    '''Draw filled contours of a gridded field (e.g. from interpolation.interpolate)
+    above the map layers and below the station values.
+    - levels are the contour levels, by default 20 levels between minval and maxval
+    (the field extremes if not given)'''
+    if levels is None:
+        if minval is None:
+            minval = np.nanmin(grid)
+        if maxval is None:
+            maxval = np.nanmax(grid)
+        levels = np.linspace(minval, maxval, 21)
+
+    kwargs = {}
+    if has_cartopy():
+        import cartopy.crs as ccrs
+        kwargs['transform'] = ccrs.PlateCarree()
+
+    return ax.contourf(grid_lons, grid_lats, grid, levels=levels, cmap=cmap,
+                       alpha=alpha, extend='both', zorder=2, **kwargs)
 
 
 def wind_degrees_from_direction(wdir, rad=True):
@@ -238,39 +555,71 @@ def wind_degrees_from_direction(wdir, rad=True):
         'NW': -45.0,
         'NNW': -22.5
     }
-    if wdir:
+    if wdir in conversion:
         if rad:
             return np.deg2rad(conversion[wdir])
         else:
             return conversion[wdir]
     else:
-        return None
+        return np.nan
+
+
+def wind_direction_codes(wdir):
+    '''Return the position of every cardinal direction in WIND_DIRECTIONS,
+    -1 for missing or unknown directions'''
+    import pandas as pd
+
+    directions = pd.Index(WIND_DIRECTIONS)
+    if isinstance(getattr(wdir, 'dtype', None), pd.CategoricalDtype):
+        # As parsed from the answers: only the categories are looked up
+        wdir = pd.Categorical(wdir)
+        positions = np.append(directions.get_indexer(wdir.categories), -1)
+        return positions[wdir.codes]
+
+    return directions.get_indexer(pd.Index(np.asarray(wdir, dtype=object)))
 
 
+@instrument.stage()
 def wind_components(speed, wdir):
-    '''Get wind components from speed and direction.'''
-    func_v = np.vectorize(wind_degrees_from_direction)
-    wdir = func_v(wdir)
-    u = -speed * np.sin(wdir)
-    v = -speed * np.cos(wdir)
+    '''Get wind components from speed and direction.
+    Directions are converted through a table of the sine and cosine of every
+    cardinal direction, so that missing or unknown directions give NaN.'''
+    codes = wind_direction_codes(wdir)
+    speed = np.asarray(speed, dtype=float)
+    u = -speed * WIND_SIN[codes]
+    v = -speed * WIND_COS[codes]
 
     return u, v
 
 
+@lru_cache(maxsize=None)
+def read_logo(logo):
+    '''Read a logo image only once'''
+    from matplotlib.image import imread as read_png
+
+    return read_png(logo)
+
+
+@instrument.stage()
 def add_logo_on_map(ax, logo, zoom=0.15, pos=(0.92, 0.1)):
     '''Add a logo on the map given a pnd image, a zoom and a position
     relative to the axis ax.'''
-    img_logo = OffsetImage(read_png(logo), zoom=zoom)
+    from matplotlib.offsetbox import AnnotationBbox, OffsetImage
+
+    img_logo = OffsetImage(read_logo(logo), zoom=zoom)
     logo_ann = AnnotationBbox(
         img_logo, pos, xycoords='axes fraction', frameon=False)
     at = ax.add_artist(logo_ann)
     return at
 
 
+@instrument.stage()
 def add_hist_on_map(ax, var, width="30%", height="15%", loc=1, label='Temperatura [C]'):
     '''Add an histogram of the variable on the map, specifying the location.
     Unfortunately face color has to be hardcoded while I understand how can
     one retrieve the  color of the fillcontinents method from basemap.'''
+    from mpl_toolkits.axes_grid1.inset_locator import inset_axes
+
     axin = inset_axes(ax, width=width, height=height, loc=loc)
     hist = axin.hist(var[~np.isnan(var)], bins=50,
                      density=True, color='black', alpha=0.8)